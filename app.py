@@ -1,20 +1,30 @@
-import io
-import json
 import os
+import queue
 import time
 import traceback
-
-import pydub
-from flask import Flask, request, render_template, jsonify
-from faster_whisper import WhisperModel, download_model
-
-from lib.address_handler import get_potential_addresses
-from lib.config_handler import load_config_file, get_max_content_length, is_model_outdated
-from lib.helpers import load_json, update_config, validate_audio_file, inject_alert_tone_segments
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, request, render_template, jsonify, Response, stream_with_context
+
+from lib.archive_handler import CallArchive, MemberTooLarge, pair_call_files
+from lib.audio_handler import SAMPLE_RATE
+from lib.cache_handler import ResultCache, get_cache_key
+from lib.config_handler import load_config_file, get_max_content_length
+from lib.helpers import load_json, validate_audio_file
+from lib.job_handler import JobQueue, JobQueueFull, TranscriptionJob
+from lib.json_handler import FastJSONProvider, dumps, dumps_result_line, to_columnar_result, to_columnar_segment, \
+    word_formats
 from lib.logging_handler import CustomLogger
-from lib.replacement_handler import transcript_replacement
-from lib.tone_removal_handler import cut_tones_from_audio, apply_agc_with_silence_detection
-from lib.unit_handler import associate_segments_with_src
+from lib.metrics_handler import metrics, record_job, time_stage
+from lib.inference_handler import InferenceClient, RemoteModelStartup, connection_errors, get_authkey, \
+    get_inference_socket_path
+from lib.model_handler import ModelStartup, get_model_key, get_model_registry
+from lib.profile_handler import get_profile_store
+from lib.prompt_handler import get_prompt_store
+from lib.replacement_handler import get_replacements_file_version
+from lib.transcribe_handler import get_replacements_file_path, get_warm_up, preprocess_audio, set_prompt_store, \
+    transcribe_model_groups
+from lib.upload_handler import MemoryLimiter, MemoryLimitExceeded, SpooledUploadRequest, get_process_rss
 
 app_name = "icad_transcribe"
 __version__ = "2.1"
@@ -31,8 +41,6 @@ config_path = os.path.join(root_path, 'etc')
 logging_instance = CustomLogger(1, f'{app_name}',
                                 os.path.join(log_path, log_file_name))
 
-last_transcript_data = {}
-
 try:
     config_data = load_config_file(os.path.join(config_path, config_file_name))
     whisper_config_data = config_data.get("whisper", {})
@@ -52,35 +60,280 @@ if not config_data:
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+app.json = FastJSONProvider(app)
 app.config['MAX_CONTENT_LENGTH'] = get_max_content_length(config_data)
 
-model_cache_dir = os.path.join(os.getenv("TRANSFORMERS_CACHE", os.path.join(root_path, 'models')),
-                               config_data.get("whisper", {}).get("model", "small"))
+# Uploads go straight to named temp files so the decoder can read them by path.
+SpooledUploadRequest.spool_path = config_data.get("audio_upload", {}).get("spool_path", None)
+SpooledUploadRequest.endpoint_max_content_length = {
+    "transcribe_batch_upload": int(config_data.get("batch_upload", {}).get("max_upload_size_mb", 512) * 1024 * 1024)}
+app.request_class = SpooledUploadRequest
 
-if is_model_outdated(model_cache_dir):
-    logger.warning(
-        f"Model is outdated or not found. Downloading model {config_data.get('whisper', {}).get('model', 'small')}...")
-    model_dir = download_model(config_data.get("whisper", {}).get("model", "small"), output_dir=model_cache_dir)
-else:
-    logger.info(f"Using cached model. {config_data.get('whisper', {}).get('model', 'small')}")
-    model_dir = model_cache_dir
+memory_limiter = MemoryLimiter(config_data.get("audio_upload", {}).get("memory_ceiling_mb", 0))
 
-try:
-    if config_data.get("whisper", {}).get("device", None) in ["cpu", "cuda"]:
-        model = WhisperModel(model_dir,
-                             device=config_data.get("whisper", {}).get("device", "cpu"),
-                             cpu_threads=config_data.get("whisper", {}).get("cpu_threads", 4),
-                             compute_type=config_data.get("whisper", {}).get("compute_type", "float16"))
-    else:
-        logger.error(f'Whisper device needs to be either CPU or Cuda.')
-        time.sleep(5)
-        exit(1)
+models_path = os.getenv("TRANSFORMERS_CACHE", os.path.join(root_path, 'models'))
+model_registry = get_model_registry(config_data, models_path)
 
-except Exception as e:
-    logger.error(f'Exception Loading Whisper Model: {e}')
+if config_data.get("whisper", {}).get("device", None) not in ["cpu", "cuda"]:
+    logger.error(f'Whisper device needs to be either CPU or Cuda.')
     time.sleep(5)
     exit(1)
 
+inference_client = None
+if config_data.get("inference_server", {}).get("enabled", False):
+    # The models live in the inference server process gunicorn.conf.py starts, this worker only sends it audio.
+    inference_client = InferenceClient(get_inference_socket_path(config_data), authkey=get_authkey())
+    model_startup = RemoteModelStartup(inference_client)
+else:
+    # The default model loads in the background so the server binds right away, /readyz reports when it is
+    # resident and warmed up. Any other model is loaded the first time a request asks for it.
+    model_startup = ModelStartup(model_registry, get_model_key(whisper_config_data),
+                                 warm_up=get_warm_up(config_data))
+    model_startup.start()
+
+
+result_cache = None
+if config_data.get("result_cache", {}).get("enabled", True):
+    result_cache = ResultCache(max_entries=config_data.get("result_cache", {}).get("max_entries", 256),
+                               ttl=config_data.get("result_cache", {}).get("ttl", 86400),
+                               disk_path=config_data.get("result_cache", {}).get("disk_path", None))
+
+set_prompt_store(get_prompt_store(config_data))
+
+profile_store = get_profile_store(config_data, os.path.join(config_path, config_file_name))
+
+
+def get_model_registry_stats():
+    """Stats of the models loaded here, or on the inference server. None when the inference server is unreachable."""
+    if not inference_client:
+        return model_registry.stats()
+    try:
+        return inference_client.status()["model_registry"]
+    except connection_errors as e:
+        logger.warning(f"Inference server unavailable: {e}")
+        return None
+
+
+def process_jobs(jobs):
+    """Transcribes a batch of jobs, here or on the inference server, and records and caches the results."""
+    if inference_client:
+        results = inference_client.transcribe_jobs(jobs)
+    else:
+        results = transcribe_model_groups(model_registry, jobs, config_path)
+
+    finished_at = time.time()
+    for job, result in zip(jobs, results):
+        record_job(get_model_key(job.whisper_config_data)[0], result[1], job.call_data, job.audio_duration,
+                   finished_at - (job.started_at or finished_at))
+        if result_cache and job.cache_key and result[1] == 200:
+            result_cache.put(job.cache_key, result[0])
+
+    return results
+
+
+job_queue = JobQueue(process_jobs,
+                     max_queue_size=config_data.get("job_queue", {}).get("max_queue_size", 32),
+                     workers=config_data.get("job_queue", {}).get("workers", 1),
+                     result_ttl=config_data.get("job_queue", {}).get("result_ttl", 600),
+                     batch_size=config_data.get("job_queue", {}).get("batch_size", 8),
+                     batch_window=config_data.get("job_queue", {}).get("batch_window_ms", 50) / 1000)
+
+metrics.gauge("queue_depth", "Jobs waiting for an inference worker.", lambda: job_queue.depth)
+metrics.gauge("in_flight", "Jobs currently being transcribed.", lambda: job_queue.in_flight)
+metrics.gauge("tracked_jobs", "Queued, running and finished jobs held for polling.", lambda: job_queue.tracked_jobs)
+metrics.gauge("memory_rejections", "Uploads rejected by the memory ceiling.", lambda: memory_limiter.rejections)
+metrics.gauge("resident_memory_bytes", "Resident memory of this worker process.", lambda: get_process_rss() or 0)
+metrics.gauge("model_ready", "1 once the default model is loaded.", lambda: int(model_startup.ready))
+metrics.gauge("models_loaded", "Whisper models resident in memory.",
+              lambda: len((get_model_registry_stats() or {}).get("models", [])))
+
+
+def error_response(result, status_code, headers=None):
+    response = jsonify(result)
+    for header, value in (headers or {}).items():
+        response.headers[header] = value
+    return response, status_code
+
+
+def prepare_transcription_job(audio_file, call_data, user_whisper_config_data, start=None, streaming=False):
+    """
+    Validates, decodes and preprocesses one call and builds a job for the queue.
+
+    Does not touch the Flask request, so batch uploads can prepare calls from worker threads.
+
+    Parameters:
+    -----------
+    audio_file : file-like object
+        The uploaded audio.
+    call_data : dict
+        The call JSON sent with the upload.
+    user_whisper_config_data : dict
+        The effective whisper configuration for the call.
+    start : float
+        Time the call was received.
+    streaming : bool
+        Build a streaming job that publishes each segment as soon as it is decoded.
+
+    Returns:
+    --------
+    tuple
+        (job, None) on success or (None, (result, status_code, headers)) when the call is rejected.
+    """
+    start = start or time.time()
+
+    model_key = get_model_key(user_whisper_config_data)
+    model_error = model_registry.validate(model_key)
+    if model_error:
+        logger.error(model_error)
+        return None, ({"success": False, "message": model_error}, 400, None)
+
+    cache_key = None
+    # With use_last_as_initial_prompt the response depends on the talkgroup's previous calls, it is never cached.
+    if result_cache and not user_whisper_config_data.get("use_last_as_initial_prompt", False):
+        # A repeat of an upload we have already answered skips decoding and inference entirely.
+        replacements_version = get_replacements_file_version(get_replacements_file_path(user_whisper_config_data,
+                                                                                         config_path))
+        cache_key = get_cache_key(getattr(audio_file, "stream", audio_file), user_whisper_config_data, model_key,
+                                  call_data, replacements_version=replacements_version)
+        cached_result = result_cache.get(cache_key)
+        if cached_result:
+            logger.debug(f"Result cache hit {cache_key}")
+            job = TranscriptionJob(None, call_data, user_whisper_config_data, {}, start=start, streaming=streaming)
+            job.cache_key = cache_key
+            job.finish(cached_result, 200)
+            return job, None
+
+    # Validate audio file, this also decodes it once for the rest of the pipeline
+    try:
+        is_valid, validation_response, audio = validate_audio_file(audio_file,
+                                                                   config_data.get("audio_upload", {}).get(
+                                                                       "allowed_extensions",
+                                                                       ["audio/x-wav", "audio/x-m4a", "audio/mpeg"]),
+                                                                   config_data.get("audio_upload", {}).get(
+                                                                       "max_audio_length", 300),
+                                                                   memory_limiter=memory_limiter)
+    except MemoryLimitExceeded as e:
+        retry_after = job_queue.retry_after()
+        logger.warning(f"{e}, rejecting upload")
+        return None, ({"success": False, "message": "Server is out of memory for new uploads, try again later",
+                       "retry_after": retry_after}, 503, {"Retry-After": str(retry_after)})
+    if not is_valid:
+        logger.error(validation_response)
+        return None, ({"success": False, "message": validation_response}, 400, None)
+
+    # Metrics count the call's length as uploaded, before trim_silence shortens it.
+    audio_duration = audio.shape[0] / SAMPLE_RATE
+    audio, detected_tones, timestamp_map = preprocess_audio(audio, call_data, user_whisper_config_data)
+
+    job = TranscriptionJob(audio, call_data, user_whisper_config_data, detected_tones, start=start,
+                           streaming=streaming, timestamp_map=timestamp_map, audio_duration=audio_duration)
+    job.cache_key = cache_key
+    return job, None
+
+
+def get_request_whisper_config(call_data):
+    """
+    Resolves the whisper configuration of a call, the configured defaults with the talkgroup's profile and the
+    whisper_config_data form field of the current request merged over them.
+
+    Parameters:
+    -----------
+    call_data : dict
+        The call JSON, its short_name and talkgroup_decimal select the profile.
+
+    Returns:
+    --------
+    tuple
+        (whisper_config_data, None) or (None, error message) if the field is not a valid JSON object.
+    """
+    user_whisper_config_data, config_error = profile_store.resolve(call_data, request.form.get('whisper_config_data'))
+    if config_error:
+        logger.error("Error parsing User Whisper Config Data")
+    return user_whisper_config_data, config_error
+
+
+def build_transcription_job(streaming=False):
+    """
+    Parses and validates a transcription upload from the current request and builds a job for the queue.
+
+    Parameters:
+    -----------
+    streaming : bool
+        Build a streaming job that publishes each segment as soon as it is decoded.
+
+    Returns:
+    --------
+    tuple
+        (job, None) on success or (None, (response, status_code)) when the request is invalid.
+    """
+    start = time.time()
+    with time_stage("upload_read"):
+        # The multipart body is parsed on first access to request.files.
+        audio_file = request.files.get('audioFile')
+        json_file = request.files.get('jsonFile')
+
+    if not audio_file:
+        result = {"success": False, "message": "No audio file uploaded"}
+        logger.error("No audio file uploaded")
+        return None, (jsonify(result), 400)
+
+    if json_file:
+        # Load and validate JSON file data
+        call_data, error = load_json(json_file)
+        if error:
+            logger.error(error)
+            return None, (jsonify({"success": False, "message": error}), 400)
+    else:
+        call_data = {}
+
+    user_whisper_config_data, config_error = get_request_whisper_config(call_data)
+    if config_error:
+        return None, (jsonify({"success": False, "message": config_error}), 400)
+
+    logger.debug(f"Using Whisper Configuration: {user_whisper_config_data}")
+
+    job, error = prepare_transcription_job(audio_file, call_data, user_whisper_config_data, start=start,
+                                           streaming=streaming)
+    if error:
+        return None, error_response(*error)
+    return job, None
+
+
+def submit_job(job):
+    """Submits a job to the queue, returns an error response tuple if the queue is saturated."""
+    try:
+        job_queue.submit(job)
+    except JobQueueFull as e:
+        logger.warning(f"{e}, queue depth {job_queue.depth}")
+        response = jsonify({"success": False, "message": "Transcription queue is full, try again later",
+                            "retry_after": e.retry_after})
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 429
+    return None
+
+
+def get_request_word_format():
+    """
+    Reads the word_format query option, objects returns one object per word, columns returns each segment's
+    words as parallel arrays.
+
+    Returns:
+    --------
+    tuple
+        (word_format, None) or (None, error response tuple).
+    """
+    word_format = request.args.get("word_format", "objects")
+    if word_format not in word_formats:
+        return None, (jsonify({"success": False, "message": f"word_format must be one of {list(word_formats)}"}), 400)
+    return word_format, None
+
+
+def result_response(result, status_code, word_format="objects"):
+    with time_stage("json_serialization"):
+        if word_format == "columns":
+            result = to_columnar_result(result)
+        return jsonify(result), status_code
+
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
@@ -90,157 +343,352 @@ def request_entity_too_large(error):
 @app.route('/transcribe', methods=["POST"])
 def transcribe():
     if request.method == "POST":
-        start = time.time()
-        audio_file = request.files.get('audioFile')
-        json_file = request.files.get('jsonFile')
-        user_whisper_config_data = request.form.get('whisper_config_data')
-        detected_tones = {"two_tone": [], "long_tone": [], "hl_tone": []}
-
-        if not audio_file:
-            result = {"success": False, "message": "No audio file uploaded"}
-            logger.error("No audio file uploaded")
-            return jsonify(result), 400
-
-        if json_file:
-            # Load and validate JSON file data
-            call_data, error = load_json(json_file)
-            if error:
-                logger.error(error)
-                return jsonify({"success": False, "message": error}), 400
-        else:
-            call_data = {}
-
-        # Update config data with user input
-        if user_whisper_config_data:
-            try:
-                user_whisper_config_data = json.loads(user_whisper_config_data)
-                user_whisper_config_data = update_config(whisper_config_data, user_whisper_config_data)
-            except json.JSONDecodeError:
-                logger.exception("Error parsing User Whisper Config Data")
-                return jsonify({"success": False, "message": "Invalid Custom Whisper Config JSON data"}), 400
-        else:
-            user_whisper_config_data = whisper_config_data
-
-        logger.debug(f"Using Whisper Configuration: {user_whisper_config_data}")
-
-        transmission_sources = call_data.get('srcList', [{
-            "pos": 0,
-            "src": 0,
-            "tag": "Speaker"
-        }])
-
-        short_name = call_data.get("short_name", "unknown")
-        talkgroup_decimal = call_data.get("talkgroup_decimal", 0)
-
-        # Validate audio file
-        is_valid, validation_response = validate_audio_file(audio_file, config_data.get("audio_upload", {}).get(
-            "allowed_extensions", ["audio/x-wav", "audio/x-m4a", "audio/mpeg"]),
-                                                            config_data.get("audio_upload", {}).get("max_audio_length",
-                                                                                                    300))
-        if not is_valid:
-            logger.error(validation_response)
-            return jsonify({"success": False, "message": validation_response}), 400
-
-        audio_file.seek(0)  # Rewind the buffer to the beginning
-
-        audio_segment = pydub.AudioSegment.from_file(io.BytesIO(audio_file.read()))
-        original_sample_rate = audio_segment.frame_rate
-
-        if user_whisper_config_data.get("cut_tones", False):
-            if call_data.get("tones", {}):
-                detected_tones = call_data["tones"]
-                logger.debug(f"Cutting Tones From Audio: {detected_tones}")
-                audio_segment = cut_tones_from_audio(detected_tones, audio_segment,
-                                                         pre_cut_length=user_whisper_config_data.get(
-                                                             "cut_pre_tone", 0.5),
-                                                         post_cut_length=user_whisper_config_data.get(
-                                                             "cut_post_tone", 0.5))
-
-        if user_whisper_config_data.get("amplify_audio", False):
-            logger.debug(f"Amplifying Audio")
-            audio_segment = apply_agc_with_silence_detection(audio_segment, target_peak=user_whisper_config_data.get("amplify_target_peak", -25), silence_threshold=user_whisper_config_data.get("amplify_silence_threshold", -48), clipping_threshold=user_whisper_config_data.get("amplify_clipping_threshold", -12))
-
-        # Convert the PyDub AudioSegment to bytes
-        audio_buffer = io.BytesIO()
-        audio_segment.export(audio_buffer, format='wav', parameters=["-ar", str(original_sample_rate)])
-        audio_buffer.seek(0)
+        word_format, error = get_request_word_format()
+        if error:
+            return error
 
-        try:
+        job, error = build_transcription_job()
+        if error:
+            return error
 
-            if user_whisper_config_data.get("use_last_as_initial_prompt", False) and call_data:
-                initial_prompt = last_transcript_data.get(short_name, {}).get(str(talkgroup_decimal), {}).get(
-                    "transcript", None)
-            else:
-                initial_prompt = user_whisper_config_data.get("initial_prompt", None)
-
-            segments, info = model.transcribe(audio_buffer,
-                                              beam_size=user_whisper_config_data.get("beam_size", 5),
-                                              best_of=user_whisper_config_data.get("best_of", 5),
-                                              language=user_whisper_config_data.get("language", "en"),
-                                              initial_prompt=initial_prompt or None,
-                                              word_timestamps=user_whisper_config_data.get("word_timestamps", False),
-                                              vad_filter=user_whisper_config_data.get("vad_filter", False),
-                                              vad_parameters=user_whisper_config_data.get("vad_parameters", {"threshold": 0.5, "min_speech_duration_ms": 250, "max_speech_duration_s": 3600, "min_silence_duration_ms": 2000, "window_size_samples": 1024, "speech_pad_ms": 400}),
-                                              hotwords=user_whisper_config_data.get("hotwords", None))
-
-            segment_texts = []
-            segments_data = []
-            segment_count = 0
-            for segment in segments:
-                segment_count += 1
-                segment_texts.append(segment.text.strip())
-                text = []
-                word_id = 0
-                if user_whisper_config_data.get("word_timestamps", False):
-                    for word in segment.words:
-                        word_id += 1
-                        text.append({'word_id': word_id, 'word': word.word, 'start': word.start, 'end': word.end})
-                else:
-                    text = []
-
-                segments_data.append(
-                    {"segment_id": segment_count, "text": segment.text.strip(), "words": text, "unit_tag": "",
-                     "start": segment.start,
-                     "end": segment.end})
-
-            if user_whisper_config_data.get("cut_tones", False) and user_whisper_config_data.get("show_tone_text", False):
-                segments_data = inject_alert_tone_segments(segments_data, detected_tones)
-
-            segments_data = associate_segments_with_src(segments_data, transmission_sources)
-
-            transcribe_text = " ".join(segment['text'] for segment in segments_data)
+        error = submit_job(job)
+        if error:
+            return error
 
-        except Exception as e:
-            traceback.print_exc()
-            result = {"success": False, "message": f"Exception: {e}"}
+        if not job.wait(config_data.get("job_queue", {}).get("transcribe_timeout", 300)):
+            result = {"success": False, "message": "Timed out waiting for transcription", "job_id": job.job_id}
             logger.error(result.get("message"))
-            return jsonify(result), 400
-
-        if not transcribe_text or len(transcribe_text.strip()) == 0:
-            transcribe_text = []
-            addresses = []
-        else:
-            addresses = get_potential_addresses(transcribe_text)
-
-        if user_whisper_config_data.get("use_last_as_initial_prompt", False):
-            last_transcript = {str(talkgroup_decimal): {"transcript": transcribe_text}}
-            last_transcript_data[short_name] = last_transcript
-
-        result = {"success": True, "message": "Transcribe Success!", "transcript": transcribe_text,
-                  "addresses": addresses, "segments": segments_data,
-                  "process_time_seconds": round((time.time() - start), 2)}
-
-        if not user_whisper_config_data.get("word_timestamps", False):
-            result = transcript_replacement(result, replacements_file_path=os.path.join(config_path, user_whisper_config_data.get("replacements_file", "transcribe_replacements.csv")))
+            return jsonify(result), 504
 
-        logger.info(result.get("message"))
-        return jsonify(result), 200
+        logger.info(job.result.get("message"))
+        return result_response(job.result, job.status_code, word_format)
     else:
         result = {"success": False, "message": "Method not allowed GET"}
         logger.error(result.get("message"))
         return jsonify(result), 405
 
 
+def format_stream_event(event, data, stream_format, word_format="objects"):
+    with time_stage("json_serialization"):
+        if word_format == "columns":
+            data = to_columnar_segment(data) if event == "segment" else to_columnar_result(data)
+        if stream_format == "ndjson":
+            return dumps({"type": event, **data}) + "\n"
+        return f"event: {event}\ndata: {dumps(data)}\n\n"
+
+
+@app.route('/transcribe/stream', methods=["POST"])
+def transcribe_stream():
+    """
+    Streams each segment as soon as it is decoded, as Server-Sent Events by default or as newline delimited JSON
+    with ?format=ndjson. Segment events already carry their unit tag and replacements, the final result event
+    is the same response /transcribe returns, including the addresses and process time. ?word_format=columns
+    sends word lists as parallel arrays, like every other transcription route.
+    """
+    stream_format = request.args.get("format", "sse")
+    if stream_format not in ["sse", "ndjson"]:
+        return jsonify({"success": False, "message": "format must be one of ['sse', 'ndjson']"}), 400
+    word_format, error = get_request_word_format()
+    if error:
+        return error
+
+    job, error = build_transcription_job(streaming=True)
+    if error:
+        return error
+
+    error = submit_job(job)
+    if error:
+        return error
+
+    timeout = config_data.get("job_queue", {}).get("transcribe_timeout", 300)
+    keepalive = config_data.get("job_queue", {}).get("stream_keepalive", 15)
+
+    def generate_events():
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                result = {"success": False, "message": "Timed out waiting for transcription", "job_id": job.job_id}
+                logger.error(result.get("message"))
+                yield format_stream_event("error", result, stream_format, word_format)
+                return
+
+            try:
+                event, data = job.events.get(timeout=min(keepalive, remaining))
+            except queue.Empty:
+                # Keeps proxies from closing an idle connection while the job waits in the queue.
+                yield ": keepalive\n\n" if stream_format == "sse" else "\n"
+                continue
+
+            yield format_stream_event(event, data, stream_format, word_format)
+            if event != "segment":
+                logger.info(data.get("message"))
+                return
+
+    mimetype = "application/x-ndjson" if stream_format == "ndjson" else "text/event-stream"
+    response = Response(stream_with_context(generate_events()), mimetype=mimetype)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.headers["X-Job-Id"] = job.job_id
+    return response
+
+
+def get_batch_upload_calls():
+    """
+    Collects the calls of a batch upload from the current request, either from an archive file field or from
+    repeated audioFile and jsonFile fields matched by file name.
+
+    Returns:
+    --------
+    tuple
+        (calls, archive, None) where calls is a list of (filename, open_audio, read_json) tuples, or
+        (None, None, error message).
+    """
+    archive_file = request.files.get('archive')
+    if archive_file:
+        try:
+            # A member may be as large as a single /transcribe upload, and the archive may not extract to more
+            # than a batch upload may send.
+            archive = CallArchive(archive_file.stream, spool_path=SpooledUploadRequest.spool_path,
+                                  max_member_size=app.config['MAX_CONTENT_LENGTH'],
+                                  max_total_size=SpooledUploadRequest.endpoint_max_content_length[
+                                      "transcribe_batch_upload"])
+        except Exception as e:
+            return None, None, f"Unable to read archive: {e}"
+        calls = [(audio_name,
+                  lambda audio_name=audio_name: archive.open_audio(audio_name),
+                  lambda json_name=json_name: archive.read_json(json_name))
+                 for audio_name, json_name in archive.calls]
+        return calls, archive, None
+
+    uploads = {}
+    for upload in request.files.getlist('audioFile') + request.files.getlist('jsonFile'):
+        if upload.filename:
+            uploads[upload.filename] = upload
+
+    calls = [(audio_name,
+              lambda audio_name=audio_name: uploads[audio_name],
+              lambda json_name=json_name: uploads[json_name].read() if json_name else None)
+             for audio_name, json_name in pair_call_files(uploads)]
+    return calls, None, None
+
+
+@app.route('/transcribe/batch', methods=["POST"])
+def transcribe_batch_upload():
+    """
+    Transcribes many calls from one request and streams the results back as newline delimited JSON in the
+    order they finish.
+
+    Calls come either from an archive field holding a zip or tar of audio files and their call JSONs, or from
+    repeated audioFile and jsonFile fields, matched by file name minus the extension. Calls are decoded and
+    preprocessed in parallel and go through the job queue like any other request, so they share batched
+    inference with everything else. Every line is a /transcribe response with the input filename added, the last
+    line summarises the batch.
+    """
+    start = time.time()
+    word_format, error = get_request_word_format()
+    if error:
+        return error
+
+    with time_stage("upload_read"):
+        calls, archive, error = get_batch_upload_calls()
+        # Checks the request's overrides once, each call resolves its own talkgroup's profile below.
+        whisper_overrides = request.form.get('whisper_config_data')
+        _, config_error = get_request_whisper_config({})
+
+    if error or config_error:
+        logger.error(error or config_error)
+        return jsonify({"success": False, "message": error or config_error}), 400
+    if not calls:
+        if archive:
+            archive.close()
+        return jsonify({"success": False, "message": "No audio files uploaded"}), 400
+
+    decode_workers = config_data.get("batch_upload", {}).get("decode_workers", 4)
+    max_in_flight = config_data.get("batch_upload", {}).get("max_in_flight", 8)
+    timeout = config_data.get("job_queue", {}).get("transcribe_timeout", 300)
+
+    def prepare_call(audio_file, call_data):
+        try:
+            user_whisper_config_data, _ = profile_store.resolve(call_data, whisper_overrides)
+            return prepare_transcription_job(audio_file, call_data, user_whisper_config_data)
+        except Exception as e:
+            traceback.print_exc()
+            return None, ({"success": False, "message": f"Exception: {e}"}, 500, None)
+        finally:
+            audio_file.close()
+
+    def result_line(filename, result, status_code):
+        with time_stage("json_serialization"):
+            return dumps_result_line(filename, result, status_code, word_format)
+
+    def generate_results():
+        # Decode results and finished jobs both land here, so lines go out in completion order.
+        completions = queue.Queue()
+        pending_calls = iter(calls)
+        in_flight = 0
+        failed = 0
+
+        def schedule_next():
+            nonlocal in_flight
+            for filename, open_audio, read_json in pending_calls:
+                in_flight += 1
+                try:
+                    json_bytes = read_json()
+                    call_data, json_error = load_json(json_bytes) if json_bytes is not None else ({}, None)
+                    if json_error:
+                        completions.put(("rejected", filename, ({"success": False, "message": json_error}, 400)))
+                        return True
+                    future = executor.submit(prepare_call, open_audio(), call_data)
+                except MemberTooLarge as e:
+                    completions.put(("rejected", filename, ({"success": False, "message": str(e)}, 413)))
+                    return True
+                except Exception as e:
+                    completions.put(("rejected", filename, ({"success": False, "message": f"Exception: {e}"}, 500)))
+                    return True
+                future.add_done_callback(
+                    lambda done_future, filename=filename: completions.put(("prepared", filename,
+                                                                            done_future.result())))
+                return True
+            return False
+
+        try:
+            with ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="batch-decode") as executor:
+                while in_flight < max_in_flight and schedule_next():
+                    pass
+
+                while in_flight:
+                    try:
+                        event, filename, payload = completions.get(timeout=timeout)
+                    except queue.Empty:
+                        message = "Timed out waiting for transcription"
+                        logger.error(f"{message}, {in_flight} call(s) of the batch still pending")
+                        yield dumps({"success": False, "message": message, "pending": in_flight}) + "\n"
+                        return
+
+                    if event == "prepared":
+                        job, error = payload
+                        if error:
+                            event, payload = "rejected", (error[0], error[1])
+                        else:
+                            while True:
+                                try:
+                                    job_queue.submit(job)
+                                    break
+                                except JobQueueFull as e:
+                                    # Other clients filled the queue, hold this call back until there is room.
+                                    time.sleep(min(1.0, e.retry_after))
+                            job.add_done_callback(
+                                lambda done_job, filename=filename: completions.put(
+                                    ("finished", filename, (done_job.result, done_job.status_code))))
+                            continue
+
+                    result, status_code = payload
+                    in_flight -= 1
+                    if status_code != 200:
+                        failed += 1
+                    yield result_line(filename, result, status_code)
+
+                    while in_flight < max_in_flight and schedule_next():
+                        pass
+        finally:
+            if archive:
+                archive.close()
+
+        logger.info(f"Batch of {len(calls)} call(s) complete, {failed} failed")
+        yield dumps({"success": True, "message": "Batch Complete", "calls": len(calls), "failed": failed,
+                     "process_time_seconds": round(time.time() - start, 2)}) + "\n"
+
+    response = Response(stream_with_context(generate_results()), mimetype="application/x-ndjson")
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route('/jobs', methods=["POST"])
+def submit_transcription_job():
+    job, error = build_transcription_job()
+    if error:
+        return error
+
+    error = submit_job(job)
+    if error:
+        return error
+
+    response = jsonify({"success": True, "message": "Job Queued", "job_id": job.job_id, "status": job.status,
+                        "queue_depth": job_queue.depth})
+    response.headers["Location"] = f"/jobs/{job.job_id}"
+    return response, 202
+
+
+@app.route('/jobs/<job_id>', methods=["GET"])
+def get_transcription_job(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"success": False, "message": "Job not found"}), 404
+
+    return jsonify({"success": True, **job.to_dict()}), 200
+
+
+@app.route('/jobs/<job_id>/result', methods=["GET"])
+def get_transcription_job_result(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"success": False, "message": "Job not found"}), 404
+
+    # Long poll, hold the request open until the job finishes or the wait runs out
+    max_wait = config_data.get("job_queue", {}).get("max_wait", 60)
+    try:
+        wait = min(float(request.args.get("wait", max_wait)), max_wait)
+    except ValueError:
+        return jsonify({"success": False, "message": "wait must be a number of seconds"}), 400
+    word_format, error = get_request_word_format()
+    if error:
+        return error
+
+    if not job.wait(max(0.0, wait)):
+        return jsonify({"success": True, **job.to_dict()}), 202
+
+    return result_response(job.result, job.status_code, word_format)
+
+
+@app.route('/models', methods=["GET"])
+def get_models():
+    model_registry_stats = get_model_registry_stats()
+    if model_registry_stats is None:
+        return jsonify({"success": False, "message": "Inference server unavailable"}), 503
+    return jsonify({"success": True, **model_registry_stats}), 200
+
+
+@app.route('/healthz', methods=["GET"])
+def healthz():
+    """Liveness, the process is up and serving. Fails only when loading the default model failed."""
+    if model_startup.failed:
+        return jsonify({"success": False, **model_startup.to_dict()}), 503
+    return jsonify({"success": True, "status": "alive"}), 200
+
+
+@app.route('/readyz', methods=["GET"])
+def readyz():
+    """Readiness, the default model is loaded and requests will not wait on startup."""
+    if not model_startup.ready:
+        response = jsonify({"success": False, **model_startup.to_dict()})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+    return jsonify({"success": True, **model_startup.to_dict()}), 200
+
+
+@app.route('/metrics', methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/cache', methods=["GET"])
+def get_cache_stats():
+    if not result_cache:
+        return jsonify({"success": True, "enabled": False}), 200
+    return jsonify({"success": True, "enabled": True, **result_cache.stats()}), 200
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
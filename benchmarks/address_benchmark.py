@@ -0,0 +1,79 @@
+"""
+Benchmarks address and town extraction over a generated corpus of long fire-ground style transcripts.
+
+Run from the repository root:
+
+    python -m benchmarks.address_benchmark --words 100 400 1600 --transcripts 50
+"""
+import argparse
+import json
+import random
+import time
+
+from lib.address_handler import get_potential_addresses
+
+radio_phrases = ["Command to Engine 12", "Ladder 4 on scene", "Engine 31 responding", "Medic 9 available",
+                 "Division Alpha", "Interior Crew reports", "Primary Search Complete", "Water Supply Established",
+                 "Battalion Chief", "Rapid Intervention Team", "Second Alarm", "Fire Ground Channel",
+                 "Structure Fire", "Working Fire", "Mayday Mayday", "Rehab Sector", "copy", "received", "standby",
+                 "respond to", "at the intersection of", "between", "near", "and"]
+streets = ["123 Main Street", "45 North Oak Avenue Apartment 3", "1200 Route 6", "77 Old Mill Lane",
+           "9 Martin Luther King Boulevard", "Fifth Street and Second Street"]
+towns = ["in the Town of Bradford", "in Lewis Run,", "near Foster Township", "Eldred Borough"]
+
+
+def generate_transcript(word_count, rng, capitalized=False):
+    words = []
+    while len(words) < word_count:
+        choice = rng.random()
+        if choice < 0.05:
+            words.extend(rng.choice(streets).split())
+        elif choice < 0.08:
+            words.extend(rng.choice(towns).split())
+        else:
+            words.extend(rng.choice(radio_phrases).split())
+    if capitalized:
+        words = [word.capitalize() for word in words]
+    return " ".join(words[:word_count])
+
+
+def run_benchmark(word_counts, transcript_count, seed=0):
+    rng = random.Random(seed)
+    results = []
+    for word_count in word_counts:
+        for capitalized in (False, True):
+            corpus = [generate_transcript(word_count, rng, capitalized) for _ in range(transcript_count)]
+
+            start = time.perf_counter()
+            for transcript in corpus:
+                get_potential_addresses(transcript)
+            elapsed = time.perf_counter() - start
+
+            results.append({"words": word_count, "capitalized": capitalized, "transcripts": transcript_count,
+                            "total_seconds": round(elapsed, 6),
+                            "ms_per_transcript": round(elapsed * 1000 / transcript_count, 4)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark address and town extraction.')
+    parser.add_argument('--words', type=int, nargs='+', default=[100, 400, 1600, 6400],
+                        help='Transcript lengths in words')
+    parser.add_argument('--transcripts', type=int, default=50, help='Transcripts per length')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.words, args.transcripts, seed=args.seed)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'words':>8} {'capitalized':>12} {'ms/transcript':>14}")
+    for result in results:
+        print(f"{result['words']:>8} {str(result['capitalized']):>12} {result['ms_per_transcript']:>14}")
+
+
+if __name__ == "__main__":
+    main()
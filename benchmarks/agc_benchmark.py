@@ -0,0 +1,142 @@
+"""
+Benchmarks the vectorized AGC against the original pydub implementation and reports how far the outputs differ.
+
+The outputs are not bit for bit equal:
+
+- pydub works on int16 samples, every amplified sample is rounded to the int16 grid.
+- pydub's RMS is an integer, which puts its window levels about 0.02 dB lower, and the gain that much higher.
+  Together with the rounding that is a difference of up to about 2e-3 on amplified samples.
+- A window whose level is within those 0.02 dB of silence_threshold can be amplified by one and left alone by
+  the other. Such windows are counted as threshold_flips and left out of max_abs_difference.
+- pydub dropped the samples after the last full 100 ms chunk, the vectorized version amplifies them with the
+  gain of the last window. They are counted as tail_samples and not compared.
+
+Needs pydub, which the service itself no longer uses (pip install pydub). Run from the repository root:
+
+    python -m benchmarks.agc_benchmark --seconds 300 --repeat 5
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from pydub import AudioSegment
+
+from lib.audio_handler import SAMPLE_RATE
+from lib.tone_removal_handler import apply_agc_with_silence_detection, get_window_dbfs
+
+
+def split_audio(audio_segment, chunk_length=1000):
+    # Unchanged from the pydub implementation, whole chunks only.
+    num_chunks = max(1, int(audio_segment.duration_seconds * 1000 // chunk_length))
+    return [audio_segment[i * chunk_length:(i + 1) * chunk_length] for i in range(num_chunks)]
+
+
+def reference_agc(audio_segment, target_peak=-25, clipping_threshold=-12, silence_threshold=-48):
+    """The pydub AGC the sample array version replaced, kept as it was for comparison."""
+    segments = split_audio(audio_segment, chunk_length=100)
+    processed_segments = []
+
+    for segment in segments:
+        segment_peak_dBFS = segment.dBFS
+        is_silent = segment_peak_dBFS < silence_threshold
+
+        if not is_silent:
+            max_gain = clipping_threshold - segment_peak_dBFS
+            gain_needed = min(target_peak - segment_peak_dBFS, max_gain)
+
+            if gain_needed > 0:
+                processed_segments.append(segment.apply_gain(gain_needed))
+            else:
+                processed_segments.append(segment)
+        else:
+            processed_segments.append(segment)
+
+    return sum(processed_segments[1:], processed_segments[0])
+
+
+def to_audio_segment(audio, sample_rate=SAMPLE_RATE):
+    samples = np.clip(np.round(audio * 32768), -32768, 32767).astype("<i2")
+    return AudioSegment(samples.tobytes(), frame_rate=sample_rate, sample_width=2, channels=1)
+
+
+def from_audio_segment(audio_segment):
+    return np.frombuffer(audio_segment.raw_data, dtype="<i2").astype(np.float32) / 32768
+
+
+def generate_radio_audio(seconds, seed=0, sample_rate=SAMPLE_RATE):
+    """Speech-like bursts of varying level separated by dead air, roughly what a busy talkgroup sounds like."""
+    rng = np.random.default_rng(seed)
+    audio = np.zeros(int(seconds * sample_rate), dtype=np.float32)
+
+    position = 0
+    while position < audio.shape[0]:
+        burst_length = int(rng.uniform(0.5, 6) * sample_rate)
+        level = 10 ** (rng.uniform(-50, -10) / 20)
+        burst = rng.standard_normal(min(burst_length, audio.shape[0] - position)).astype(np.float32)
+        envelope = np.abs(np.sin(np.linspace(0, rng.uniform(3, 30), burst.shape[0]))).astype(np.float32)
+        audio[position:position + burst.shape[0]] = burst * envelope * level
+        position += burst_length + int(rng.uniform(0.2, 3) * sample_rate)
+
+    # On the int16 grid, like decoded audio, so both implementations start from the same samples.
+    return (np.clip(np.round(audio * 32768), -32768, 32767) / 32768).astype(np.float32)
+
+
+def time_function(function, audio, repeat, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(audio, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_benchmark(seconds, repeat, seed=0):
+    audio = generate_radio_audio(seconds, seed=seed)
+    audio_segment = to_audio_segment(audio)
+    agc_kwargs = {"target_peak": -22, "clipping_threshold": -11, "silence_threshold": -40}
+
+    vectorized = apply_agc_with_silence_detection(audio, **agc_kwargs)
+    reference = from_audio_segment(reference_agc(audio_segment, **agc_kwargs))
+
+    window_size = int(SAMPLE_RATE * 0.1)
+    difference = np.abs(vectorized[:reference.shape[0]] - reference).reshape(-1, window_size)
+    vectorized_silent = get_window_dbfs(audio, window_size)[:difference.shape[0]] < agc_kwargs["silence_threshold"]
+    reference_silent = np.array([chunk.dBFS < agc_kwargs["silence_threshold"]
+                                 for chunk in split_audio(audio_segment, chunk_length=100)])
+    agreed = vectorized_silent == reference_silent
+    max_difference = float(np.max(difference[agreed])) if agreed.any() else 0.0
+
+    vectorized_seconds = time_function(apply_agc_with_silence_detection, audio, repeat, **agc_kwargs)
+    smoothed_seconds = time_function(apply_agc_with_silence_detection, audio, repeat, smooth_gain=True,
+                                     **agc_kwargs)
+    reference_seconds = time_function(reference_agc, audio_segment, repeat, **agc_kwargs)
+
+    return {"audio_seconds": seconds,
+            "reference_ms": round(reference_seconds * 1000, 3),
+            "vectorized_ms": round(vectorized_seconds * 1000, 3),
+            "vectorized_smoothed_ms": round(smoothed_seconds * 1000, 3),
+            "speedup": round(reference_seconds / vectorized_seconds, 1),
+            "max_abs_difference": max_difference,
+            "threshold_flips": int(np.count_nonzero(~agreed)),
+            "tail_samples": int(vectorized.shape[0] - reference.shape[0])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vectorized AGC against the pydub implementation.')
+    parser.add_argument('--seconds', type=float, default=300, help='Length of the generated audio')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per implementation, the fastest is reported')
+    parser.add_argument('--tolerance', type=float, default=2e-3,
+                        help='Maximum allowed sample difference outside threshold flips')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    result = run_benchmark(args.seconds, args.repeat, seed=args.seed)
+    print(json.dumps(result, indent=2))
+
+    if result["max_abs_difference"] > args.tolerance:
+        raise SystemExit(f"Vectorized AGC differs from the reference by {result['max_abs_difference']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Concurrent load driver for the /transcribe endpoint.
+
+Posts synthetic calls from a pool of client threads and reports latency percentiles, throughput and the real
+time factor (audio seconds transcribed per wall clock second) as JSON.
+
+Against a running server:
+
+    python -m benchmarks.load_test --url http://localhost:9912 --requests 200 --concurrency 8
+
+Fully offline, the Flask app is imported in process with a stub model standing in for Whisper:
+
+    python -m benchmarks.load_test --in-process --requests 200 --concurrency 8 --stub-rtf 0.05
+"""
+import argparse
+import copy
+import io
+import json
+import math
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.synthetic import StubModel, encode_wav, generate_call
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    # Nearest rank percentile.
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def build_calls(count, seconds, seed=0):
+    """Builds count distinct calls, as (wav bytes, call JSON bytes, audio seconds) tuples."""
+    calls = []
+    for index in range(count):
+        audio, call_data = generate_call(seconds, seed=seed + index)
+        calls.append((encode_wav(audio), json.dumps(call_data).encode(), call_data["call_length"]))
+    return calls
+
+
+def load_in_process_app(model_path=None, stub_rtf=0.0, workers=1, batch_size=1, result_cache=False):
+    """
+    Imports app.py from a scratch working directory with a generated config, so nothing touches etc/ or log/.
+
+    Without model_path the model registry is pointed at a StubModel so no model is downloaded or loaded, with it
+    the model is loaded straight from that directory and never downloaded or refreshed.
+    """
+    from lib.config_handler import default_config, save_config_file
+    from lib.model_handler import LoadedModel, ModelRegistry, get_directory_size
+
+    work_path = tempfile.mkdtemp(prefix="icad_load_test_")
+    os.makedirs(os.path.join(work_path, "etc"))
+    os.makedirs(os.path.join(work_path, "log"))
+
+    config_data = copy.deepcopy(default_config)
+    config_data["log_level"] = 3
+    config_data["audio_upload"]["max_file_size"] = 64
+    config_data["whisper"].update({"device": "cpu", "compute_type": "int8", "model": "benchmark"})
+    config_data["model_pool"]["allowed_models"] = []
+    config_data["job_queue"].update({"workers": workers, "batch_size": batch_size, "max_queue_size": 1024})
+    config_data["result_cache"]["enabled"] = result_cache
+    save_config_file(os.path.join(work_path, "etc", "config.json"), config_data)
+
+    if model_path:
+        from faster_whisper import WhisperModel
+
+        def load_model(registry, model_key):
+            model = WhisperModel(model_path, device="cpu", compute_type="int8", cpu_threads=registry.cpu_threads,
+                                 num_workers=registry.num_workers)
+            return LoadedModel(model_key, model, get_directory_size(model_path), 0.0)
+    else:
+        stub_model = StubModel(seconds_per_audio_second=stub_rtf)
+
+        def load_model(registry, model_key):
+            return LoadedModel(model_key, stub_model, 0, 0.0)
+
+    ModelRegistry._load = load_model
+
+    os.chdir(work_path)
+    import app
+    return app.app
+
+
+def run_load_test(post_call, calls, request_count, concurrency):
+    latencies = []
+    status_counts = {}
+    audio_seconds = 0.0
+    lock = threading.Lock()
+
+    def send(index):
+        nonlocal audio_seconds
+        wav_bytes, call_bytes, call_seconds = calls[index % len(calls)]
+        request_start = time.perf_counter()
+        try:
+            status_code = post_call(wav_bytes, call_bytes)
+        except Exception as e:
+            status_code = f"error: {e.__class__.__name__}"
+        latency = time.perf_counter() - request_start
+        with lock:
+            status_counts[str(status_code)] = status_counts.get(str(status_code), 0) + 1
+            if status_code == 200:
+                latencies.append(latency)
+                audio_seconds += call_seconds
+
+    test_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(request_count)))
+    elapsed = time.perf_counter() - test_start
+
+    return {"requests": request_count,
+            "concurrency": concurrency,
+            "status_counts": status_counts,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "latency_ms": {"p50": round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+                           "p95": round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+                           "p99": round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+                           "mean": round(statistics.mean(latencies) * 1000, 1) if latencies else None,
+                           "max": round(max(latencies) * 1000, 1) if latencies else None},
+            "audio_seconds": round(audio_seconds, 2),
+            "real_time_factor": round(audio_seconds / elapsed, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the /transcribe endpoint with synthetic calls.')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='Base URL of a running server, e.g. http://localhost:9912')
+    target.add_argument('--in-process', action='store_true', help='Import the Flask app and call it directly')
+    parser.add_argument('--requests', type=int, default=100, help='Total number of requests')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of client threads')
+    parser.add_argument('--calls', type=int, default=16, help='Number of distinct synthetic calls to cycle through')
+    parser.add_argument('--seconds', type=float, default=20, help='Approximate length of each call')
+    parser.add_argument('--whisper-config', default=None, help='JSON whisper_config_data sent with each request')
+    parser.add_argument('--model', default=None, help='In process only, path of a CTranslate2 model to load')
+    parser.add_argument('--stub-rtf', type=float, default=0.0,
+                        help='In process only, stub model seconds of processing per second of audio')
+    parser.add_argument('--workers', type=int, default=1, help='In process only, inference workers')
+    parser.add_argument('--batch-size', type=int, default=1, help='In process only, job queue batch size')
+    parser.add_argument('--result-cache', action='store_true', help='In process only, enable the result cache')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Also write the JSON results to this file')
+    args = parser.parse_args()
+
+    calls = build_calls(args.calls, args.seconds, seed=args.seed)
+    form_data = {"whisper_config_data": args.whisper_config} if args.whisper_config else {}
+
+    if args.in_process:
+        flask_app = load_in_process_app(model_path=args.model, stub_rtf=args.stub_rtf, workers=args.workers,
+                                        batch_size=args.batch_size, result_cache=args.result_cache)
+
+        def post_call(wav_bytes, call_bytes):
+            data = {"audioFile": (io.BytesIO(wav_bytes), "call.wav"),
+                    "jsonFile": (io.BytesIO(call_bytes), "call.json"), **form_data}
+            with flask_app.test_client() as client:
+                return client.post("/transcribe", data=data, content_type="multipart/form-data").status_code
+    else:
+        import requests
+        sessions = threading.local()
+        url = args.url.rstrip("/") + "/transcribe"
+
+        def post_call(wav_bytes, call_bytes):
+            # One keep-alive session per client thread.
+            if not hasattr(sessions, "session"):
+                sessions.session = requests.Session()
+            files = {"audioFile": ("call.wav", wav_bytes, "audio/x-wav"),
+                     "jsonFile": ("call.json", call_bytes, "application/json")}
+            return sessions.session.post(url, files=files, data=form_data, timeout=600).status_code
+
+    results = {"target": args.url or "in-process",
+               "model": args.model or ("stub" if args.in_process else None),
+               "call_seconds": args.seconds,
+               **run_load_test(post_call, calls, args.requests, args.concurrency)}
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as of:
+            of.write(output)
+
+
+if __name__ == "__main__":
+    main()
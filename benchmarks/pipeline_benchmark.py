@@ -0,0 +1,128 @@
+"""
+Measures every stage of the transcription pipeline on its own against synthetic calls.
+
+Inference uses the stub model by default so the numbers cover only our own code, pass --model with the path of a
+converted CTranslate2 model (e.g. a local copy of tiny) to include a real model.
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline_benchmark --seconds 30 120 --repeat 5 --output pipeline.json
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import magic
+
+from benchmarks.synthetic import StubModel, encode_wav, generate_call
+from lib.address_handler import get_potential_addresses
+from lib.audio_handler import SAMPLE_RATE, load_audio
+from lib.json_handler import dumps, to_columnar_result
+from lib.replacement_handler import transcript_replacement
+from lib.tone_removal_handler import apply_agc_with_silence_detection, cut_tones_from_audio, trim_silence
+from lib.transcribe_handler import build_transcription_result, run_inference
+
+benchmark_replacements = [("Engine", "Engine"), ("Medic", "Medic"), ("copy", "Copy"), ("en route", "enroute"),
+                          ("Apartment", "Apt"), ("Route", "Rt"), ("Street", "St")]
+
+
+def write_replacements_file(directory):
+    replacements_file = "benchmark_replacements.csv"
+    with open(os.path.join(directory, replacements_file), "w", newline="") as rf:
+        writer = csv.writer(rf)
+        writer.writerow(["Word", "Replacement"])
+        writer.writerows(benchmark_replacements)
+    return replacements_file
+
+
+def time_stage(function, repeat):
+    """Runs function repeat times and returns the timings in milliseconds along with the last return value."""
+    timings = []
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"min_ms": round(min(timings), 3), "median_ms": round(statistics.median(timings), 3)}, value
+
+
+def run_benchmark(seconds, repeat, model, whisper_config_data, config_path, seed=0):
+    audio, call_data = generate_call(seconds, seed=seed)
+    wav_bytes = encode_wav(audio)
+    stages = {}
+
+    stages["mime_sniff"], _ = time_stage(lambda: magic.from_buffer(wav_bytes[:1024], mime=True), repeat)
+    stages["decode"], (audio, duration) = time_stage(lambda: load_audio(io.BytesIO(wav_bytes)), repeat)
+    stages["tone_cut"], _ = time_stage(lambda: cut_tones_from_audio(call_data["tones"], audio.copy()), repeat)
+    stages["agc"], _ = time_stage(lambda: apply_agc_with_silence_detection(audio, target_peak=-22,
+                                                                           clipping_threshold=-11,
+                                                                           silence_threshold=-40), repeat)
+    stages["silence_trim"], (trimmed_audio, _) = time_stage(lambda: trim_silence(audio), repeat)
+    stages["inference"], segments = time_stage(
+        lambda: list(run_inference(model, audio, whisper_config_data, None)), repeat)
+    stages["build_result"], (result, _) = time_stage(
+        lambda: build_transcription_result(segments, call_data, whisper_config_data, call_data["tones"],
+                                           config_path), repeat)
+
+    replacements_file_path = os.path.join(config_path, whisper_config_data["replacements_file"])
+    stages["replacement"], _ = time_stage(
+        lambda: transcript_replacement({"transcript": result["transcript"],
+                                        "segments": [dict(segment) for segment in result["segments"]]},
+                                       replacements_file_path), repeat)
+    stages["address_extraction"], _ = time_stage(lambda: get_potential_addresses(result["transcript"]), repeat)
+    stages["json_serialization"], _ = time_stage(lambda: json.dumps(result), repeat)
+    stages["json_serialization_fast"], _ = time_stage(lambda: dumps(result), repeat)
+    stages["json_serialization_columns"], _ = time_stage(lambda: dumps(to_columnar_result(result)), repeat)
+
+    # The serializations are alternatives, only the one /transcribe uses by default counts towards the total.
+    total_ms = sum(stage["median_ms"] for name, stage in stages.items()
+                   if name not in ("json_serialization", "json_serialization_columns"))
+    return {"audio_seconds": round(duration, 2),
+            "trimmed_audio_seconds": round(trimmed_audio.shape[0] / SAMPLE_RATE, 2),
+            "segments": len(result["segments"]),
+            "stages": stages,
+            "total_median_ms": round(total_ms, 3),
+            "real_time_factor": round(duration / (total_ms / 1000), 1) if total_ms else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the transcription pipeline.')
+    parser.add_argument('--seconds', type=float, nargs='+', default=[30, 120], help='Lengths of the synthetic calls')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per stage')
+    parser.add_argument('--model', default=None,
+                        help='Path of a CTranslate2 Whisper model to use instead of the stub model')
+    parser.add_argument('--compute-type', default='int8', help='Compute type for --model')
+    parser.add_argument('--word-timestamps', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Also write the JSON results to this file')
+    args = parser.parse_args()
+
+    if args.model:
+        from faster_whisper import WhisperModel
+        model = WhisperModel(args.model, device="cpu", compute_type=args.compute_type)
+    else:
+        model = StubModel()
+
+    with tempfile.TemporaryDirectory() as config_path:
+        whisper_config_data = {"language": "en", "beam_size": 5, "best_of": 5,
+                               "word_timestamps": args.word_timestamps,
+                               "replacements_file": write_replacements_file(config_path)}
+        results = {"model": args.model or "stub",
+                   "word_timestamps": args.word_timestamps,
+                   "runs": [run_benchmark(seconds, args.repeat, model, whisper_config_data, config_path,
+                                          seed=args.seed) for seconds in args.seconds]}
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as of:
+            of.write(output)
+
+
+if __name__ == "__main__":
+    main()
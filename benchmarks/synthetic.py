@@ -0,0 +1,145 @@
+"""
+Synthetic calls and a stub model for running the benchmarks offline.
+
+generate_call builds the audio and a trunk-recorder style call JSON together, transmissions of speech-like noise
+separated by dead air, some of them preceded by two tone or long tone bursts, with srcList and tones lining up
+with the audio.
+"""
+import io
+import time
+import wave
+from types import SimpleNamespace
+
+import numpy as np
+from faster_whisper.transcribe import Segment, TranscriptionInfo, Word
+
+from lib.audio_handler import SAMPLE_RATE
+
+radio_sentences = ["Engine 12 respond to 123 Main Street for a structure fire",
+                   "Medic 9 copy en route to 45 North Oak Avenue Apartment 3",
+                   "Command to Ladder 4 primary search complete",
+                   "Battalion Chief on scene at 77 Old Mill Lane in the Town of Bradford",
+                   "Water supply established on Route 6",
+                   "Rescue 2 standby at the intersection of Fifth Street and Second Street"]
+two_tone_pairs = [(721.4, 1119.7), (853.2, 1092.4), (584.8, 979.9)]
+
+
+def generate_speech(seconds, rng, sample_rate=SAMPLE_RATE):
+    """Noise shaped by a syllable rate envelope and a low pass, loud enough for the AGC to act on."""
+    sample_count = int(seconds * sample_rate)
+    noise = rng.standard_normal(sample_count).astype(np.float32)
+    # A short moving average pulls the energy down towards the voice band.
+    voiced = np.convolve(noise, np.ones(8, dtype=np.float32) / 8, mode="same")
+    syllables = np.abs(np.sin(np.linspace(0, np.pi * seconds * rng.uniform(3, 5), sample_count)))
+    level = 10 ** (rng.uniform(-30, -12) / 20)
+    return (voiced * syllables * level).astype(np.float32)
+
+
+def generate_tone(frequency, seconds, sample_rate=SAMPLE_RATE, level=0.3):
+    t = np.arange(int(seconds * sample_rate), dtype=np.float32) / sample_rate
+    return (level * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def generate_call(seconds, seed=0, sample_rate=SAMPLE_RATE, tone_probability=0.3, short_name="bench",
+                  talkgroup_decimal=100):
+    """
+    Builds a synthetic call.
+
+    :param seconds: Approximate length of the call.
+    :param seed: Seed for the random generator, the same seed always produces the same call.
+    :param sample_rate: Sample rate of the returned array.
+    :param tone_probability: Chance that a transmission is preceded by a tone burst.
+    :return: A tuple of the float32 sample array and the call JSON dict.
+    """
+    rng = np.random.default_rng(seed)
+    pieces = []
+    src_list = []
+    tones = {"two_tone": [], "long_tone": [], "hi_low_tone": []}
+    position = 0.0
+
+    def append(samples):
+        nonlocal position
+        pieces.append(samples)
+        position += samples.shape[0] / sample_rate
+
+    append(np.zeros(int(rng.uniform(0.2, 1.0) * sample_rate), dtype=np.float32))
+
+    while position < seconds:
+        if rng.random() < tone_probability:
+            tone_start = position
+            if rng.random() < 0.7:
+                first, second = two_tone_pairs[rng.integers(len(two_tone_pairs))]
+                append(generate_tone(first, 1.0, sample_rate))
+                append(generate_tone(second, 3.0, sample_rate))
+                tones["two_tone"].append({"tone_id": f"qc_{len(tones['two_tone']) + 1}",
+                                          "detected": [first, second],
+                                          "start": round(tone_start, 3), "end": round(position, 3)})
+            else:
+                append(generate_tone(1000.0, 2.0, sample_rate))
+                tones["long_tone"].append({"tone_id": f"lt_{len(tones['long_tone']) + 1}", "detected": 1000.0,
+                                           "start": round(tone_start, 3), "end": round(position, 3)})
+
+        unit = int(rng.integers(1000, 9999))
+        src_list.append({"src": unit, "time": 1715451604 + int(position), "pos": round(position, 3),
+                         "emergency": 0, "signal_system": "", "tag": f"Unit {unit}" if rng.random() < 0.5 else ""})
+        append(generate_speech(rng.uniform(1.5, 6.0), rng, sample_rate))
+        append(np.zeros(int(rng.uniform(0.3, 2.5) * sample_rate), dtype=np.float32))
+
+    audio = np.concatenate(pieces)
+    call_data = {"short_name": short_name, "talkgroup": talkgroup_decimal, "talkgroup_decimal": talkgroup_decimal,
+                 "call_length": round(audio.shape[0] / sample_rate, 3), "srcList": src_list, "tones": tones}
+    return audio, call_data
+
+
+def encode_wav(audio, sample_rate=SAMPLE_RATE):
+    """Encodes a float32 sample array as 16 bit mono WAV bytes."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((np.clip(audio, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+class StubModel:
+    """
+    Stands in for WhisperModel.transcribe so the pipeline around inference can be measured without a model.
+
+    Emits one segment every segment_seconds of audio, taking seconds_per_audio_second of wall time per second of
+    audio to mimic a model's real time factor.
+    """
+
+    def __init__(self, segment_seconds=3.0, seconds_per_audio_second=0.0):
+        self.segment_seconds = segment_seconds
+        self.seconds_per_audio_second = seconds_per_audio_second
+        # No audio fits the batched path's window, so every call goes through transcribe.
+        self.feature_extractor = SimpleNamespace(n_samples=0)
+
+    def transcribe(self, audio, word_timestamps=False, **kwargs):
+        duration = audio.shape[0] / SAMPLE_RATE
+
+        def generate_segments():
+            segment_start = 0.0
+            segment_id = 0
+            while segment_start < duration:
+                segment_end = min(duration, segment_start + self.segment_seconds)
+                if self.seconds_per_audio_second:
+                    time.sleep((segment_end - segment_start) * self.seconds_per_audio_second)
+                text = " " + radio_sentences[segment_id % len(radio_sentences)]
+                words = None
+                if word_timestamps:
+                    tokens = text.split()
+                    step = (segment_end - segment_start) / len(tokens)
+                    words = [Word(start=segment_start + index * step, end=segment_start + (index + 1) * step,
+                                  word=" " + token, probability=0.9) for index, token in enumerate(tokens)]
+                segment_id += 1
+                yield Segment(id=segment_id, seek=0, start=segment_start, end=segment_end, text=text, tokens=[],
+                              temperature=0.0, avg_logprob=-0.2, compression_ratio=1.2, no_speech_prob=0.01,
+                              words=words)
+                segment_start = segment_end
+
+        info = TranscriptionInfo(language="en", language_probability=1.0, duration=duration,
+                                 duration_after_vad=duration, all_language_probs=None, transcription_options=None,
+                                 vad_options=None)
+        return generate_segments(), info
@@ -0,0 +1,33 @@
+"""
+Gunicorn hooks, read automatically when gunicorn is started from this directory.
+
+With inference_server.enabled in etc/config.json the master starts one inference server process before the
+workers fork, it loads and warms up the models once and every worker sends its audio to it over a Unix socket.
+"""
+import os
+
+from lib.config_handler import load_config_file
+from lib.inference_handler import start_inference_server
+
+config_file_path = os.path.join(os.getcwd(), "etc", "config.json")
+inference_process = None
+
+
+def on_starting(server):
+    global inference_process
+    if not os.path.exists(config_file_path):
+        return
+
+    config_data = load_config_file(config_file_path) or {}
+    if not config_data.get("inference_server", {}).get("enabled", False):
+        return
+
+    inference_process = start_inference_server(config_file_path,
+                                               os.getenv("TRANSFORMERS_CACHE", os.path.join(os.getcwd(), "models")))
+    server.log.info(f"Inference server started in process {inference_process.pid}")
+
+
+def on_exit(server):
+    if inference_process is not None and inference_process.is_alive():
+        inference_process.terminate()
+        inference_process.join(10)
@@ -1,61 +1,142 @@
+import bisect
 import re
 
+valid_suffixes = {'Street', 'St', 'Road', 'Rd', 'Avenue', 'Ave', 'Boulevard', 'Blvd', 'Lane', 'Ln', 'Drive', 'Dr',
+                  'Terrace', 'Place', 'Court', 'Parkway', 'Circle', 'Trail', 'Way', 'Turnpike', 'Heights', 'Loop',
+                  'Path', 'Trace', 'Crossing', 'Cove', 'Bend', 'Landing', 'Pass', 'Ridge'}
 
-def build_address_regex(include_intersections: bool = True):
-    street_suffix = r"(Road|Street|Ave|Avenue|Boulevard|Drive|Lane|Terrace|Place|Court|Parkway|Circle|Trail|Way|Turnpike|Heights|Loop|Path|Trace|Crossing|Cove|Bend|Landing|Pass|Ridge)?"
-    ordinal = r"(1st|2nd|3rd|[0-9]+th|[0-9]+)"
-    spelled_out_ordinal = r"(First|Second|Third|[A-Z][a-z]*(th|st|nd|rd)|One Hundred and (First|Second|Third|[A-Z][a-z]*(th|st|nd|rd)))"
-    street_name = rf"((?:[A-Z][a-z.-]+(?:\s|$))+|(?:{ordinal})|(?:{spelled_out_ordinal})|(?:Route|Highway|Interstate|I|State Route|State Road|County Route|SR) [0-9]+)"
-    direction = r"(North|South|East|West)?"
-    street_number = r"([0-9]+(?:-[0-9]+)*)"
+
+def build_address_regex(include_intersections: bool = True, intersection_street_runs: bool = True):
+    """
+    :param include_intersections: Also match intersections like "Fifth Street and Second Street".
+    :param intersection_street_runs: Allow a run of capitalized words as the street names of an intersection. Such
+        a run ends in whitespace and is followed by a literal space, so it only ever matches where whitespace is
+        followed by a space. Leaving it out matches the same on text without that, and keeps the engine from
+        rescanning the rest of a long capitalized run from every word in it.
+    """
+    street_suffix = r"(?:Road|Street|Ave|Avenue|Boulevard|Drive|Lane|Terrace|Place|Court|Parkway|Circle|Trail|Way|Turnpike|Heights|Loop|Path|Trace|Crossing|Cove|Bend|Landing|Pass|Ridge)?"
+    ordinal = r"(?:1st|2nd|3rd|[0-9]+th|[0-9]+)"
+    spelled_out_ordinal = r"(?:First|Second|Third|[A-Z][a-z]*(?:th|st|nd|rd)|One Hundred and (?:First|Second|Third|[A-Z][a-z]*(?:th|st|nd|rd)))"
+    numbered_route = r"(?:Route|Highway|Interstate|I|State Route|State Road|County Route|SR) [0-9]+"
+    street_name = rf"(?:(?:[A-Z][a-z.-]+(?:\s|$))+|(?:{ordinal})|(?:{spelled_out_ordinal})|{numbered_route})"
+    intersection_street_name = street_name if intersection_street_runs else \
+        rf"(?:(?:{ordinal})|(?:{spelled_out_ordinal})|{numbered_route})"
+    direction = r"(?:North|South|East|West)?"
+    street_number = r"(?:[0-9]+(?:-[0-9]+)*)"
     unit = r"(?:Apartment|Unit|Suite|Apartment Number)? ?(?:#? ?[0-9A-Z]+)?"
     intersection_phrases = r"(?:cross street of|cross streets|in the intersection near|at the intersection of|between|and)"
-    intersection = rf"({street_name} {street_suffix}? {intersection_phrases} {street_name} {street_suffix}?)"
+    intersection = rf"(?:{intersection_street_name} {street_suffix}? {intersection_phrases} {intersection_street_name} {street_suffix}?)"
     address = rf"{street_number} {direction} ?{street_name} ?{street_suffix} ?{unit}"
-    regex = rf"({intersection}|{address})" if include_intersections else rf"({address})"
+    regex = rf"(?:{intersection}|{address})" if include_intersections else rf"(?:{address})"
     return regex
 
 
-def extract_town(text):
-    pattern = r'''
+# Transcripts are single spaced once double spaces are replaced, so intersections are matched without the
+# capitalized runs, see build_address_regex.
+address_regex = re.compile(build_address_regex(intersection_street_runs=False))
+
+town_regex = re.compile(r'''
             \b
             (
-                (?:[Tt]own\s[oO]f|[Vv]illage\s[oO]f|[Cc]ity\s[oO]f)\s([A-Z][A-Za-z\s-]+)|  # Town of/Village of/City of ... (name follows, capitalized)
-                ([A-Z][A-Za-z\s-]+)(?:[Tt]ownship|[Bb]orough|[Bb]oro|[Cc]ity)  # ... Township/Borough/Boro/City (name precedes, capitalized)
+                (?:[Tt]own\s[oO]f|[Vv]illage\s[oO]f|[Cc]ity\s[oO]f)\s([A-Z][A-Za-z\s-]+)  # Town of/Village of/City of ... (name follows, capitalized)
             )
             |
-            \b(?:in|near|outside of)\s([A-Z][A-Za-z\s-]+?)(?:,|\.|\b)  # Standalone town name in a specific context (e.g., "in Centerville", requires capitalization)
+            \b(?:in|near|outside\ of)\s([A-Z][A-Za-z\s-]+?)(?:,|\.|\b)  # Standalone town name in a specific context (e.g., "in Centerville", requires capitalization)
             \b
-            '''
-    matches = re.findall(pattern, text, re.VERBOSE)
+            ''', re.VERBOSE)
+
+# Names before Township/Borough/Boro/City are found by find_suffixed_towns rather than a "[A-Z][A-Za-z\s-]+"
+# pattern, which runs to the end of the letters and spaces and backtracks to the last suffix from every capital
+# letter in them, quadratic on long transcripts.
+town_name_run_regex = re.compile(r'[A-Za-z\s-]+')
+town_name_start_regex = re.compile(r'\b[A-Z]')
+town_suffix_regex = re.compile(r'[Tt]ownship|[Bb]orough|[Bb]oro|[Cc]ity')
+town_suffix_start_regex = re.compile(r'(?=[Tt]ownship|[Bb]orough|[Bb]oro|[Cc]ity)')
+
+whitespace_regex = re.compile(r'\s+')
+
+
+def find_suffixed_towns(text):
+    """
+    Indexes the "<Name> Township/Borough/Boro/City" towns of text. A name starting at a capital letter runs to the
+    last suffix of its run of letters and spaces, when that suffix is at least two characters after it.
+
+    :param text: The transcript.
+    :return: A function that takes a position and returns (start, end) of the first such town starting at or after
+        it, or None.
+    """
+    run_starts = []
+    run_ends = []
+    last_suffix_starts = []
+    for run in town_name_run_regex.finditer(text):
+        run_starts.append(run.start())
+        run_ends.append(run.end())
+        last_suffix_starts.append(None)
+
+    for suffix in town_suffix_start_regex.finditer(text):
+        last_suffix_starts[bisect.bisect_right(run_starts, suffix.start()) - 1] = suffix.start()
 
+    name_starts = [name_start.start() for name_start in town_name_start_regex.finditer(text)]
+
+    def next_town(position):
+        index = bisect.bisect_left(name_starts, position)
+        while index < len(name_starts):
+            start = name_starts[index]
+            run_index = bisect.bisect_right(run_starts, start) - 1
+            suffix_start = last_suffix_starts[run_index]
+            if suffix_start is not None and suffix_start >= start + 2:
+                return start, town_suffix_regex.match(text, suffix_start).end()
+            # Later names in the same run are even closer to its last suffix, skip to the next run.
+            index = bisect.bisect_left(name_starts, run_ends[run_index])
+        return None
+
+    return next_town
+
+
+def find_towns(text):
+    """Yields the town names of text in order, at the same position "Town of" beats a suffix beats "in"/"near"."""
+    next_suffixed_town = find_suffixed_towns(text)
+    position = 0
+    match = None
+    suffixed_town = None
+    while True:
+        # Both lookups only move forward, a result still ahead of the position is reused.
+        if match is None or match.start() < position:
+            match = town_regex.search(text, position)
+        if suffixed_town is None or suffixed_town[0] < position:
+            suffixed_town = next_suffixed_town(position)
+
+        if suffixed_town and (not match or suffixed_town[0] < match.start() or
+                              (suffixed_town[0] == match.start() and not match.group(1))):
+            yield text[suffixed_town[0]:suffixed_town[1]]
+            position = suffixed_town[1]
+        elif match:
+            yield match.group(1) or match.group(3)
+            position = match.end()
+        else:
+            return
+
+
+def extract_town(text):
     cleaned_towns = []
-    for match in matches:
-        for town in match:
-            if town:  # Check if the capturing group captured anything
-                town = re.sub(r'\s+', ' ', town.strip())  # Clean up the town name
-                if town not in cleaned_towns:
-                    cleaned_towns.append(town)
-                break  # Break after the first non-empty match to avoid duplicates from the same tuple
+    for town in find_towns(text):
+        town = whitespace_regex.sub(' ', town.strip())  # Clean up the town name
+        if town not in cleaned_towns:
+            cleaned_towns.append(town)
 
     return cleaned_towns
 
 
 def get_potential_addresses(transcript):
     transcript = transcript.replace(",", "").replace("  ", " ")
-    address_regex = re.compile(build_address_regex())
     addresses = address_regex.findall(transcript)
 
     towns = extract_town(transcript)
     # Assuming extract_town returns a list of towns or an empty list if no towns are found
 
-    valid_suffixes = {'Street', 'St', 'Road', 'Rd', 'Avenue', 'Ave', 'Boulevard', 'Blvd', 'Lane', 'Ln', 'Drive', 'Dr',
-                      'Terrace', 'Place', 'Court', 'Parkway', 'Circle', 'Trail', 'Way', 'Turnpike', 'Heights', 'Loop',
-                      'Path', 'Trace', 'Crossing', 'Cove', 'Bend', 'Landing', 'Pass', 'Ridge'}
-
     cleaned_addresses = []
     for address in addresses:
-        address_text = address[0].strip().replace("-", "")
+        address_text = address.strip().replace("-", "")
         if len(address_text) > 5 and (address_text.split()[-1] in valid_suffixes or address_text.split()[-1].isdigit()):
             full_address = address_text
             if towns:  # If a town is extracted, append it to the address
@@ -0,0 +1,160 @@
+import logging
+import os
+import tarfile
+import tempfile
+import zipfile
+
+module_logger = logging.getLogger('icad_transcribe.archive')
+
+audio_extensions = (".wav", ".mp3", ".m4a")
+
+
+class MemberTooLarge(ValueError):
+    """Raised when an archive member is larger than the size allowed for one call."""
+
+    def __init__(self, name, max_size):
+        super().__init__(f"{name} is larger than the {max_size} byte limit")
+        self.name = name
+        self.max_size = max_size
+
+
+def is_ignored_file(path):
+    # Directory entries, dot files and the resource forks macOS adds to zip files.
+    file_name = os.path.basename(path)
+    return not file_name or file_name.startswith(".") or "__MACOSX/" in path
+
+
+def pair_call_files(paths):
+    """
+    Matches audio files with the call JSON that has the same path minus the extension, the way trunk-recorder
+    writes them, e.g. 100-1711131089_155250000.0-call_20424.wav and 100-1711131089_155250000.0-call_20424.json.
+
+    :param paths: Iterable of file paths or archive member names.
+    :return: A list of (audio_path, json_path or None) tuples sorted by audio path.
+    """
+    audio_paths = {}
+    json_paths = {}
+    for path in paths:
+        if is_ignored_file(path):
+            continue
+        stem, extension = os.path.splitext(path)
+        extension = extension.lower()
+        if extension in audio_extensions:
+            audio_paths[stem] = path
+        elif extension == ".json":
+            json_paths[stem] = path
+
+    return [(audio_paths[stem], json_paths.get(stem)) for stem in sorted(audio_paths)]
+
+
+def read_limited(member_file, name, max_size=None, chunk_size=1024 * 1024):
+    """
+    Yields the chunks of an archive member, raising MemberTooLarge as soon as more than max_size bytes were read.
+    The size an archive declares for a member can be forged, so the bytes actually read are what is counted.
+    """
+    read_size = 0
+    while True:
+        chunk = member_file.read(chunk_size)
+        if not chunk:
+            return
+        read_size += len(chunk)
+        if max_size is not None and read_size > max_size:
+            raise MemberTooLarge(name, max_size)
+        yield chunk
+
+
+def spool_member(member_file, name, spool_path=None, max_size=None):
+    """Copies an archive member into a named temporary file, rewound and ready to decode."""
+    spooled_file = tempfile.NamedTemporaryFile("wb+", dir=spool_path, prefix="icad_upload_")
+    try:
+        for chunk in read_limited(member_file, name, max_size):
+            spooled_file.write(chunk)
+        spooled_file.seek(0)
+    except Exception:
+        spooled_file.close()
+        raise
+    return spooled_file
+
+
+class CallArchive:
+    """
+    Reads audio and call JSON pairs from a tar (optionally compressed) or zip archive.
+
+    Members are only read when asked for, audio members are extracted into their own temporary file by open_audio
+    so they can be decoded in parallel. Members are read through one shared file handle, so read_json and
+    open_audio must only be called from one thread at a time.
+    """
+
+    def __init__(self, archive_file, spool_path=None, max_member_size=None, max_total_size=None):
+        """
+        :param archive_file: Seekable file-like object holding the archive.
+        :param spool_path: Directory for the extracted audio, None uses the system temp directory.
+        :param max_member_size: Largest member in bytes that is extracted, None for no limit.
+        :param max_total_size: Total bytes extracted from the archive before every further member is rejected, so
+            a small compressed archive can't fill the disk. None for no limit.
+        """
+        self.spool_path = spool_path
+        self.max_member_size = max_member_size
+        self.max_total_size = max_total_size
+        self.extracted_size = 0
+        self._zip = None
+        self._tar = None
+
+        archive_file.seek(0)
+        if zipfile.is_zipfile(archive_file):
+            archive_file.seek(0)
+            self._zip = zipfile.ZipFile(archive_file)
+            names = [info.filename for info in self._zip.infolist() if not info.is_dir()]
+        else:
+            archive_file.seek(0)
+            try:
+                self._tar = tarfile.open(fileobj=archive_file, mode="r:*")
+            except tarfile.TarError:
+                raise ValueError("Archive must be a zip or tar file")
+            self._members = {member.name: member for member in self._tar.getmembers() if member.isfile()}
+            names = list(self._members)
+
+        self.calls = pair_call_files(names)
+
+    def _get_member_size(self, name):
+        if self._zip:
+            return self._zip.getinfo(name).file_size
+        return self._members[name].size
+
+    def _get_budget(self, name):
+        """Returns the bytes name may extract to, rejecting it up front when its declared size is already over."""
+        budget = self.max_member_size
+        if self.max_total_size is not None:
+            remaining = max(0, self.max_total_size - self.extracted_size)
+            budget = remaining if budget is None else min(budget, remaining)
+        if budget is not None and self._get_member_size(name) > budget:
+            raise MemberTooLarge(name, budget)
+        return budget
+
+    def _open_member(self, name):
+        if self._zip:
+            return self._zip.open(name)
+        return self._tar.extractfile(self._members[name])
+
+    def read_json(self, name):
+        if name is None:
+            return None
+        budget = self._get_budget(name)
+        with self._open_member(name) as member_file:
+            json_bytes = b"".join(read_limited(member_file, name, budget))
+        self.extracted_size += len(json_bytes)
+        return json_bytes
+
+    def open_audio(self, name):
+        """Extracts an audio member into a named temporary file, the caller closes it when done."""
+        budget = self._get_budget(name)
+        with self._open_member(name) as member_file:
+            spooled_file = spool_member(member_file, name, self.spool_path, budget)
+        self.extracted_size += os.fstat(spooled_file.fileno()).st_size
+        return spooled_file
+
+    def close(self):
+        if self._zip:
+            self._zip.close()
+        if self._tar:
+            self._tar.close()
@@ -0,0 +1,316 @@
+import logging
+import os
+import struct
+
+import av
+import numpy as np
+
+module_logger = logging.getLogger('icad_transcribe.audio')
+
+# Whisper models expect 16 kHz mono input, so everything downstream of the upload works on this rate.
+SAMPLE_RATE = 16000
+
+# Decoded frames are resampled in groups of this many samples, same as faster-whisper.
+decode_group_samples = 500000
+
+
+def get_upload_path(audio_file):
+    """Returns the path of the file backing an upload if it has been spooled to disk, None otherwise."""
+    stream = getattr(audio_file, "stream", audio_file)
+    path = getattr(stream, "name", None)
+    if isinstance(path, str) and os.path.isfile(path):
+        if hasattr(stream, "flush"):
+            stream.flush()
+        return path
+    return None
+
+
+def get_pcm_size(duration, sampling_rate=SAMPLE_RATE):
+    """Bytes of float32 samples needed to hold duration seconds of decoded audio."""
+    return int(duration * sampling_rate) * 4
+
+
+def decode_audio_file(input_file, sampling_rate=SAMPLE_RATE, expected_duration=None):
+    """
+    Decodes and resamples audio straight into one float32 array.
+
+    Produces the same samples as faster_whisper.audio.decode_audio, which collects int16 chunks in a BytesIO and
+    then makes two float32 copies of it, but only ever holds the output array plus one chunk of frames. With an
+    expected_duration the output is allocated once at the right size.
+
+    :param input_file: Path to the input file or a file-like object.
+    :param sampling_rate: Resample the audio to this sample rate.
+    :param expected_duration: Duration in seconds read from the container headers, if known.
+    :return: A float32 NumPy array.
+    """
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=sampling_rate)
+    # A little headroom so resampler rounding and encoder padding do not force a reallocation.
+    capacity = int((expected_duration or 60) * sampling_rate * 1.01) + sampling_rate
+    audio = np.empty(capacity, dtype=np.float32)
+    length = 0
+    scale = np.float32(32768.0)
+
+    def write(frame):
+        nonlocal audio, length
+        samples = frame.to_ndarray().reshape(-1)
+        if length + samples.shape[0] > audio.shape[0]:
+            grown = np.empty(max(length + samples.shape[0], int(audio.shape[0] * 1.5)), dtype=np.float32)
+            grown[:length] = audio[:length]
+            audio = grown
+        np.divide(samples, scale, out=audio[length:length + samples.shape[0]], dtype=np.float32)
+        length += samples.shape[0]
+
+    with av.open(input_file, mode="r", metadata_errors="ignore") as container:
+        fifo = av.audio.fifo.AudioFifo()
+        frames = container.decode(audio=0)
+        while True:
+            try:
+                frame = next(frames)
+            except StopIteration:
+                break
+            except av.error.InvalidDataError:
+                continue
+
+            # Group frames before resampling, resampling many tiny frames one at a time is slow.
+            frame.pts = None
+            fifo.write(frame)
+            if fifo.samples >= decode_group_samples:
+                for resampled_frame in resampler.resample(fifo.read()):
+                    write(resampled_frame)
+
+        if fifo.samples > 0:
+            for resampled_frame in resampler.resample(fifo.read()):
+                write(resampled_frame)
+        for resampled_frame in resampler.resample(None):
+            write(resampled_frame)
+
+    return audio[:length]
+
+
+def load_audio(audio_file, sampling_rate=SAMPLE_RATE, expected_duration=None):
+    """
+    Decodes an uploaded audio file exactly once into a mono float32 NumPy array.
+
+    The returned array is shared by validation, tone cutting, AGC and inference so the upload never goes
+    through ffmpeg more than once per request. Uploads that were spooled to disk are handed to the decoder by
+    path so ffmpeg reads the file itself instead of pulling it through Python.
+
+    :param audio_file: A file-like object (or path) containing the encoded audio.
+    :param sampling_rate: The sample rate to resample the audio to.
+    :param expected_duration: Duration in seconds read from the container headers, used to size the output.
+    :return: A tuple of the float32 sample array in the range [-1.0, 1.0] and its duration in seconds.
+    """
+    if hasattr(audio_file, 'seek'):
+        audio_file.seek(0)
+
+    audio = decode_audio_file(get_upload_path(audio_file) or audio_file, sampling_rate=sampling_rate,
+                              expected_duration=expected_duration)
+    duration = audio.shape[0] / sampling_rate
+
+    module_logger.debug(f"Decoded audio: {audio.shape[0]} samples, {round(duration, 2)} seconds")
+
+    return audio, duration
+
+
+# MPEG audio header tables, indexed by the bit fields of the frame header.
+mpeg_versions = {0: 2.5, 2: 2, 3: 1}
+mpeg_layers = {1: 3, 2: 2, 3: 1}
+mpeg_sample_rates = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
+mpeg_bitrates = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+# How far into an MP3 we look for the first frame, past padding or junk after the ID3 tag.
+mp3_sync_search_bytes = 64 * 1024
+
+
+def get_file_size(audio_file):
+    audio_file.seek(0, 2)
+    file_size = audio_file.tell()
+    audio_file.seek(0)
+    return file_size
+
+
+def get_wav_duration(audio_file, file_size):
+    header = audio_file.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+
+    byte_rate = None
+    position = 12
+    while position + 8 <= file_size:
+        audio_file.seek(position)
+        chunk_id, chunk_size = struct.unpack("<4sI", audio_file.read(8))
+        if chunk_id == b"fmt ":
+            fmt = audio_file.read(16)
+            if len(fmt) < 16:
+                return None
+            byte_rate = struct.unpack("<I", fmt[8:12])[0]
+        elif chunk_id == b"data":
+            if not byte_rate:
+                return None
+            # Recorders that stream WAV write 0 or 0xFFFFFFFF and never patch the size, use what is really there.
+            available = file_size - position - 8
+            data_size = available if chunk_size in (0, 0xFFFFFFFF) else min(chunk_size, available)
+            return data_size / byte_rate
+        # Chunks are word aligned.
+        position += 8 + chunk_size + (chunk_size & 1)
+
+    return None
+
+
+def parse_mpeg_frame_header(header):
+    """Returns (version, layer, bitrate_kbps, sample_rate, frame_length, channel_mode) or None if not a frame."""
+    if len(header) < 4 or header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+        return None
+
+    version = mpeg_versions.get((header[1] >> 3) & 0x03)
+    layer = mpeg_layers.get((header[1] >> 1) & 0x03)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = mpeg_bitrates[(1 if version == 1 else 2, layer)][bitrate_index]
+    sample_rate = mpeg_sample_rates[version][sample_rate_index]
+    padding = (header[2] >> 1) & 0x01
+    channel_mode = header[3] >> 6
+
+    if layer == 1:
+        frame_length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+    elif layer == 3 and version != 1:
+        frame_length = 72 * bitrate * 1000 // sample_rate + padding
+    else:
+        frame_length = 144 * bitrate * 1000 // sample_rate + padding
+
+    return version, layer, bitrate, sample_rate, frame_length, channel_mode
+
+
+def get_mp3_duration(audio_file, file_size):
+    audio_start = 0
+    header = audio_file.read(10)
+    if header[:3] == b"ID3" and len(header) == 10:
+        # Syncsafe size, plus the optional footer.
+        tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+        audio_start = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+
+    audio_file.seek(audio_start)
+    search = audio_file.read(mp3_sync_search_bytes)
+
+    offset = search.find(b"\xff")
+    while offset != -1:
+        frame = parse_mpeg_frame_header(search[offset:offset + 4])
+        if frame:
+            # Only accept a sync when the next frame header follows where this one says it ends.
+            next_offset = offset + frame[4]
+            next_frame = parse_mpeg_frame_header(search[next_offset:next_offset + 4])
+            if next_frame or next_offset >= len(search):
+                break
+        offset = search.find(b"\xff", offset + 1)
+    else:
+        return None
+
+    version, layer, bitrate, sample_rate, frame_length, channel_mode = frame
+    samples_per_frame = 384 if layer == 1 else (576 if layer == 3 and version != 1 else 1152)
+
+    # Xing / Info tag, written by LAME and most encoders in the first frame of a VBR file.
+    if version == 1:
+        side_info_length = 17 if channel_mode == 3 else 32
+    else:
+        side_info_length = 9 if channel_mode == 3 else 17
+    xing_offset = offset + 4 + side_info_length
+    if search[xing_offset:xing_offset + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", search[xing_offset + 4:xing_offset + 8])[0]
+        if flags & 0x01:
+            frame_count = struct.unpack(">I", search[xing_offset + 8:xing_offset + 12])[0]
+            return frame_count * samples_per_frame / sample_rate
+
+    # VBRI tag, written by the Fraunhofer encoder, always 32 bytes after the frame header.
+    vbri_offset = offset + 4 + 32
+    if search[vbri_offset:vbri_offset + 4] == b"VBRI":
+        frame_count = struct.unpack(">I", search[vbri_offset + 14:vbri_offset + 18])[0]
+        return frame_count * samples_per_frame / sample_rate
+
+    # No tag, treat it as constant bitrate.
+    audio_size = file_size - audio_start - offset
+    audio_file.seek(max(0, file_size - 128))
+    if audio_file.read(3) == b"TAG":
+        audio_size -= 128
+    return audio_size * 8 / (bitrate * 1000)
+
+
+def get_mp4_duration(audio_file, file_size):
+    def find_atom(start, end, atom_type):
+        position = start
+        while position + 8 <= end:
+            audio_file.seek(position)
+            atom_size, found_type = struct.unpack(">I4s", audio_file.read(8))
+            header_size = 8
+            if atom_size == 1:
+                atom_size = struct.unpack(">Q", audio_file.read(8))[0]
+                header_size = 16
+            elif atom_size == 0:
+                atom_size = end - position
+            if atom_size < header_size:
+                return None
+            if found_type == atom_type:
+                return position + header_size, position + atom_size
+            position += atom_size
+        return None
+
+    # moov may come after mdat, atoms are skipped by size so mdat itself is never read.
+    moov = find_atom(0, file_size, b"moov")
+    if not moov:
+        return None
+    mvhd = find_atom(moov[0], moov[1], b"mvhd")
+    if not mvhd:
+        return None
+
+    audio_file.seek(mvhd[0])
+    version = audio_file.read(4)[0]
+    if version == 1:
+        audio_file.seek(16, 1)
+        timescale, duration = struct.unpack(">IQ", audio_file.read(12))
+    else:
+        audio_file.seek(8, 1)
+        timescale, duration = struct.unpack(">II", audio_file.read(8))
+
+    if not timescale:
+        return None
+    return duration / timescale
+
+
+def get_audio_duration(audio_file):
+    """
+    Reads the duration of a WAV, MP3 or M4A upload from its container headers without decoding it.
+
+    Only a few header bytes are read, the file is left rewound to the start.
+
+    :param audio_file: A seekable file-like object containing the encoded audio.
+    :return: The duration in seconds, or None if the format is not recognised or the headers can not be trusted.
+    """
+    try:
+        file_size = get_file_size(audio_file)
+        magic_bytes = audio_file.read(12)
+        audio_file.seek(0)
+
+        if magic_bytes[:4] == b"RIFF":
+            duration = get_wav_duration(audio_file, file_size)
+        elif magic_bytes[4:8] == b"ftyp":
+            duration = get_mp4_duration(audio_file, file_size)
+        elif magic_bytes[:3] == b"ID3" or (magic_bytes[:1] == b"\xff" and (magic_bytes[1] & 0xE0) == 0xE0):
+            duration = get_mp3_duration(audio_file, file_size)
+        else:
+            duration = None
+    except (struct.error, IndexError, OSError, ValueError) as e:
+        module_logger.debug(f"Unable to read audio duration from headers: {e}")
+        duration = None
+    finally:
+        audio_file.seek(0)
+
+    return duration
@@ -0,0 +1,207 @@
+import json
+import logging
+
+import numpy as np
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.transcribe import Segment, get_ctranslate2_storage, get_compression_ratio, \
+    get_suppressed_tokens, restore_speech_timestamps
+from faster_whisper.vad import VadOptions, get_speech_timestamps, collect_chunks
+
+module_logger = logging.getLogger('icad_transcribe.batch')
+
+# Decode options that must match for two requests to share an encoder and generate pass.
+batch_option_keys = ("language", "beam_size", "word_timestamps", "hotwords", "vad_filter", "vad_parameters")
+
+# Fallback thresholds, these mirror the faster-whisper transcribe() defaults.
+compression_ratio_threshold = 2.4
+log_prob_threshold = -1.0
+no_speech_threshold = 0.6
+max_initial_timestamp = 1.0
+
+
+def get_batch_key(whisper_config_data):
+    """Returns a hashable key made from the decode options that have to match inside one batch."""
+    return tuple(json.dumps(whisper_config_data.get(key), sort_keys=True) for key in batch_option_keys)
+
+
+def can_batch(model, audio, whisper_config_data):
+    """
+    Checks if a request can go through the batched path.
+
+    Only calls that fit in a single 30 second window, with a fixed language and without word timestamps, are
+    batched. Everything else is transcribed on its own with model.transcribe.
+    """
+    if whisper_config_data.get("word_timestamps", False):
+        return False
+
+    if not whisper_config_data.get("language", "en"):
+        return False
+
+    return audio.shape[0] <= model.feature_extractor.n_samples
+
+
+def _apply_vad(audio, whisper_config_data, default_vad_parameters):
+    if not whisper_config_data.get("vad_filter", False):
+        return audio, None
+
+    vad_parameters = whisper_config_data.get("vad_parameters", default_vad_parameters)
+    speech_chunks = get_speech_timestamps(audio, VadOptions(**vad_parameters))
+    return collect_chunks(audio, speech_chunks), speech_chunks
+
+
+def _split_segments(model, tokenizer, tokens, segment_size):
+    """
+    Splits generated tokens into timestamped segments the same way WhisperModel.generate_segments does for
+    the first window. Returns None when the model stopped mid window and the rest needs another window.
+    """
+    timestamp_begin = tokenizer.timestamp_begin
+    segments = []
+
+    single_timestamp_ending = len(tokens) >= 2 and tokens[-2] < timestamp_begin <= tokens[-1]
+
+    consecutive_timestamps = [i for i in range(1, len(tokens))
+                              if tokens[i] >= timestamp_begin and tokens[i - 1] >= timestamp_begin]
+
+    if consecutive_timestamps:
+        slices = list(consecutive_timestamps)
+        if single_timestamp_ending:
+            slices.append(len(tokens))
+
+        last_slice = 0
+        for current_slice in slices:
+            sliced_tokens = tokens[last_slice:current_slice]
+            segments.append({
+                "start": (sliced_tokens[0] - timestamp_begin) * model.time_precision,
+                "end": (sliced_tokens[-1] - timestamp_begin) * model.time_precision,
+                "tokens": sliced_tokens
+            })
+            last_slice = current_slice
+
+        if not single_timestamp_ending:
+            last_timestamp_position = tokens[last_slice - 1] - timestamp_begin
+            if last_timestamp_position * model.input_stride < segment_size:
+                return None
+    else:
+        duration = segment_size * model.feature_extractor.time_per_frame
+        timestamps = [token for token in tokens if token >= timestamp_begin]
+        if timestamps and timestamps[-1] != timestamp_begin:
+            duration = (timestamps[-1] - timestamp_begin) * model.time_precision
+
+        segments.append({"start": 0.0, "end": duration, "tokens": tokens})
+
+    return segments
+
+
+def transcribe_batch(model, audio_list, whisper_config_data, initial_prompts, default_vad_parameters=None):
+    """
+    Transcribes several short calls that share decode options with one batched encoder and generate pass.
+
+    Calls whose batched result would have triggered faster-whisper's temperature fallback, or that did not
+    finish inside the window, are re-run on their own with model.transcribe so output quality is unchanged.
+
+    :param model: The WhisperModel instance to use.
+    :param audio_list: List of float32 sample arrays, each no longer than one 30 second window.
+    :param whisper_config_data: The decode options shared by every call in the batch.
+    :param initial_prompts: List of initial prompt strings (or None) matching audio_list.
+    :param default_vad_parameters: VAD parameters used when the config has vad_filter without parameters.
+    :return: List of segment lists, one per input, in the same order as audio_list.
+    """
+    feature_extractor = model.feature_extractor
+    nb_max_frames = feature_extractor.nb_max_frames
+
+    tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe",
+                          language=whisper_config_data.get("language", "en"))
+    hotwords = whisper_config_data.get("hotwords", None)
+    beam_size = whisper_config_data.get("beam_size", 5)
+
+    features = []
+    prompts = []
+    segment_sizes = []
+    speech_chunk_list = []
+    for audio, initial_prompt in zip(audio_list, initial_prompts):
+        audio, speech_chunks = _apply_vad(audio, whisper_config_data, default_vad_parameters)
+        speech_chunk_list.append(speech_chunks)
+
+        mel = feature_extractor(audio)
+        segment_size = min(nb_max_frames, mel.shape[-1] - nb_max_frames)
+        segment_sizes.append(segment_size)
+        features.append(pad_or_trim(mel[:, :segment_size], nb_max_frames))
+
+        previous_tokens = tokenizer.encode(" " + initial_prompt.strip()) if initial_prompt else []
+        prompts.append(model.get_prompt(tokenizer, previous_tokens, hotwords=hotwords))
+
+    # CTranslate2 needs <|startoftranscript|> at the same position for every prompt in a generate call, so
+    # calls with different prompt lengths run as separate sub batches.
+    sub_batches = {}
+    for index, prompt in enumerate(prompts):
+        sub_batches.setdefault(prompt.index(tokenizer.sot), []).append(index)
+
+    results = [None] * len(prompts)
+    for indexes in sub_batches.values():
+        encoder_output = model.model.encode(get_ctranslate2_storage(np.stack([features[i] for i in indexes])),
+                                            to_cpu=False)
+        sub_results = model.model.generate(encoder_output, [prompts[i] for i in indexes],
+                                           beam_size=beam_size,
+                                           max_length=model.max_length,
+                                           return_scores=True,
+                                           return_no_speech_prob=True,
+                                           suppress_blank=True,
+                                           suppress_tokens=get_suppressed_tokens(tokenizer, [-1]),
+                                           max_initial_timestamp_index=int(
+                                               round(max_initial_timestamp / model.time_precision)))
+        for index, result in zip(indexes, sub_results):
+            results[index] = result
+
+    all_segments = []
+    fallback_count = 0
+    for index, result in enumerate(results):
+        tokens = result.sequences_ids[0]
+        avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+        compression_ratio = get_compression_ratio(tokenizer.decode(tokens).strip())
+
+        # Same check as faster-whisper's generate_segments, a logprob exactly at the threshold still skips.
+        is_silent = result.no_speech_prob > no_speech_threshold and not avg_logprob > log_prob_threshold
+        if is_silent or segment_sizes[index] <= 0:
+            all_segments.append([])
+            continue
+
+        split_segments = None
+        if compression_ratio <= compression_ratio_threshold and avg_logprob >= log_prob_threshold:
+            split_segments = _split_segments(model, tokenizer, tokens, segment_sizes[index])
+
+        if split_segments is None:
+            # Needs temperature fallback or another window, let faster-whisper handle this one on its own.
+            fallback_count += 1
+            segments, _ = model.transcribe(audio_list[index],
+                                           beam_size=beam_size,
+                                           best_of=whisper_config_data.get("best_of", 5),
+                                           language=whisper_config_data.get("language", "en"),
+                                           initial_prompt=initial_prompts[index] or None,
+                                           vad_filter=whisper_config_data.get("vad_filter", False),
+                                           vad_parameters=whisper_config_data.get("vad_parameters",
+                                                                                  default_vad_parameters),
+                                           hotwords=hotwords)
+            all_segments.append(list(segments))
+            continue
+
+        segments = []
+        for split_segment in split_segments:
+            text = tokenizer.decode(split_segment["tokens"])
+            if split_segment["start"] == split_segment["end"] or not text.strip():
+                continue
+
+            segments.append(Segment(id=len(segments) + 1, seek=0, start=split_segment["start"],
+                                    end=split_segment["end"], text=text, tokens=split_segment["tokens"],
+                                    temperature=0.0, avg_logprob=avg_logprob, compression_ratio=compression_ratio,
+                                    no_speech_prob=result.no_speech_prob, words=None))
+
+        if speech_chunk_list[index]:
+            segments = list(restore_speech_timestamps(segments, speech_chunk_list[index],
+                                                      feature_extractor.sampling_rate))
+
+        all_segments.append(segments)
+
+    module_logger.debug(f"Batched {len(audio_list)} calls, {fallback_count} fell back to single transcription")
+
+    return all_segments
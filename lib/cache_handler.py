@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+module_logger = logging.getLogger('icad_transcribe.cache')
+
+# Call JSON fields that change the response for the same audio, unit tags come from srcList, tone cutting
+# from tones and the last transcript prompt from the system and talkgroup.
+cache_call_keys = ("srcList", "tones", "short_name", "talkgroup_decimal")
+
+
+def get_cache_key(audio_file, whisper_config_data, model_key, call_data=None, replacements_version=None,
+                  chunk_size=1024 * 1024):
+    """
+    Builds the content address for a transcription request.
+
+    Responses that depend on earlier calls, use_last_as_initial_prompt, can not be cached and callers should skip
+    the cache for them.
+
+    :param audio_file: File-like object with the uploaded audio, read in chunks and rewound afterwards.
+    :param whisper_config_data: The effective merged whisper configuration for the request.
+    :param model_key: The (model, device, compute_type) tuple the request will run on.
+    :param call_data: The call JSON sent with the upload.
+    :param replacements_version: (mtime_ns, size) of the request's replacements file, editing the file changes
+        the key.
+    :param chunk_size: Bytes hashed per read.
+    :return: A hex sha256 digest.
+    """
+    digest = hashlib.sha256()
+
+    audio_file.seek(0)
+    while True:
+        chunk = audio_file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    audio_file.seek(0)
+
+    call_data = call_data or {}
+    digest.update(json.dumps({"whisper": whisper_config_data,
+                              "model": list(model_key),
+                              "call": {key: call_data.get(key) for key in cache_call_keys},
+                              "replacements": replacements_version},
+                             sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two tier cache of finished /transcribe responses keyed by get_cache_key.
+
+    The memory tier is a per process LRU, the optional disk tier is a SQLite database that is shared by every
+    worker process pointing at the same file. Entries older than ttl seconds are treated as misses in both tiers.
+
+    Both tiers hold the serialized response, every hit decodes a fresh copy that the caller is free to modify.
+    """
+
+    def __init__(self, max_entries=256, ttl=86400, disk_path=None):
+        """
+        :param max_entries: Maximum number of responses kept in memory, 0 disables the memory tier.
+        :param ttl: Seconds a response stays valid, 0 keeps responses until they are evicted.
+        :param disk_path: Path of the SQLite database for the disk tier, None or empty disables it.
+        """
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = ttl
+        self.disk_path = disk_path or None
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.disk_path)), exist_ok=True)
+            with self._connect() as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS results "
+                                   "(cache_key TEXT PRIMARY KEY, created_at REAL NOT NULL, result TEXT NOT NULL)")
+            self._purge_disk()
+
+    @contextmanager
+    def _connect(self):
+        # One short lived connection per call keeps the disk tier safe across threads and forked workers.
+        connection = sqlite3.connect(self.disk_path, timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _is_expired(self, created_at, now):
+        return bool(self.ttl) and now - created_at > self.ttl
+
+    def get(self, cache_key):
+        """Returns a copy of the cached response marked with cached: True, or None on a miss."""
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry:
+                if self._is_expired(entry[0], now):
+                    del self._entries[cache_key]
+                else:
+                    self._entries.move_to_end(cache_key)
+                    self.hits += 1
+                    return {**json.loads(entry[1]), "cached": True}
+
+        entry = self._get_disk(cache_key, now)
+        with self._lock:
+            if not entry:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+
+        self._put_memory(cache_key, entry[1], entry[0])
+        return {**json.loads(entry[1]), "cached": True}
+
+    def put(self, cache_key, result):
+        """Stores a successful response in every enabled tier."""
+        created_at = time.time()
+        serialized_result = json.dumps(result)
+        self._put_memory(cache_key, serialized_result, created_at)
+        self._put_disk(cache_key, serialized_result, created_at)
+
+    def _put_memory(self, cache_key, serialized_result, created_at):
+        if not self.max_entries:
+            return
+
+        with self._lock:
+            self._entries[cache_key] = (created_at, serialized_result)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_disk(self, cache_key, now):
+        if not self.disk_path:
+            return None
+
+        try:
+            with self._connect() as connection:
+                row = connection.execute("SELECT created_at, result FROM results WHERE cache_key = ?",
+                                         (cache_key,)).fetchone()
+        except sqlite3.Error as e:
+            module_logger.warning(f"Failed to read result cache: {e}")
+            return None
+
+        if not row or self._is_expired(row[0], now):
+            return None
+
+        return row
+
+    def _put_disk(self, cache_key, serialized_result, created_at):
+        if not self.disk_path:
+            return
+
+        try:
+            with self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO results (cache_key, created_at, result) VALUES (?, ?, ?)",
+                                   (cache_key, created_at, serialized_result))
+        except sqlite3.Error as e:
+            module_logger.warning(f"Failed to write result cache: {e}")
+
+    def _purge_disk(self):
+        if not self.disk_path or not self.ttl:
+            return
+
+        try:
+            with self._connect() as connection:
+                deleted = connection.execute("DELETE FROM results WHERE created_at < ?",
+                                             (time.time() - self.ttl,)).rowcount
+            if deleted:
+                module_logger.info(f"Purged {deleted} expired result(s) from the result cache")
+        except sqlite3.Error as e:
+            module_logger.warning(f"Failed to purge result cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "max_entries": self.max_entries,
+                    "ttl": self.ttl,
+                    "disk": bool(self.disk_path),
+                    "hits": self.hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
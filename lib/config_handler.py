@@ -1,8 +1,6 @@
 import json
 import logging
-import os
 import time
-from datetime import datetime, timedelta
 
 module_logger = logging.getLogger('icad_transcribe.config')
 
@@ -11,7 +9,55 @@ default_config = {
     "audio_upload": {
         "allowed_extensions": ["audio/x-wav", "audio/x-m4a", "audio/mpeg"],
         "max_audio_length": 300,
-        "max_file_size": 3
+        "max_file_size": 3,
+        "spool_path": None,
+        "memory_ceiling_mb": 0
+    },
+    "job_queue": {
+        "workers": 1,
+        "max_queue_size": 32,
+        "result_ttl": 600,
+        "max_wait": 60,
+        "transcribe_timeout": 300,
+        "stream_keepalive": 15,
+        "batch_size": 8,
+        "batch_window_ms": 50
+    },
+    "batch_upload": {
+        "decode_workers": 4,
+        "max_in_flight": 8,
+        "max_upload_size_mb": 512
+    },
+    "result_cache": {
+        "enabled": True,
+        "max_entries": 256,
+        "ttl": 86400,
+        "disk_path": None
+    },
+    "prompt_store": {
+        "max_entries": 1024,
+        "ttl": 3600,
+        "max_history": 5,
+        "disk_path": None
+    },
+    "talkgroup_profiles": {
+        "reload_interval": 5,
+        "max_entries": 256,
+        "profiles": {}
+    },
+    "inference_server": {
+        "enabled": False,
+        "socket_path": None,
+        "max_queue_size": 256
+    },
+    "model_pool": {
+        "memory_budget_mb": 0,
+        "offline": False,
+        "verify_checksums": True,
+        "refresh_days": 0,
+        "warm_up_seconds": 2,
+        "warm_up_runs": 1,
+        "allowed_models": ["tiny", "tiny.en", "base", "base.en", "small", "small.en", "medium", "medium.en", "large-v1", "large-v2", "large-v3"]
     },
     "whisper": {
         "device": "cuda",
@@ -24,7 +70,10 @@ default_config = {
         "best_of": 5,
         "initial_prompt": None,
         "use_last_as_initial_prompt": False,
+        "last_prompt_history": 1,
+        "last_prompt_max_tokens": 223,
         "word_timestamps": False,
+        "unit_attribution": "closest",
         "cut_tones": False,
         "show_tone_text": False,
         "cut_pre_tone": 0.5,
@@ -33,6 +82,14 @@ default_config = {
         "amplify_target_peak": -22,
         "amplify_silence_threshold": -40,
         "amplify_clipping_threshold": -11,
+        "amplify_smooth_gain": False,
+        "trim_silence": False,
+        "trim_silence_threshold": -45,
+        "trim_min_silence": 1.0,
+        "trim_pad": 0.25,
+        "trim_gap": 0.3,
+        "split_transmissions": False,
+        "split_min_seconds": 1.0,
         "vad_filter": True,
         "vad_parameters": {
             "threshold": 0.3,
@@ -47,26 +104,6 @@ default_config = {
 }
 
 
-def is_model_outdated(directory, days=7):
-    """Check if the model files in the directory are older than 'days' days."""
-    now = datetime.now()
-    threshold = now - timedelta(days=days)
-
-    if not os.path.exists(directory):
-        # Directory does not exist, so model is considered outdated
-        return True
-
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        file_mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-        if file_mod_time < threshold:
-            # At least one file is older than the threshold, so model is outdated
-            return True
-
-    # All files are within the 'days' threshold
-    return False
-
-
 def get_max_content_length(config_data, default_size_mb=3):
     try:
         # Attempt to retrieve and convert the max file size to an integer
@@ -1,9 +1,11 @@
-import io
 import json
 import copy
+from contextlib import nullcontext
 
 import magic
-from pydub import AudioSegment
+
+from lib.audio_handler import get_audio_duration, get_pcm_size, load_audio
+from lib.metrics_handler import time_stage
 
 hallucinations = [""]
 
@@ -55,18 +57,49 @@ def update_config(default_config, user_config):
     return update(default_copy, user_config)
 
 
-def validate_audio_file(audio_file, allowed_mimetypes, max_audio_length):
-    mimetype = magic.from_buffer(audio_file.read(1024), mime=True)
-    audio_file.seek(0)
+def validate_audio_file(audio_file, allowed_mimetypes, max_audio_length, memory_limiter=None):
+    """
+    Validates the MIME type and duration of an uploaded audio file.
+
+    The duration is read from the container headers first so uploads that are too long are rejected before they
+    reach ffmpeg, a full decode is only used to measure formats the header parser does not understand. Valid
+    files are decoded a single time here and the decoded samples are handed back so the caller can reuse them
+    for the rest of the pipeline instead of decoding the upload again.
+
+    With a memory_limiter the decoded size is reserved first, MemoryLimitExceeded is raised instead of decoding
+    when the process is too close to its memory ceiling.
+
+    Returns:
+    --------
+    tuple
+        (is_valid, message, audio) where audio is the decoded float32 sample array or None if invalid.
+    """
+    with time_stage("mime_sniff"):
+        mimetype = magic.from_buffer(audio_file.read(1024), mime=True)
+        audio_file.seek(0)
     if mimetype not in allowed_mimetypes:
-        return False, "Audio MIMETYPE must be in {}".format(allowed_mimetypes)
+        return False, "Audio MIMETYPE must be in {}".format(allowed_mimetypes), None
+
+    with time_stage("header_duration"):
+        duration = get_audio_duration(audio_file)
+    if duration is not None and duration > max_audio_length:
+        return False, f"File duration must be under {max_audio_length} seconds", None
+
+    reservation = nullcontext()
+    if memory_limiter:
+        reservation = memory_limiter.reserve(get_pcm_size(duration if duration is not None else max_audio_length))
 
-    audio = AudioSegment.from_file(io.BytesIO(audio_file.read()))
+    with reservation:
+        try:
+            with time_stage("decode"):
+                audio, decoded_duration = load_audio(audio_file, expected_duration=duration)
+        except Exception as e:
+            return False, f"Unable to decode audio file: {e}", None
 
-    if audio.duration_seconds > max_audio_length:
-        return False, f"File duration must be under {max_audio_length * 60} minutes"
+    if duration is None and decoded_duration > max_audio_length:
+        return False, f"File duration must be under {max_audio_length} seconds", None
 
-    return True, "Valid audio file"
+    return True, "Valid audio file", audio
 
 def inject_alert_tone_segments(whisper_segments, detected_tones):
     whisper_segments = list(whisper_segments)
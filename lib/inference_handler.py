@@ -0,0 +1,242 @@
+import logging
+import os
+import queue
+import secrets
+import tempfile
+import threading
+import traceback
+from multiprocessing import AuthenticationError, get_context
+from multiprocessing.connection import Client, Listener
+
+from lib.job_handler import JobQueue, JobQueueFull, TranscriptionJob
+
+module_logger = logging.getLogger('icad_transcribe.inference')
+
+# What a dropped connection, or one made with a different authkey, raises on either side of the socket.
+connection_errors = (EOFError, OSError, AuthenticationError)
+
+authkey_env = "ICAD_INFERENCE_AUTHKEY"
+
+
+def get_inference_socket_path(config_data):
+    return (config_data.get("inference_server", {}).get("socket_path", None) or
+            os.path.join(tempfile.gettempdir(), "icad_transcribe_inference.sock"))
+
+
+def get_authkey():
+    authkey = os.getenv(authkey_env)
+    return authkey.encode() if authkey else None
+
+
+class _TaggedEvents:
+    """Stands in for a streaming job's event queue on the server, tags each event with the job's batch index."""
+
+    def __init__(self, outbound, index):
+        self.outbound = outbound
+        self.index = index
+
+    def put(self, event):
+        self.outbound.put((self.index, event))
+
+
+class InferenceServer:
+    """
+    Owns the one copy of the models and serves transcription to every gunicorn worker over a Unix socket.
+
+    CTranslate2 keeps its own worker threads, which do not survive a fork, so a model loaded in the gunicorn master
+    can not be shared with the workers through copy on write. Instead the workers keep their HTTP side, upload
+    decoding, job tracking and result cache, and send decoded audio here. Jobs from every worker land in one job
+    queue, so they also batch together.
+
+    Every connection carries one request, a status query or a list of jobs. For a list of jobs the server sends
+    ("segment", index, segment) for each decoded segment of a streaming job and ("result", index, (result,
+    status_code)) as each job finishes.
+    """
+
+    def __init__(self, socket_path, job_queue, model_startup, model_registry, authkey=None):
+        self.socket_path = socket_path
+        self.job_queue = job_queue
+        self.model_startup = model_startup
+        self.model_registry = model_registry
+        self.authkey = authkey
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        with Listener(self.socket_path, family="AF_UNIX", authkey=self.authkey) as listener:
+            module_logger.info(f"Inference server listening on {self.socket_path}")
+            while True:
+                try:
+                    connection = listener.accept()
+                except Exception as e:
+                    module_logger.warning(f"Rejected inference connection: {e}")
+                    continue
+                threading.Thread(target=self._handle_connection, args=(connection,), name="inference-connection",
+                                 daemon=True).start()
+
+    def status(self):
+        return {**self.model_startup.to_dict(), "model_registry": self.model_registry.stats(),
+                "queue_depth": self.job_queue.depth, "in_flight": self.job_queue.in_flight}
+
+    def _handle_connection(self, connection):
+        try:
+            with connection:
+                message = connection.recv()
+                if message[0] == "status":
+                    connection.send(self.status())
+                elif message[0] == "transcribe":
+                    self._transcribe(connection, message[1])
+        except connection_errors as e:
+            module_logger.debug(f"Inference connection closed early: {e}")
+        except Exception as e:
+            traceback.print_exc()
+            module_logger.error(f"Inference connection failed: {e}")
+
+    def _transcribe(self, connection, job_payloads):
+        outbound = queue.Queue()
+
+        for index, (audio, call_data, whisper_config_data, detected_tones, start, streaming,
+                    timestamp_map) in enumerate(job_payloads):
+            job = TranscriptionJob(audio, call_data, whisper_config_data, detected_tones, start=start,
+                                   timestamp_map=timestamp_map)
+            if streaming:
+                job.events = _TaggedEvents(outbound, index)
+            job.add_done_callback(lambda job, index=index: outbound.put((index, ("done", job.result,
+                                                                                   job.status_code))))
+            try:
+                self.job_queue.submit(job)
+            except JobQueueFull as e:
+                job.finish({"success": False, "message": "Transcription queue is full, try again later",
+                            "retry_after": e.retry_after}, 429)
+
+        remaining = len(job_payloads)
+        while remaining:
+            index, event = outbound.get()
+            if event[0] == "segment":
+                connection.send(("segment", index, event[1]))
+            elif event[0] == "done":
+                connection.send(("result", index, (event[1], event[2])))
+                remaining -= 1
+
+
+class InferenceClient:
+    """Sends the jobs of a gunicorn worker to the InferenceServer, see InferenceServer for the protocol."""
+
+    def __init__(self, socket_path, authkey=None):
+        self.socket_path = socket_path
+        self.authkey = authkey
+
+    def _connect(self):
+        return Client(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+
+    def status(self):
+        with self._connect() as connection:
+            connection.send(("status",))
+            return connection.recv()
+
+    def transcribe_jobs(self, jobs):
+        """
+        Transcribes a batch of jobs on the server, segments of streaming jobs are passed on to job.emit_segment as
+        they arrive.
+
+        :return: List of (result, status_code) tuples in the same order as jobs.
+        """
+        results = [None] * len(jobs)
+        try:
+            with self._connect() as connection:
+                connection.send(("transcribe", [(job.audio, job.call_data, job.whisper_config_data,
+                                                 job.detected_tones, job.start, job.streaming, job.timestamp_map)
+                                                for job in jobs]))
+                remaining = len(jobs)
+                while remaining:
+                    message, index, data = connection.recv()
+                    if message == "segment":
+                        jobs[index].emit_segment(data)
+                    else:
+                        results[index] = data
+                        remaining -= 1
+        except connection_errors as e:
+            module_logger.error(f"Inference server at {self.socket_path} unavailable: {e}")
+
+        return [result or ({"success": False, "message": "Inference server unavailable"}, 503)
+                for result in results]
+
+
+class RemoteModelStartup:
+    """Reports the InferenceServer's model startup through the same interface as ModelStartup."""
+
+    def __init__(self, inference_client):
+        self.inference_client = inference_client
+
+    def to_dict(self):
+        try:
+            status = self.inference_client.status()
+        except connection_errors as e:
+            return {"status": "unreachable", "error": str(e)}
+        status.pop("model_registry", None)
+        return status
+
+    @property
+    def ready(self):
+        return self.to_dict()["status"] == "ready"
+
+    @property
+    def failed(self):
+        return self.to_dict()["status"] == "failed"
+
+
+def run_inference_server(config_file_path, socket_path, models_path):
+    """Entry point of the inference server process, loads the default model and serves until killed."""
+    from lib.config_handler import load_config_file
+    from lib.logging_handler import CustomLogger
+    from lib.model_handler import ModelStartup, get_model_key, get_model_registry
+    from lib.prompt_handler import get_prompt_store
+    from lib.transcribe_handler import get_warm_up, set_prompt_store, transcribe_model_groups
+
+    config_data = load_config_file(config_file_path) or {}
+    config_path = os.path.dirname(config_file_path)
+    whisper_config_data = config_data.get("whisper", {})
+
+    log_path = os.path.join(os.path.dirname(config_path), 'log')
+    CustomLogger(config_data.get("log_level", 1), "icad_transcribe",
+                 os.path.join(log_path, "icad_transcribe_inference.log"))
+
+    set_prompt_store(get_prompt_store(config_data))
+    model_registry = get_model_registry(config_data, models_path)
+
+    job_queue = JobQueue(lambda jobs: transcribe_model_groups(model_registry, jobs, config_path),
+                         max_queue_size=config_data.get("inference_server", {}).get("max_queue_size", 256),
+                         workers=config_data.get("job_queue", {}).get("workers", 1),
+                         result_ttl=0,
+                         batch_size=config_data.get("job_queue", {}).get("batch_size", 8),
+                         batch_window=config_data.get("job_queue", {}).get("batch_window_ms", 50) / 1000)
+
+    model_startup = ModelStartup(model_registry, get_model_key(whisper_config_data),
+                                 warm_up=get_warm_up(config_data))
+    model_startup.start()
+
+    InferenceServer(socket_path, job_queue, model_startup, model_registry, authkey=get_authkey()).serve_forever()
+
+
+def start_inference_server(config_file_path, models_path):
+    """
+    Starts the inference server in its own process, called from the gunicorn master before any worker forks.
+
+    The process is spawned rather than forked and shares a random authkey with the workers through the
+    environment they inherit.
+
+    :return: The multiprocessing Process running the server.
+    """
+    if not os.getenv(authkey_env):
+        os.environ[authkey_env] = secrets.token_hex(16)
+
+    from lib.config_handler import load_config_file
+    socket_path = get_inference_socket_path(load_config_file(config_file_path) or {})
+
+    process = get_context("spawn").Process(target=run_inference_server,
+                                           args=(config_file_path, socket_path, models_path),
+                                           name="icad-inference-server", daemon=True)
+    process.start()
+    module_logger.info(f"Started inference server process {process.pid}")
+    return process
@@ -0,0 +1,257 @@
+import logging
+import math
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+from lib.audio_handler import SAMPLE_RATE
+
+module_logger = logging.getLogger('icad_transcribe.job_queue')
+
+
+class JobQueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Transcription queue is full, retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class TranscriptionJob:
+    """
+    A single transcription request waiting for, or being processed by, an inference worker.
+
+    The decoded audio is dropped as soon as the job finishes so completed jobs only hold on to their result.
+
+    Streaming jobs also get an event queue that receives each segment as it is decoded, followed by the final
+    result once the job finishes.
+    """
+
+    def __init__(self, audio, call_data, whisper_config_data, detected_tones, start=None, streaming=False,
+                 timestamp_map=None, audio_duration=None):
+        self.job_id = uuid.uuid4().hex
+        self.audio = audio
+        self.timestamp_map = timestamp_map
+        self.call_data = call_data
+        self.whisper_config_data = whisper_config_data
+        self.detected_tones = detected_tones
+        self.start = start or time.time()
+        self.cache_key = None
+        # Length of the call as uploaded, the audio itself may already have had silence trimmed out of it.
+        if audio_duration is None:
+            audio_duration = audio.shape[0] / SAMPLE_RATE if audio is not None else 0.0
+        self.audio_duration = audio_duration
+        self.started_at = None
+
+        self.status = "queued"
+        self.result = None
+        self.status_code = None
+        self.completed_at = None
+        self._done = threading.Event()
+        self._done_callbacks = []
+        self._callback_lock = threading.Lock()
+        self.events = queue.Queue() if streaming else None
+
+    @property
+    def streaming(self):
+        return self.events is not None
+
+    def emit_segment(self, segment):
+        self.events.put(("segment", segment))
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the job is finished or the timeout expires. Returns True if the job is finished."""
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """Calls callback(job) once the job finishes, right away if it already has."""
+        with self._callback_lock:
+            if not self.done:
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, result, status_code):
+        self.result = result
+        self.status_code = status_code
+        self.status = "complete" if status_code == 200 else "failed"
+        self.completed_at = time.time()
+        self.audio = None
+        self.timestamp_map = None
+        with self._callback_lock:
+            self._done.set()
+            done_callbacks, self._done_callbacks = self._done_callbacks, []
+        if self.events is not None:
+            self.events.put(("result" if status_code == 200 else "error", result))
+        for callback in done_callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                module_logger.error(f"Job {self.job_id} done callback failed: {e}")
+
+    def to_dict(self):
+        job_data = {"job_id": self.job_id, "status": self.status}
+        if self.done:
+            job_data["result"] = self.result
+        return job_data
+
+
+class JobQueue:
+    """
+    Bounded in-process queue drained by a fixed set of inference worker threads.
+
+    Jobs are rejected with JobQueueFull once max_queue_size jobs are waiting so that a burst of calls produces
+    backpressure for the client instead of piling up behind the model until requests time out.
+
+    Each worker micro-batches, after taking a job it keeps collecting for up to batch_window seconds or until it
+    holds batch_size jobs and hands the whole batch to process_func in one call.
+    """
+
+    def __init__(self, process_func, max_queue_size=32, workers=1, result_ttl=600, batch_size=1, batch_window=0.05):
+        """
+        :param process_func: Callable taking a list of TranscriptionJob objects and returning a list of
+            (result, status_code) tuples in the same order.
+        :param max_queue_size: Maximum number of jobs waiting for a worker.
+        :param workers: Number of inference worker threads.
+        :param result_ttl: Seconds a finished job is kept around for polling.
+        :param batch_size: Maximum number of jobs handed to process_func at once.
+        :param batch_window: Seconds a worker waits for more jobs after taking the first one of a batch.
+        """
+        self.process_func = process_func
+        self.max_queue_size = max(1, int(max_queue_size))
+        self.worker_count = max(1, int(workers))
+        self.result_ttl = result_ttl
+        self.batch_size = max(1, int(batch_size))
+        self.batch_window = max(0.0, float(batch_window))
+
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        self._worker_pid = None
+        self._in_flight = 0
+        self._average_process_time = 5.0
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def tracked_jobs(self):
+        return len(self._jobs)
+
+    def _ensure_workers(self):
+        # Worker threads do not survive a fork, so (re)start them in whichever process is submitting.
+        if self._worker_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+
+            self._workers = []
+            for worker_number in range(self.worker_count):
+                worker = threading.Thread(target=self._worker_loop, name=f"inference-worker-{worker_number}",
+                                          daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            self._worker_pid = os.getpid()
+            module_logger.info(f"Started {self.worker_count} inference worker(s)")
+
+    def retry_after(self):
+        """Estimate, in whole seconds, how long until the queue has room again."""
+        pending = self.depth + self._in_flight
+        return max(1, math.ceil(self._average_process_time * pending / self.worker_count))
+
+    def submit(self, job):
+        self._purge_expired()
+
+        if job.done:
+            # Already answered, e.g. from the result cache, only keep it around for polling.
+            with self._lock:
+                self._jobs[job.job_id] = job
+            return job
+
+        self._ensure_workers()
+
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise JobQueueFull(self.retry_after())
+
+        with self._lock:
+            self._jobs[job.job_id] = job
+
+        module_logger.debug(f"Queued job {job.job_id}, queue depth {self.depth}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.completed_at and now - job.completed_at > self.result_ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _worker_loop(self):
+        while True:
+            batch = self._collect_batch()
+            self._run_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run_batch(self, jobs):
+        with self._lock:
+            self._in_flight += len(jobs)
+        process_start = time.time()
+        for job in jobs:
+            job.status = "processing"
+            job.started_at = process_start
+
+        try:
+            results = self.process_func(jobs)
+        except Exception as e:
+            traceback.print_exc()
+            results = [({"success": False, "message": f"Exception: {e}"}, 500)] * len(jobs)
+
+        process_time = time.time() - process_start
+        with self._lock:
+            self._in_flight -= len(jobs)
+            # Exponential moving average of the per job time, used for Retry-After estimates.
+            self._average_process_time = (0.8 * self._average_process_time) + (0.2 * process_time / len(jobs))
+
+        for job, (result, status_code) in zip(jobs, results):
+            job.finish(result, status_code)
+
+        module_logger.debug(f"Finished {len(jobs)} job(s) in {round(process_time, 2)} seconds")
@@ -0,0 +1,181 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+module_logger = logging.getLogger('icad_transcribe.metrics')
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+real_time_factor_buckets = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        label_values = tuple(str(label_value) for label_value in label_values)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose value is read from a callback at scrape time."""
+
+    def __init__(self, name, documentation, value_func):
+        self.name = name
+        self.documentation = documentation
+        self.value_func = value_func
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            lines.append(f"{self.name} {format_value(self.value_func())}")
+        except Exception as e:
+            module_logger.warning(f"Failed to read gauge {self.name}: {e}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per bucket counts, +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        label_values = tuple(str(label_value) for label_value in label_values)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            if bucket_index < len(self.buckets):
+                state[0][bucket_index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (bucket_counts, count, total) in sorted(self._values.items()):
+                # Buckets are stored per interval, Prometheus expects them cumulative.
+                cumulative = 0
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.label_names, label_values, f'le="{format_value(upper_bound)}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.label_names, label_values, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="icad_transcribe"):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(f"{self.prefix}_{name}", documentation, label_names))
+
+    def gauge(self, name, documentation, value_func):
+        return self._register(Gauge(f"{self.prefix}_{name}", documentation, value_func))
+
+    def histogram(self, name, documentation, label_names=(), buckets=default_buckets):
+        return self._register(Histogram(f"{self.prefix}_{name}", documentation, label_names, buckets))
+
+    def render(self):
+        """Returns every registered metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram("stage_seconds", "Time spent in each stage of the transcription pipeline.",
+                                  label_names=("stage",))
+jobs_total = metrics.counter("jobs_total", "Transcription jobs finished per model and HTTP status.",
+                             label_names=("model", "status"))
+system_jobs_total = metrics.counter("system_jobs_total", "Transcription jobs finished per system short_name.",
+                                    label_names=("short_name",))
+talkgroup_jobs_total = metrics.counter("talkgroup_jobs_total", "Transcription jobs finished per talkgroup.",
+                                       label_names=("short_name", "talkgroup"))
+audio_seconds_total = metrics.counter("audio_seconds_total", "Seconds of audio transcribed.")
+processing_seconds_total = metrics.counter("processing_seconds_total",
+                                           "Seconds spent processing transcription jobs.")
+real_time_factor = metrics.histogram("real_time_factor",
+                                     "Audio seconds transcribed per second of processing, per job.",
+                                     buckets=real_time_factor_buckets)
+
+
+@contextmanager
+def time_stage(stage):
+    """Records the wall time of the wrapped block in the stage_seconds histogram."""
+    stage_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - stage_start, stage)
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage)
+
+
+def record_job(model_name, status_code, call_data, audio_seconds, processing_seconds):
+    """Updates the per model, per system and per talkgroup counters and the real time factor for a finished job."""
+    call_data = call_data or {}
+    short_name = call_data.get("short_name", "unknown")
+
+    jobs_total.inc(model_name, status_code)
+    system_jobs_total.inc(short_name)
+    talkgroup_jobs_total.inc(short_name, call_data.get("talkgroup_decimal", 0))
+
+    if status_code == 200 and audio_seconds and processing_seconds > 0:
+        audio_seconds_total.inc(amount=audio_seconds)
+        processing_seconds_total.inc(amount=processing_seconds)
+        real_time_factor.observe(audio_seconds / processing_seconds)
@@ -0,0 +1,429 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from faster_whisper import WhisperModel, download_model
+
+module_logger = logging.getLogger('icad_transcribe.models')
+
+valid_devices = ["cpu", "cuda"]
+
+manifest_file_name = "icad_model_manifest.json"
+# Files a converted model can not be loaded without.
+required_model_files = ("model.bin", "config.json")
+
+
+def get_model_key(whisper_config_data):
+    """Returns the (model, device, compute_type) tuple that identifies the model a request needs."""
+    return (whisper_config_data.get("model", "small"),
+            whisper_config_data.get("device", "cpu"),
+            whisper_config_data.get("compute_type", "float16"))
+
+
+def get_directory_size(directory):
+    total_size = 0
+    for dir_path, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            if os.path.isfile(file_path):
+                total_size += os.path.getsize(file_path)
+    return total_size
+
+
+def hash_file(file_path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_model_files(model_dir):
+    """Returns the model's files relative to model_dir, without the manifest and the download tool's dot folders."""
+    model_files = []
+    for dir_path, dir_names, file_names in os.walk(model_dir):
+        dir_names[:] = [dir_name for dir_name in dir_names if not dir_name.startswith(".")]
+        for file_name in file_names:
+            if file_name == manifest_file_name or file_name.startswith("."):
+                continue
+            model_files.append(os.path.relpath(os.path.join(dir_path, file_name), model_dir))
+    return sorted(model_files)
+
+
+def read_model_manifest(model_dir):
+    try:
+        with open(os.path.join(model_dir, manifest_file_name), "r") as mf:
+            return json.load(mf)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        module_logger.warning(f"Unreadable model manifest in {model_dir}: {e}")
+        return None
+
+
+def save_model_manifest(model_dir, manifest):
+    manifest_path = os.path.join(model_dir, manifest_file_name)
+    with open(manifest_path + ".tmp", "w") as mf:
+        json.dump(manifest, mf, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def write_model_manifest(model_dir, model_name, downloaded_at=None):
+    """
+    Records the size, modification time and sha256 of every file of a model that was just downloaded.
+
+    :return: The manifest dict.
+    """
+    files = {}
+    for model_file in list_model_files(model_dir):
+        file_stat = os.stat(os.path.join(model_dir, model_file))
+        files[model_file] = {"size": file_stat.st_size,
+                             "mtime_ns": file_stat.st_mtime_ns,
+                             "sha256": hash_file(os.path.join(model_dir, model_file))}
+
+    manifest = {"model": model_name, "downloaded_at": downloaded_at or time.time(), "files": files}
+    save_model_manifest(model_dir, manifest)
+    return manifest
+
+
+def verify_model_manifest(model_dir, manifest, verify_checksums=True):
+    """
+    Checks a model directory against its manifest.
+
+    Every file has to exist with the recorded size. With verify_checksums a file whose modification time changed
+    since the manifest was written is hashed again, files that were not touched are trusted without reading them,
+    so verifying an unchanged multi GB model takes milliseconds.
+
+    :return: A tuple of (reason the model is not usable or None, whether the manifest's modification times were
+        updated and it should be saved).
+    """
+    files = manifest.get("files", {})
+    for required_file in required_model_files:
+        if required_file not in files:
+            return f"Model manifest has no {required_file}", False
+
+    updated = False
+    for model_file, entry in files.items():
+        try:
+            file_stat = os.stat(os.path.join(model_dir, model_file))
+        except FileNotFoundError:
+            return f"Model file {model_file} is missing", False
+
+        if file_stat.st_size != entry.get("size"):
+            return f"Model file {model_file} is {file_stat.st_size} bytes, expected {entry.get('size')}", False
+
+        if verify_checksums and file_stat.st_mtime_ns != entry.get("mtime_ns"):
+            if hash_file(os.path.join(model_dir, model_file)) != entry.get("sha256"):
+                return f"Model file {model_file} does not match its checksum", False
+            entry["mtime_ns"] = file_stat.st_mtime_ns
+            updated = True
+
+    return None, updated
+
+
+def check_model_cache(model_dir, model_name, verify_checksums=True, refresh_days=0):
+    """
+    Decides whether a cached model can be loaded as it is.
+
+    A model downloaded by an older version has no manifest, it gets one when its required files are present.
+
+    :param refresh_days: Download the model again once its manifest is older than this many days, 0 never does.
+    :return: The reason the model has to be downloaded, or None when the cache is usable.
+    """
+    if not os.path.isdir(model_dir):
+        return "Model not found"
+
+    manifest = read_model_manifest(model_dir)
+    if manifest is None:
+        missing_files = [required_file for required_file in required_model_files
+                         if not os.path.isfile(os.path.join(model_dir, required_file))]
+        if missing_files:
+            return f"Model files {missing_files} are missing"
+        module_logger.info(f"Creating manifest for cached model {model_name}")
+        write_model_manifest(model_dir, model_name)
+        return None
+
+    if refresh_days and time.time() - manifest.get("downloaded_at", 0) > refresh_days * 86400:
+        return f"Model is older than {refresh_days} days"
+
+    reason, updated = verify_model_manifest(model_dir, manifest, verify_checksums=verify_checksums)
+    if updated:
+        try:
+            save_model_manifest(model_dir, manifest)
+        except OSError as e:
+            module_logger.warning(f"Failed to update model manifest: {e}")
+    return reason
+
+
+def get_model_registry(config_data, models_path):
+    """Builds the ModelRegistry described by the model_pool, whisper and job_queue sections of the config."""
+    allowed_models = config_data.get("model_pool", {}).get("allowed_models", [])
+    if allowed_models:
+        # The configured default model can always be used.
+        allowed_models = allowed_models + [config_data.get("whisper", {}).get("model", "small")]
+
+    return ModelRegistry(models_path,
+                         allowed_models=allowed_models,
+                         memory_budget_mb=config_data.get("model_pool", {}).get("memory_budget_mb", 0),
+                         cpu_threads=config_data.get("whisper", {}).get("cpu_threads", 4),
+                         num_workers=config_data.get("job_queue", {}).get("workers", 1),
+                         offline=config_data.get("model_pool", {}).get("offline", False),
+                         verify_checksums=config_data.get("model_pool", {}).get("verify_checksums", True),
+                         refresh_days=config_data.get("model_pool", {}).get("refresh_days", 0))
+
+
+class LoadedModel:
+    def __init__(self, key, model, memory_bytes, load_seconds):
+        self.key = key
+        self.model = model
+        self.memory_bytes = memory_bytes
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.last_used = self.loaded_at
+        self.hits = 0
+
+    def to_dict(self):
+        model_name, device, compute_type = self.key
+        return {"model": model_name, "device": device, "compute_type": compute_type,
+                "memory_mb": round(self.memory_bytes / (1024 * 1024), 1),
+                "load_seconds": round(self.load_seconds, 2),
+                "loaded_at": round(self.loaded_at, 3),
+                "last_used": round(self.last_used, 3),
+                "hits": self.hits}
+
+
+class ModelRegistry:
+    """
+    Lazily loads WhisperModel instances keyed by (model, device, compute_type) and keeps them resident
+    within a memory budget, evicting the least recently used model when a new one would not fit.
+
+    Memory use is estimated from the size of the model files on disk, which is close to what CTranslate2 holds
+    resident for the model weights.
+    """
+
+    def __init__(self, models_path, allowed_models=None, memory_budget_mb=0, cpu_threads=4, num_workers=1,
+                 offline=False, verify_checksums=True, refresh_days=0):
+        """
+        :param models_path: Directory models are downloaded to, one sub directory per model name.
+        :param allowed_models: Model names requests may select, None or empty allows any model.
+        :param memory_budget_mb: Maximum estimated memory for resident models, 0 disables the budget.
+        :param cpu_threads: CTranslate2 intra op threads per model.
+        :param num_workers: CTranslate2 inter op workers per model, should match the inference workers.
+        :param offline: Never download, a model that is not cached fails to load.
+        :param verify_checksums: Hash model files that changed since they were downloaded, see verify_model_manifest.
+        :param refresh_days: Download cached models again after this many days, 0 keeps them until they are damaged.
+        """
+        self.models_path = models_path
+        self.allowed_models = allowed_models or []
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.offline = offline
+        self.verify_checksums = verify_checksums
+        self.refresh_days = refresh_days
+
+        self._models = OrderedDict()
+        self._load_locks = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def memory_used(self):
+        return sum(loaded_model.memory_bytes for loaded_model in self._models.values())
+
+    def validate(self, model_key):
+        """Returns an error message if the model key can not be served, None otherwise."""
+        model_name, device, compute_type = model_key
+        if device not in valid_devices:
+            return f"Whisper device needs to be one of {valid_devices}"
+        if self.allowed_models and model_name not in self.allowed_models:
+            return f"Whisper model must be one of {self.allowed_models}"
+        return None
+
+    def get(self, model_key):
+        """
+        Returns the WhisperModel for model_key, loading it first if it is not resident.
+
+        :param model_key: Tuple of (model, device, compute_type), see get_model_key.
+        :return: The loaded WhisperModel.
+        """
+        error = self.validate(model_key)
+        if error:
+            raise ValueError(error)
+
+        loaded_model = self._get_resident(model_key)
+        if loaded_model:
+            return loaded_model.model
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(model_key, threading.Lock())
+
+        # Only one thread loads a given model, the rest wait here and pick it up once it is resident.
+        with load_lock:
+            loaded_model = self._get_resident(model_key)
+            if loaded_model:
+                return loaded_model.model
+
+            with self._lock:
+                self.misses += 1
+
+            loaded_model = self._load(model_key)
+
+            with self._lock:
+                self._models[model_key] = loaded_model
+
+        return loaded_model.model
+
+    def _get_resident(self, model_key):
+        with self._lock:
+            loaded_model = self._models.get(model_key)
+            if loaded_model:
+                self._models.move_to_end(model_key)
+                loaded_model.hits += 1
+                loaded_model.last_used = time.time()
+                self.hits += 1
+            return loaded_model
+
+    def _evict_for(self, memory_bytes):
+        if not self.memory_budget:
+            return
+
+        with self._lock:
+            while self._models and self.memory_used + memory_bytes > self.memory_budget:
+                evicted_key, evicted_model = self._models.popitem(last=False)
+                self.evictions += 1
+                module_logger.info(f"Evicting model {evicted_key} to free "
+                                   f"{round(evicted_model.memory_bytes / (1024 * 1024), 1)} MB")
+
+        if memory_bytes > self.memory_budget:
+            module_logger.warning(f"Model needs {round(memory_bytes / (1024 * 1024), 1)} MB which is more than "
+                                  f"the {round(self.memory_budget / (1024 * 1024), 1)} MB model memory budget")
+
+    def _load(self, model_key):
+        model_name, device, compute_type = model_key
+        load_start = time.time()
+
+        model_dir = self._get_model_dir(model_name)
+
+        memory_bytes = get_directory_size(model_dir)
+        self._evict_for(memory_bytes)
+
+        model = WhisperModel(model_dir,
+                             device=device,
+                             cpu_threads=self.cpu_threads,
+                             num_workers=self.num_workers,
+                             compute_type=compute_type)
+
+        load_seconds = time.time() - load_start
+        module_logger.info(f"Loaded model {model_name} on {device} ({compute_type}) in {round(load_seconds, 2)} "
+                           f"seconds")
+
+        return LoadedModel(model_key, model, memory_bytes, load_seconds)
+
+    def _get_model_dir(self, model_name):
+        model_cache_dir = os.path.join(self.models_path, model_name)
+        reason = check_model_cache(model_cache_dir, model_name, verify_checksums=self.verify_checksums,
+                                   refresh_days=0 if self.offline else self.refresh_days)
+        if reason is None:
+            module_logger.info(f"Using cached model. {model_name}")
+            return model_cache_dir
+
+        if self.offline:
+            raise RuntimeError(f"{reason} and offline mode is on, not downloading model {model_name}")
+
+        module_logger.warning(f"{reason}. Downloading model {model_name}...")
+        model_dir = download_model(model_name, output_dir=model_cache_dir)
+        write_model_manifest(model_dir, model_name)
+        return model_dir
+
+    def stats(self):
+        with self._lock:
+            return {"models": [loaded_model.to_dict() for loaded_model in reversed(self._models.values())],
+                    "memory_budget_mb": round(self.memory_budget / (1024 * 1024), 1),
+                    "memory_used_mb": round(self.memory_used / (1024 * 1024), 1),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+class ModelStartup:
+    """
+    Loads the default model on a background thread, so the server binds and answers liveness checks right away
+    instead of blocking import until a download or load finishes. Requests that arrive first wait in the job queue
+    until the model is resident.
+
+    An optional warm up runs after the load and before the model is reported ready, so the first real request
+    does not pay for CTranslate2 and CUDA initialization.
+    """
+
+    def __init__(self, model_registry, model_key, warm_up=None):
+        """
+        :param model_registry: The ModelRegistry to load the model into.
+        :param model_key: The (model, device, compute_type) tuple of the default model.
+        :param warm_up: Optional callable that takes the loaded WhisperModel and runs it once.
+        """
+        self.model_registry = model_registry
+        self.model_key = model_key
+        self.warm_up = warm_up
+        self.status = "pending"
+        self.error = None
+        self.started_at = None
+        self.ready_at = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    @property
+    def failed(self):
+        return self.status == "failed"
+
+    def start(self):
+        self.status = "loading"
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="model-startup", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            model = self.model_registry.get(self.model_key)
+            if self.warm_up:
+                self.status = "warming"
+                warm_up_start = time.time()
+                self.warm_up(model)
+                module_logger.info(f"Warmed up model in {round(time.time() - warm_up_start, 2)} seconds")
+        except Exception as e:
+            module_logger.error(f"Exception Loading Whisper Model: {e}")
+            self.error = str(e)
+            self.status = "failed"
+        else:
+            self.ready_at = time.time()
+            self.status = "ready"
+            module_logger.info(f"Ready after {round(self.ready_at - self.started_at, 2)} seconds")
+        finally:
+            self._ready.set()
+
+    def wait(self, timeout=None):
+        """Blocks until startup finished or failed, returns True once the model is ready."""
+        self._ready.wait(timeout)
+        return self.ready
+
+    def to_dict(self):
+        model_name, device, compute_type = self.model_key
+        return {"status": self.status,
+                "model": model_name, "device": device, "compute_type": compute_type,
+                "error": self.error,
+                "startup_seconds": round((self.ready_at or time.time()) - self.started_at, 2)
+                if self.started_at else None}
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from lib.config_handler import load_config_file
+from lib.helpers import update_config
+
+module_logger = logging.getLogger('icad_transcribe.profile')
+
+invalid_overrides_message = "Invalid Custom Whisper Config JSON data"
+
+
+def get_profile_talkgroups(profile):
+    """
+    Checks one entry of talkgroup_profiles.profiles.
+
+    :param profile: The profile as it appears in the config.
+    :return: A tuple of ((short_name, talkgroup) keys the profile applies to, None), or (None, error message) when
+        the profile is malformed.
+    """
+    if not isinstance(profile, dict):
+        return None, "profile must be an object"
+    if not isinstance(profile.get("whisper", {}), dict):
+        return None, "whisper must be an object"
+    if not isinstance(profile.get("talkgroups", {}), dict):
+        return None, "talkgroups must be an object of short_name to a list of talkgroups or \"*\""
+
+    keys = []
+    for short_name, talkgroup_list in profile.get("talkgroups", {}).items():
+        if talkgroup_list == "*":
+            keys.append((str(short_name), "*"))
+        elif isinstance(talkgroup_list, list):
+            keys.extend((str(short_name), str(talkgroup)) for talkgroup in talkgroup_list)
+        else:
+            return None, f"talkgroups of {short_name} must be a list of talkgroups or \"*\""
+    return keys, None
+
+
+class ProfileStore:
+    """
+    Resolves the whisper configuration of a call, the whisper section of the config with the profile of the call's
+    talkgroup merged over it and the request's whisper_config_data over that.
+
+    Profiles live in the talkgroup_profiles section, each with the talkgroups it applies to by short_name, a list of
+    talkgroup_decimal values or "*" for every talkgroup of the system, and the whisper options it changes:
+
+        "fire": {"talkgroups": {"county": [100, 101]}, "whisper": {"beam_size": 8, "hotwords": "Engine Medic"}}
+
+    Every profile is merged over the whisper section once when the config is loaded and every (profile, overrides)
+    pair once when it is first seen, so resolving a request is a dict lookup. The returned dicts are shared between
+    requests and must not be modified.
+
+    With config_file_path the file is checked for changes at most every reload_interval seconds, a changed file
+    replaces the whisper section and the profiles and clears the memoized configs.
+    """
+
+    def __init__(self, config_data, config_file_path=None, reload_interval=5, max_entries=256):
+        """
+        :param config_data: The loaded config.
+        :param config_file_path: Path of the config file to watch, None never reloads.
+        :param reload_interval: Seconds between checks of the config file's modification time.
+        :param max_entries: Maximum number of memoized (profile, overrides) configs, least recently used go first.
+        """
+        self.config_file_path = config_file_path
+        self.reload_interval = reload_interval
+        self.max_entries = max(1, int(max_entries))
+
+        self._lock = threading.Lock()
+        self._next_check = time.monotonic() + reload_interval
+        self._mtime = self._get_mtime()
+        self._load(config_data)
+
+    def _get_mtime(self):
+        if not self.config_file_path:
+            return None
+        try:
+            return os.stat(self.config_file_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self, config_data):
+        whisper_config_data = config_data.get("whisper", {})
+        profiles = {None: whisper_config_data}
+        talkgroups = {}
+
+        profile_configs = config_data.get("talkgroup_profiles", {}).get("profiles", {})
+        if not isinstance(profile_configs, dict):
+            module_logger.error("talkgroup_profiles.profiles must be an object, no talkgroup profiles loaded")
+            profile_configs = {}
+
+        for name, profile in profile_configs.items():
+            profile_talkgroups, error = get_profile_talkgroups(profile)
+            if error:
+                module_logger.error(f"Skipping talkgroup profile {name}: {error}")
+                continue
+            profiles[name] = update_config(whisper_config_data, profile.get("whisper", {}))
+            for key in profile_talkgroups:
+                talkgroups[key] = name
+
+        # Swapped as one tuple so a request never sees the profiles of one load with the memo of another.
+        self._state = (profiles, talkgroups, OrderedDict())
+
+        module_logger.debug(f"Loaded {len(profiles) - 1} talkgroup profile(s) for {len(talkgroups)} talkgroup(s)")
+
+    def _check_reload(self):
+        if not self.config_file_path:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.reload_interval
+
+        mtime = self._get_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+
+        config_data = load_config_file(self.config_file_path)
+        if not config_data:
+            module_logger.warning(f"Could not reload {self.config_file_path}, keeping the current profiles")
+            return
+
+        self._mtime = mtime
+        try:
+            self._load(config_data)
+        except Exception as e:
+            module_logger.error(f"Could not load the talkgroup profiles of {self.config_file_path}, keeping the "
+                                f"current profiles: {e}")
+            return
+        module_logger.info(f"Reloaded talkgroup profiles from {self.config_file_path}")
+
+    def get_profile_name(self, call_data, talkgroups=None):
+        """Returns the name of the profile for a call's talkgroup, None when no profile applies."""
+        talkgroups = self._state[1] if talkgroups is None else talkgroups
+        short_name = str(call_data.get("short_name", "unknown"))
+        return (talkgroups.get((short_name, str(call_data.get("talkgroup_decimal", 0)))) or
+                talkgroups.get((short_name, "*")))
+
+    def resolve(self, call_data, overrides=None):
+        """
+        Returns the whisper configuration for a call.
+
+        :param call_data: The call JSON sent with the upload.
+        :param overrides: The whisper_config_data JSON text of the request, or None.
+        :return: A tuple of (whisper_config_data, None), or (None, error message) when overrides is not a JSON
+            object.
+        """
+        self._check_reload()
+
+        profiles, talkgroups, memo = self._state
+        profile_name = self.get_profile_name(call_data or {}, talkgroups)
+        if not overrides:
+            return profiles[profile_name], None
+
+        # The request's raw JSON text is the key, a repeated request skips parsing it.
+        key = (profile_name, overrides)
+        with self._lock:
+            merged = memo.get(key)
+            if merged is not None:
+                memo.move_to_end(key)
+                return merged, None
+
+        try:
+            user_whisper_config_data = json.loads(overrides)
+        except json.JSONDecodeError:
+            return None, invalid_overrides_message
+        if not isinstance(user_whisper_config_data, dict):
+            return None, invalid_overrides_message
+
+        merged = update_config(profiles[profile_name], user_whisper_config_data)
+        with self._lock:
+            memo[key] = merged
+            while len(memo) > self.max_entries:
+                memo.popitem(last=False)
+
+        return merged, None
+
+    def stats(self):
+        profiles, talkgroups, memo = self._state
+        return {"profiles": sorted(name for name in profiles if name is not None),
+                "talkgroups": len(talkgroups),
+                "memoized_configs": len(memo),
+                "max_entries": self.max_entries}
+
+
+def get_profile_store(config_data, config_file_path=None):
+    """Builds the ProfileStore described by the talkgroup_profiles section of the config."""
+    return ProfileStore(config_data, config_file_path,
+                        reload_interval=config_data.get("talkgroup_profiles", {}).get("reload_interval", 5),
+                        max_entries=config_data.get("talkgroup_profiles", {}).get("max_entries", 256))
@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+module_logger = logging.getLogger('icad_transcribe.prompt')
+
+# faster-whisper keeps at most the last max_length // 2 - 1 prompt tokens, anything before that is dropped anyway.
+whisper_max_prompt_tokens = 223
+
+
+def get_prompt_key(call_data):
+    """Returns the (system, talkgroup) key prompts are stored under for a call."""
+    return str(call_data.get("short_name", "unknown")), str(call_data.get("talkgroup_decimal", 0))
+
+
+def get_prompt_store(config_data):
+    """
+    Builds the PromptStore described by the prompt_store section of the config. Without a disk_path each gunicorn
+    worker keeps its own prompts, set it to a file all workers can write, e.g. "var/prompt_store.db", to share them.
+    A relative disk_path is taken from the working directory.
+    """
+    disk_path = config_data.get("prompt_store", {}).get("disk_path", None)
+    return PromptStore(max_entries=config_data.get("prompt_store", {}).get("max_entries", 1024),
+                       ttl=config_data.get("prompt_store", {}).get("ttl", 3600),
+                       max_history=config_data.get("prompt_store", {}).get("max_history", 5),
+                       disk_path=os.path.abspath(disk_path) if disk_path else None)
+
+
+class PromptStore:
+    """
+    Keeps the last transcripts of every (system, talkgroup) for use_last_as_initial_prompt.
+
+    Without disk_path the transcripts live in a per process LRU. With it every read and write goes to a SQLite
+    database instead, so all worker processes pointing at the same file build the same prompt no matter which of
+    them takes the call, and the transcripts survive a restart. Both are bounded to max_entries talkgroups, the
+    talkgroups written to least recently are evicted first, and transcripts older than ttl seconds are ignored.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, max_history=5, disk_path=None):
+        """
+        :param max_entries: Maximum number of talkgroups kept.
+        :param ttl: Seconds a transcript stays usable as a prompt, 0 keeps transcripts until they are evicted.
+        :param max_history: Transcripts kept per talkgroup, the upper bound for last_prompt_history.
+        :param disk_path: Path of the SQLite database shared by the workers, None or empty keeps the store in memory.
+        """
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl
+        self.max_history = max(1, int(max_history))
+        self.disk_path = disk_path or None
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        if self.disk_path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.disk_path)), exist_ok=True)
+                with self._connect() as connection:
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.execute("CREATE TABLE IF NOT EXISTS prompts (system TEXT NOT NULL, "
+                                       "talkgroup TEXT NOT NULL, updated_at REAL NOT NULL, "
+                                       "transcripts TEXT NOT NULL, PRIMARY KEY (system, talkgroup))")
+                    connection.execute("CREATE INDEX IF NOT EXISTS prompts_updated_at ON prompts (updated_at)")
+            except (OSError, sqlite3.Error) as e:
+                # An unwritable path must not stop the workers from starting, they just don't share prompts.
+                module_logger.warning(f"Unable to open prompt store {self.disk_path}, keeping prompts in memory: {e}")
+                self.disk_path = None
+            else:
+                self._purge_disk()
+
+    @contextmanager
+    def _connect(self):
+        # One short lived connection per call keeps the store safe across threads and forked workers.
+        connection = sqlite3.connect(self.disk_path, timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _live_transcripts(self, transcripts, now):
+        # Transcripts are stored as [created_at, text] pairs, oldest first.
+        if not self.ttl:
+            return transcripts
+        return [transcript for transcript in transcripts if now - transcript[0] <= self.ttl]
+
+    def get(self, system, talkgroup, count=1):
+        """Returns up to count of the latest transcripts for a talkgroup, oldest first."""
+        now = time.time()
+        key = (str(system), str(talkgroup))
+
+        if self.disk_path:
+            try:
+                with self._connect() as connection:
+                    row = connection.execute("SELECT transcripts FROM prompts WHERE system = ? AND talkgroup = ?",
+                                             key).fetchone()
+            except sqlite3.Error as e:
+                module_logger.warning(f"Failed to read prompt store: {e}")
+                return []
+            transcripts = json.loads(row[0]) if row else []
+        else:
+            with self._lock:
+                transcripts = self._entries.get(key, [])
+
+        transcripts = self._live_transcripts(transcripts, now)
+        return [transcript[1] for transcript in transcripts[-count:]] if count > 0 else []
+
+    def add(self, system, talkgroup, transcript):
+        """Appends a transcript to a talkgroup without touching any other talkgroup of the same system."""
+        if not transcript or not transcript.strip():
+            return
+
+        now = time.time()
+        key = (str(system), str(talkgroup))
+
+        if self.disk_path:
+            self._add_disk(key, transcript, now)
+            return
+
+        with self._lock:
+            transcripts = self._live_transcripts(self._entries.get(key, []), now)
+            self._entries[key] = (transcripts + [[now, transcript]])[-self.max_history:]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _add_disk(self, key, transcript, now):
+        try:
+            connection = sqlite3.connect(self.disk_path, timeout=10, isolation_level=None)
+            try:
+                # Takes the write lock before reading so concurrent workers can not drop each other's transcripts.
+                connection.execute("BEGIN IMMEDIATE")
+                row = connection.execute("SELECT transcripts FROM prompts WHERE system = ? AND talkgroup = ?",
+                                         key).fetchone()
+                transcripts = self._live_transcripts(json.loads(row[0]), now) if row else []
+                transcripts = (transcripts + [[now, transcript]])[-self.max_history:]
+                connection.execute("INSERT OR REPLACE INTO prompts (system, talkgroup, updated_at, transcripts) "
+                                   "VALUES (?, ?, ?, ?)", (*key, now, json.dumps(transcripts)))
+                connection.execute("COMMIT")
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            module_logger.warning(f"Failed to write prompt store: {e}")
+            return
+
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % 64 == 0
+        if purge:
+            self._purge_disk()
+
+    def _purge_disk(self):
+        try:
+            with self._connect() as connection:
+                deleted = 0
+                if self.ttl:
+                    deleted += connection.execute("DELETE FROM prompts WHERE updated_at < ?",
+                                                  (time.time() - self.ttl,)).rowcount
+                deleted += connection.execute("DELETE FROM prompts WHERE rowid IN (SELECT rowid FROM prompts "
+                                              "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                                              (self.max_entries,)).rowcount
+            if deleted:
+                module_logger.debug(f"Purged {deleted} talkgroup(s) from the prompt store")
+        except sqlite3.Error as e:
+            module_logger.warning(f"Failed to purge prompt store: {e}")
+
+    def stats(self):
+        if self.disk_path:
+            try:
+                with self._connect() as connection:
+                    entries = connection.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+            except sqlite3.Error:
+                entries = None
+        else:
+            with self._lock:
+                entries = len(self._entries)
+
+        return {"entries": entries,
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "max_history": self.max_history,
+                "disk": bool(self.disk_path)}
+
+
+def build_prompt(transcripts, max_tokens=whisper_max_prompt_tokens, tokenizer=None):
+    """
+    Joins transcripts, oldest first, into one prompt that fits in max_tokens.
+
+    The oldest text is dropped first so the prompt always ends with the latest transcript. Tokens are counted with
+    the model's tokenizers.Tokenizer when one is given and approximated by words otherwise.
+
+    :param transcripts: List of transcripts, oldest first.
+    :param max_tokens: Token budget for the prompt, 0 disables trimming.
+    :param tokenizer: Optional tokenizers.Tokenizer, e.g. WhisperModel.hf_tokenizer.
+    :return: The prompt text, or None when there is nothing to prompt with.
+    """
+    prompt = " ".join(transcript.strip() for transcript in transcripts if transcript and transcript.strip())
+    if not prompt:
+        return None
+    if not max_tokens:
+        return prompt
+
+    if tokenizer is not None:
+        # Leading space, the way faster-whisper encodes the prompt.
+        encoding = tokenizer.encode(" " + prompt, add_special_tokens=False)
+        if len(encoding.ids) <= max_tokens:
+            return prompt
+        # offsets are into the encoded text, which has the extra leading space. The cut moves forward to the next
+        # word, and once more whenever the trimmed text still tokenizes over budget, the first word can merge
+        # differently without the word in front of it.
+        cut = max(1, encoding.offsets[-max_tokens][0] - 1)
+        if prompt[cut - 1] != " ":
+            cut = prompt.find(" ", cut) + 1
+        while cut > 0:
+            trimmed = prompt[cut:].strip()
+            if not trimmed:
+                return None
+            if len(tokenizer.encode(" " + trimmed, add_special_tokens=False).ids) <= max_tokens:
+                return trimmed
+            cut = prompt.find(" ", cut) + 1
+        return None
+
+    words = prompt.split()
+    if len(words) <= max_tokens:
+        return prompt
+    return " ".join(words[-max_tokens:])
@@ -2,56 +2,156 @@ import csv
 import logging
 import os
 import re
+import threading
+from bisect import bisect_right
 
 module_logger = logging.getLogger('icad_transcribe.replacement')
 
+_engine_cache = {}
+_engine_cache_lock = threading.Lock()
 
-def transcript_replacement(transcript_dict, replacements_file_path):
-    if not os.path.exists(replacements_file_path):
-        module_logger.warning(f"Replacement file does not exist: {replacements_file_path}")
-        return transcript_dict
 
-    try:
-        with open(replacements_file_path, "r") as rf:
-            csv_reader = csv.DictReader(rf)
-            replace_data = [row for row in csv_reader]
+class ReplacementEngine:
+    """
+    Compiled form of a replacements CSV.
 
-            if not replace_data:
-                module_logger.warning("Replacement data is empty.")
-                return transcript_dict
+    All words are matched by a single alternation regex anchored on word boundaries and each match is resolved
+    with a lowercase dict lookup, so a replacement pass is linear in the length of the text no matter how many
+    rows the CSV has.
+    """
 
-    except Exception as e:
-        module_logger.warning(f"Failed to read or process replacements file: {e}")
-        return transcript_dict
+    def __init__(self, replace_data):
+        self.replacements = {}
+        for replacement in replace_data:
+            word = (replacement.get("Word") or "").strip()
+            if not word:
+                continue
+            # The first row for a word wins, same as the old linear scan.
+            self.replacements.setdefault(word.lower(), replacement.get("Replacement", word) or "")
+
+        # Longest words first so multi word phrases win over a single word they start with.
+        words = sorted(self.replacements, key=len, reverse=True)
+        self.pattern = re.compile(r'(?<!\w)(?:' + '|'.join(re.escape(word) for word in words) + r')(?!\w)',
+                                  flags=re.IGNORECASE) if words else None
+
+    def __len__(self):
+        return len(self.replacements)
 
-    def replace_func(match):
+    def _replace_match(self, match):
         word = match.group(0)
-        for replacement in replace_data:
-            if word.lower() == replacement.get("Word", "").lower():
-                return replacement.get("Replacement", word)
-        return word
+        return self.replacements.get(word.lower(), word)
+
+    def replace(self, text):
+        if not self.pattern or not text:
+            return text
+        return self.pattern.sub(self._replace_match, text)
+
+    def replace_words(self, words):
+        """
+        Applies the replacements to a segment's word list.
+
+        The words are joined once and matched in a single pass, a match that spans several words, e.g. en route,
+        merges them into one word that keeps the first word's start and the last word's end.
+
+        :param words: List of word dicts with word, start and end, as built for word_timestamps.
+        :return: A new list of word dicts, words without a match are passed through as they are.
+        """
+        if not self.pattern or not words:
+            return words
+
+        text = "".join(word['word'] for word in words)
+        offsets = []
+        position = 0
+        for word in words:
+            offsets.append(position)
+            position += len(word['word'])
+
+        # Runs of words touched by one or more overlapping matches, as [first, last] word indexes.
+        spans = []
+        for match in self.pattern.finditer(text):
+            first = bisect_right(offsets, match.start()) - 1
+            last = bisect_right(offsets, match.end() - 1) - 1
+            if spans and first <= spans[-1][1]:
+                spans[-1][1] = max(spans[-1][1], last)
+            else:
+                spans.append([first, last])
+
+        if not spans:
+            return words
+
+        replaced_words = []
+        next_word = 0
+        for first, last in spans:
+            replaced_words.extend(words[next_word:first])
+            span_end = offsets[last] + len(words[last]['word'])
+            replaced_words.append(dict(words[first], word=self.replace(text[offsets[first]:span_end]),
+                                       end=words[last]['end']))
+            next_word = last + 1
+        replaced_words.extend(words[next_word:])
+        return replaced_words
 
+
+def get_replacements_file_version(replacements_file_path):
+    """Returns the (mtime_ns, size) of a replacements file, None when it does not exist."""
+    try:
+        file_stat = os.stat(replacements_file_path)
+    except OSError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+def load_replacement_engine(replacements_file_path):
+    """
+    Returns the compiled ReplacementEngine for a replacements file.
+
+    Engines are cached per file and rebuilt automatically when the file's modification time or size changes.
+    Returns None if the file is missing, unreadable or empty.
+    """
     try:
-        pattern = '|'.join(
-            re.escape(replacement.get("Word")) for replacement in replace_data if replacement.get("Word"))
-
-        # Replace in the main transcript text
-        if 'transcript' in transcript_dict:
-            transcript_dict['transcript'] = re.sub(pattern, replace_func, transcript_dict['transcript'], flags=re.IGNORECASE)
-
-        # Concatenate all segments' texts with a unique delimiter
-        if 'segments' in transcript_dict:
-            delimiter = '|SEGMENT_DELIMITER|'
-            all_segments_text = delimiter.join(segment['text'] for segment in transcript_dict['segments'])
-            all_segments_text_replaced = re.sub(pattern, replace_func, all_segments_text, flags=re.IGNORECASE)
-
-            # Split the replaced text back into segments based on the delimiter
-            replaced_segments = all_segments_text_replaced.split(delimiter)
-            for segment, replaced_text in zip(transcript_dict['segments'], replaced_segments):
-                segment['text'] = replaced_text
-
-    except re.error as e:
-        module_logger.warning(f"Regex error: {e}")
+        file_stat = os.stat(replacements_file_path)
+    except FileNotFoundError:
+        module_logger.warning(f"Replacement file does not exist: {replacements_file_path}")
+        return None
+    except OSError as e:
+        module_logger.warning(f"Failed to read or process replacements file: {e}")
+        return None
+
+    file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    with _engine_cache_lock:
+        cached = _engine_cache.get(replacements_file_path)
+        if cached and cached[0] == file_version:
+            return cached[1]
+
+        try:
+            with open(replacements_file_path, "r") as rf:
+                csv_reader = csv.DictReader(rf)
+                engine = ReplacementEngine(csv_reader)
+        except Exception as e:
+            module_logger.warning(f"Failed to read or process replacements file: {e}")
+            return None
+
+        if not len(engine):
+            module_logger.warning("Replacement data is empty.")
+            engine = None
+        else:
+            module_logger.debug(f"Compiled {len(engine)} replacements from {replacements_file_path}")
+
+        _engine_cache[replacements_file_path] = (file_version, engine)
+        return engine
+
+
+def transcript_replacement(transcript_dict, replacements_file_path):
+    engine = load_replacement_engine(replacements_file_path)
+    if not engine:
         return transcript_dict
 
+    # Replace in the main transcript text
+    if 'transcript' in transcript_dict and isinstance(transcript_dict['transcript'], str):
+        transcript_dict['transcript'] = engine.replace(transcript_dict['transcript'])
+
+    if 'segments' in transcript_dict:
+        for segment in transcript_dict['segments']:
+            segment['text'] = engine.replace(segment['text'])
+
     return transcript_dict
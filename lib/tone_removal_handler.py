@@ -1,105 +1,269 @@
 import logging
+from bisect import bisect_left, bisect_right
 
-from pydub import AudioSegment
+import numpy as np
+
+from lib.audio_handler import SAMPLE_RATE
 
 module_logger = logging.getLogger('icad_transcribe.tone_removal')
 
-def split_audio(audio_segment, chunk_length=1000):
+
+def get_window_dbfs(audio, window_size):
     """
-    Splits the audio segment into chunks of the specified length in milliseconds.
-    This is a simple utility function for demonstration and may need adjustment based on actual use case.
+    Calculates the RMS level in dBFS of every window of window_size samples in one vectorized pass.
 
-    :param audio_segment: The audio segment to split.
-    :param chunk_length: The length of each chunk in milliseconds.
-    :return: A list of audio segments.
+    :param audio: A float32 NumPy array in the range [-1.0, 1.0].
+    :param window_size: Number of samples per window, the last window may be shorter.
+    :return: A float64 array with one dBFS value per window, -inf for digitally silent windows.
     """
-    # Assuming audio_segment.duration_seconds is the total duration in seconds
-    chunk_length_ms = chunk_length  # chunk_length is already in milliseconds
-    num_chunks = max(1, int(audio_segment.duration_seconds * 1000 // chunk_length_ms))
-    return [audio_segment[i * chunk_length_ms:(i + 1) * chunk_length_ms] for i in range(num_chunks)]
+    full_windows = audio.shape[0] // window_size
+    windows = audio[:full_windows * window_size].reshape(full_windows, window_size)
+    sum_squares = np.einsum('ij,ij->i', windows, windows, dtype=np.float64)
+    window_lengths = np.full(full_windows, window_size, dtype=np.float64)
+
+    # The last window may be shorter, average it over its real length so it is not diluted.
+    tail = audio[full_windows * window_size:]
+    if tail.shape[0]:
+        sum_squares = np.append(sum_squares, np.dot(tail, tail.astype(np.float64)))
+        window_lengths = np.append(window_lengths, tail.shape[0])
+
+    mean_squares = sum_squares / window_lengths
 
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(mean_squares)
 
-def apply_agc_with_silence_detection(audio_segment, target_peak=-25, clipping_threshold=-12, silence_threshold=-48):
+
+def apply_agc_with_silence_detection(audio, target_peak=-25, clipping_threshold=-12, silence_threshold=-48,
+                                     sample_rate=SAMPLE_RATE, window_ms=100, smooth_gain=False):
     """
-    Apply Automatic Gain Control (AGC) to an audio segment to normalize its volume, while ignoring silent sections
+    Apply Automatic Gain Control (AGC) to audio samples to normalize its volume, while ignoring silent sections
     and avoiding clipping.
 
-    :param audio_segment: The audio segment to process.
+    The level of every window, the silence mask and the clipped gain are all computed over the whole array at
+    once, so the cost is a handful of linear NumPy passes regardless of the audio length.
+
+    :param audio: The float32 sample array to process.
     :param target_peak: The target peak in dBFS that we want to amplify up to but not exceed.
     :param clipping_threshold: The dBFS value above which we consider the signal might clip.
     :param silence_threshold: The dBFS value below which a segment is considered silent.
-    :return: The processed AudioSegment with AGC applied selectively, ignoring silent segments and avoiding clipping.
+    :param sample_rate: The sample rate of the audio array.
+    :param window_ms: Length of the analysis windows in milliseconds.
+    :param smooth_gain: Ramp the gain linearly from one window to the next instead of stepping it at every
+        window boundary.
+    :return: A new sample array with AGC applied selectively, ignoring silent segments and avoiding clipping.
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    if audio.shape[0] == 0:
+        return audio.copy()
+
+    window_size = max(1, int(sample_rate * window_ms / 1000))
+    window_dbfs = get_window_dbfs(audio, window_size)
+
+    # Gain needed to reach the target peak, capped by the clipping threshold. Silent windows are left untouched
+    # and the gain is never negative.
+    is_silent = window_dbfs < silence_threshold
+    with np.errstate(invalid='ignore'):
+        gain_db = np.minimum(target_peak - window_dbfs, clipping_threshold - window_dbfs)
+    gain_db[is_silent | ~np.isfinite(gain_db) | (gain_db <= 0)] = 0.0
+
+    window_gain = np.power(10.0, gain_db / 20).astype(np.float32)
+
+    processed_audio = np.array(audio, dtype=np.float32, copy=True)
+    full_windows = processed_audio.shape[0] // window_size
+    windows = processed_audio[:full_windows * window_size].reshape(full_windows, window_size)
+    tail = processed_audio[full_windows * window_size:]
+
+    if smooth_gain:
+        # Ramp linearly from the previous window's gain to this window's gain across each window.
+        previous_gain = np.concatenate((window_gain[:1], window_gain[:-1]))
+        ramp = np.arange(window_size, dtype=np.float32) / window_size
+        gain_step = window_gain - previous_gain
+        windows *= previous_gain[:full_windows, None] + gain_step[:full_windows, None] * ramp
+        if tail.shape[0]:
+            tail *= previous_gain[-1] + gain_step[-1] * ramp[:tail.shape[0]]
+    else:
+        windows *= window_gain[:full_windows, None]
+        if tail.shape[0]:
+            tail *= window_gain[-1]
+
+    np.clip(processed_audio, -1.0, 1.0, out=processed_audio)
+
+    return processed_audio
+
+
+def get_speech_regions(audio, threshold=-45, min_silence=1.0, min_speech=0.1, pad=0.25, sample_rate=SAMPLE_RATE,
+                       window_ms=20):
+    """
+    Finds the stretches of the sample array that carry signal from the level of short windows, a cheap stand in
+    for a VAD model that is good enough to find squelch tails and dead air between transmissions.
+
+    :param audio: A float32 NumPy array in the range [-1.0, 1.0].
+    :param threshold: The dBFS level at or above which a window counts as speech.
+    :param min_silence: Seconds of silence needed to split two regions, shorter pauses stay inside a region.
+    :param min_speech: Regions with less than this many seconds of signal are dropped as clicks.
+    :param pad: Seconds of audio kept on either side of every region.
+    :param sample_rate: The sample rate of the audio array.
+    :param window_ms: Length of the analysis windows in milliseconds.
+    :return: A sorted list of non overlapping (start_sample, end_sample) tuples.
+    """
+    audio_length = audio.shape[0]
+    if audio_length == 0:
+        return []
+
+    window_size = max(1, int(sample_rate * window_ms / 1000))
+    is_speech = get_window_dbfs(audio, window_size) >= threshold
+    if not is_speech.any():
+        return []
+
+    # Window indexes where a run of speech starts and where it ends, exclusive.
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], is_speech, [False])).astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+
+    is_split = (starts[1:] - ends[:-1]) * window_size >= min_silence * sample_rate
+    starts = np.concatenate((starts[:1], starts[1:][is_split]))
+    ends = np.concatenate((ends[:-1][is_split], ends[-1:]))
+
+    pad_samples = int(pad * sample_rate)
+    regions = []
+    for start, end in zip(starts * window_size, ends * window_size):
+        if end - start < min_speech * sample_rate:
+            continue
+        start, end = max(0, int(start) - pad_samples), min(audio_length, int(end) + pad_samples)
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+
+    return regions
+
+
+class TimestampMap:
     """
-    segments = split_audio(audio_segment, chunk_length=100)  # Split into chunks, e.g., every 1000ms.
-    processed_segments = []
-
-    for segment in segments:
-        segment_peak_dBFS = segment.dBFS  # Get the current peak amplitude of the segment in dBFS.
-        is_silent = segment_peak_dBFS < silence_threshold  # Determine if the segment is silent.
-
-        if not is_silent:
-            # Calculate how much gain is needed to reach the target peak, capped by the clipping threshold.
-            max_gain = clipping_threshold - segment_peak_dBFS
-            gain_needed = min(target_peak - segment_peak_dBFS, max_gain)
-
-            # Only apply gain if it doesn't lead to clipping and is a positive value.
-            if gain_needed > 0:
-                amplified_segment = segment.apply_gain(gain_needed)
-                processed_segments.append(amplified_segment)
+    Maps times in audio that had its silence removed back to the original audio, so segment and word times, tone
+    times and srcList positions all stay on the timeline of the uploaded call.
+
+    Every kept region is stored as where it starts in the trimmed audio, where it started in the original audio
+    and its length, all in seconds.
+    """
+
+    def __init__(self, trimmed_starts, original_starts, lengths):
+        self.trimmed_starts = trimmed_starts
+        self.original_starts = original_starts
+        self.lengths = lengths
+
+    def to_original(self, time, is_end=False):
+        """
+        Returns the original time for a time in the trimmed audio.
+
+        A time in the gap inserted between two regions maps to the end of the region before it when it ends a
+        segment or word, and to the start of the region after it otherwise. An end right at the start of a region
+        counts as in the gap before it.
+        """
+        index = max(0, (bisect_left if is_end else bisect_right)(self.trimmed_starts, time) - 1)
+        offset = time - self.trimmed_starts[index]
+        if offset > self.lengths[index]:
+            if is_end or index + 1 == len(self.trimmed_starts):
+                offset = self.lengths[index]
             else:
-                processed_segments.append(segment)
+                return round(self.original_starts[index + 1], 3)
+        return round(self.original_starts[index] + max(0.0, offset), 3)
+
+    def to_trimmed(self, time):
+        """Returns the time in the trimmed audio for an original time, removed silence maps to the next region."""
+        index = bisect_right(self.original_starts, time) - 1
+        if index < 0:
+            return 0.0
+        offset = time - self.original_starts[index]
+        if offset > self.lengths[index]:
+            if index + 1 == len(self.original_starts):
+                return self.trimmed_starts[index] + self.lengths[index]
+            return self.trimmed_starts[index + 1]
+        return self.trimmed_starts[index] + offset
+
+
+def trim_silence(audio, threshold=-45, min_silence=1.0, min_speech=0.1, pad=0.25, gap=0.3, sample_rate=SAMPLE_RATE):
+    """
+    Drops the leading and trailing silence of a call and collapses every longer silence inside it to gap seconds,
+    so the model only decodes the transmissions. See get_speech_regions for the detection parameters.
+
+    :param audio: The float32 sample array to process.
+    :param gap: Seconds of silence left between two regions, enough for the model to see a break.
+    :return: A tuple of the trimmed sample array and a TimestampMap back to the original audio. The original array
+        and None when there is nothing to remove or no region was found.
+    """
+    regions = get_speech_regions(audio, threshold=threshold, min_silence=min_silence, min_speech=min_speech,
+                                 pad=pad, sample_rate=sample_rate)
+    if not regions or (len(regions) == 1 and regions[0] == (0, audio.shape[0])):
+        return audio, None
+
+    gap_samples = int(gap * sample_rate)
+    trimmed_audio = np.zeros(sum(end - start for start, end in regions) + gap_samples * (len(regions) - 1),
+                             dtype=np.float32)
+
+    trimmed_starts, original_starts, lengths = [], [], []
+    position = 0
+    for start, end in regions:
+        trimmed_audio[position:position + end - start] = audio[start:end]
+        trimmed_starts.append(position / sample_rate)
+        original_starts.append(start / sample_rate)
+        lengths.append((end - start) / sample_rate)
+        position += end - start + gap_samples
+
+    return trimmed_audio, TimestampMap(trimmed_starts, original_starts, lengths)
+
+
+def get_tone_intervals(detected_tones, pre_cut_length=0.5, post_cut_length=0.5):
+    """
+    Collects every tone from the call JSON, whatever its type, pads it and merges overlapping intervals.
+
+    :param detected_tones: The tones dict from the call JSON, e.g. two_tone, long_tone, hi_low_tone, hl_tone.
+    :param pre_cut_length: Seconds to cut before each tone.
+    :param post_cut_length: Seconds to cut after each tone.
+    :return: A sorted list of non overlapping (start, end) tuples in seconds.
+    """
+    intervals = []
+    for tones in detected_tones.values():
+        if not isinstance(tones, list):
+            continue
+        for tone in tones:
+            if isinstance(tone, dict) and 'start' in tone and 'end' in tone:
+                intervals.append((max(0.0, tone['start'] - pre_cut_length), tone['end'] + post_cut_length))
+
+    intervals.sort()
+
+    merged_intervals = []
+    for start, end in intervals:
+        if merged_intervals and start <= merged_intervals[-1][1]:
+            merged_intervals[-1] = (merged_intervals[-1][0], max(merged_intervals[-1][1], end))
         else:
-            processed_segments.append(segment)  # Append silent segments unmodified.
+            merged_intervals.append((start, end))
 
-    # Concatenate all the processed segments back together.
-    processed_audio = sum(processed_segments[1:], processed_segments[0])
+    return merged_intervals
 
-    return processed_audio
 
+def cut_tones_from_audio(detected_tones, audio, pre_cut_length=0.5, post_cut_length=0.5, sample_rate=SAMPLE_RATE):
+    """
+    Silences every detected tone in the sample array in place.
+
+    The audio keeps its length so segment timestamps still line up with the original call. Overlapping tones,
+    such as stacked two tone pages, are merged first so each sample is written at most once.
 
-def cut_tones_from_audio(detected_tones, audio_segment, pre_cut_length=0.5, post_cut_length=0.5):
+    :param detected_tones: The tones dict from the call JSON.
+    :param audio: The float32 sample array, modified in place.
+    :param pre_cut_length: Seconds to cut before each tone.
+    :param post_cut_length: Seconds to cut after each tone.
+    :param sample_rate: The sample rate of the audio array.
+    :return: The same sample array with the tones silenced, or None if the tones could not be processed.
+    """
     try:
-        # Initialize a new, empty audio segment to build the processed audio
-        processed_audio = AudioSegment.empty()
-
-        # Gather all tone information in one list and sort them by their start time
-        all_tones = sorted(
-            detected_tones.get('two_tone', []) +
-            detected_tones.get('warble_tone', []) +
-            detected_tones.get('long_tone', []),
-            key=lambda x: x['start']
-        )
-
-        last_end_ms = 0
-        audio_length_ms = len(audio_segment)
-
-        for tone in all_tones:
-            # Adjust the start and end times with pre_cut_length and post_cut_length, ensuring they stay within the audio bounds
-            start_ms = max(0, int(tone['start'] * 1000) - int(pre_cut_length * 1000))
-            end_ms = min(audio_length_ms, int(tone['end'] * 1000) + int(post_cut_length * 1000))
-
-            # Add the audio segment before the tone to the processed audio
-            processed_audio += audio_segment[last_end_ms:start_ms]
-
-            # Create a silent audio segment for the duration of the tone and add it
-            silence_duration = max(0, end_ms - start_ms)  # Ensure non-negative duration
-            silence = AudioSegment.silent(duration=silence_duration)
-            processed_audio += silence
-
-            # Update the last_end_ms to the end of the current tone
-            last_end_ms = end_ms
-
-        # After processing all tones, add the remaining audio segment
-        processed_audio += audio_segment[last_end_ms:]
-
-        # Ensure the processed audio is the same length as the input audio
-        if len(processed_audio) > audio_length_ms:
-            processed_audio = processed_audio[:audio_length_ms]
-        elif len(processed_audio) < audio_length_ms:
-            silence_padding = AudioSegment.silent(duration=audio_length_ms - len(processed_audio))
-            processed_audio += silence_padding
-
-        return processed_audio
+        audio_length = audio.shape[0]
+
+        for start, end in get_tone_intervals(detected_tones, pre_cut_length, post_cut_length):
+            start_sample = min(audio_length, int(start * sample_rate))
+            end_sample = min(audio_length, int(end * sample_rate))
+            audio[start_sample:end_sample] = 0.0
+
+        return audio
 
     except Exception as e:
         module_logger.error(f"An error occurred while cutting tones from the audio: {e}")
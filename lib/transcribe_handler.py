@@ -0,0 +1,537 @@
+import functools
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lib.address_handler import get_potential_addresses
+from lib.audio_handler import SAMPLE_RATE
+from lib.batch_handler import can_batch, get_batch_key, transcribe_batch
+from lib.helpers import inject_alert_tone_segments
+from lib.metrics_handler import observe_stage, time_stage
+from lib.model_handler import get_model_key
+from lib.prompt_handler import PromptStore, build_prompt, get_prompt_key, whisper_max_prompt_tokens
+from lib.replacement_handler import transcript_replacement, load_replacement_engine
+from lib.tone_removal_handler import cut_tones_from_audio, apply_agc_with_silence_detection, trim_silence
+from lib.unit_handler import TransmissionIndex, associate_segments_with_src, get_key_up_spans, \
+    split_segments_by_unit, tile_src_list
+
+module_logger = logging.getLogger('icad_transcribe.transcribe')
+
+default_vad_parameters = {"threshold": 0.5, "min_speech_duration_ms": 250, "max_speech_duration_s": 3600,
+                          "min_silence_duration_ms": 2000, "window_size_samples": 1024, "speech_pad_ms": 400}
+
+prompt_store = PromptStore()
+
+
+def preprocess_audio(audio, call_data, whisper_config_data):
+    """
+    Runs the optional tone cutting, AGC and silence trimming steps over the decoded sample array.
+
+    :param audio: The decoded float32 sample array.
+    :param call_data: The call JSON sent with the upload.
+    :param whisper_config_data: The effective whisper configuration for this request.
+    :return: A tuple of the processed sample array, the tones that were cut and the TimestampMap back to the
+        original audio when silence was trimmed, otherwise None.
+    """
+    detected_tones = {"two_tone": [], "long_tone": [], "hl_tone": []}
+
+    if whisper_config_data.get("cut_tones", False):
+        if call_data.get("tones", {}):
+            detected_tones = call_data["tones"]
+            module_logger.debug(f"Cutting Tones From Audio: {detected_tones}")
+            with time_stage("tone_cut"):
+                cut_audio = cut_tones_from_audio(detected_tones, audio,
+                                                 pre_cut_length=whisper_config_data.get("cut_pre_tone", 0.5),
+                                                 post_cut_length=whisper_config_data.get("cut_post_tone", 0.5))
+            if cut_audio is not None:
+                audio = cut_audio
+
+    if whisper_config_data.get("amplify_audio", False):
+        module_logger.debug(f"Amplifying Audio")
+        with time_stage("agc"):
+            audio = apply_agc_with_silence_detection(audio,
+                                                     target_peak=whisper_config_data.get("amplify_target_peak", -25),
+                                                     silence_threshold=whisper_config_data.get(
+                                                         "amplify_silence_threshold", -48),
+                                                     clipping_threshold=whisper_config_data.get(
+                                                         "amplify_clipping_threshold", -12),
+                                                     smooth_gain=whisper_config_data.get("amplify_smooth_gain",
+                                                                                         False))
+
+    timestamp_map = None
+    if whisper_config_data.get("trim_silence", False):
+        original_length = audio.shape[0]
+        with time_stage("silence_trim"):
+            audio, timestamp_map = trim_silence(audio,
+                                                threshold=whisper_config_data.get("trim_silence_threshold", -45),
+                                                min_silence=whisper_config_data.get("trim_min_silence", 1.0),
+                                                pad=whisper_config_data.get("trim_pad", 0.25),
+                                                gap=whisper_config_data.get("trim_gap", 0.3))
+        module_logger.debug(f"Trimmed {round((original_length - audio.shape[0]) / SAMPLE_RATE, 2)} seconds of "
+                            f"silence")
+
+    return audio, detected_tones, timestamp_map
+
+
+def set_prompt_store(store):
+    """Replaces the default in memory store for use_last_as_initial_prompt, e.g. with one shared over SQLite."""
+    global prompt_store
+    prompt_store = store
+
+
+def get_initial_prompt(call_data, whisper_config_data, model=None):
+    """
+    Returns the prompt for a call, the talkgroup's last transcripts with use_last_as_initial_prompt and the
+    configured initial_prompt otherwise.
+
+    :param model: The WhisperModel the call runs on, its tokenizer is used to trim the prompt to
+        last_prompt_max_tokens.
+    """
+    if whisper_config_data.get("use_last_as_initial_prompt", False) and call_data:
+        transcripts = prompt_store.get(*get_prompt_key(call_data),
+                                       count=whisper_config_data.get("last_prompt_history", 1))
+        return build_prompt(transcripts,
+                            max_tokens=whisper_config_data.get("last_prompt_max_tokens", whisper_max_prompt_tokens),
+                            tokenizer=getattr(model, "hf_tokenizer", None))
+
+    return whisper_config_data.get("initial_prompt", None)
+
+
+def run_inference(model, audio, whisper_config_data, initial_prompt):
+    """Starts faster-whisper inference for one call and returns the lazy segment generator."""
+    segments, info = model.transcribe(audio,
+                                      beam_size=whisper_config_data.get("beam_size", 5),
+                                      best_of=whisper_config_data.get("best_of", 5),
+                                      language=whisper_config_data.get("language", "en"),
+                                      initial_prompt=initial_prompt or None,
+                                      word_timestamps=whisper_config_data.get("word_timestamps", False),
+                                      vad_filter=whisper_config_data.get("vad_filter", False),
+                                      vad_parameters=whisper_config_data.get("vad_parameters",
+                                                                             default_vad_parameters),
+                                      hotwords=whisper_config_data.get("hotwords", None))
+    return segments
+
+
+def warm_up_model(model, whisper_config_data, seconds=2.0, runs=1):
+    """
+    Runs the model over synthetic audio, a swept tone over low noise, so CTranslate2, CUDA and the VAD model are
+    initialized before the first real call. Decoding stops after a few tokens since only the first pass is slow.
+    """
+    sample_rate = 16000
+    timeline = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = (0.1 * np.sin(2 * np.pi * (300 + 200 * timeline) * timeline) +
+             0.01 * np.random.default_rng(0).standard_normal(timeline.shape[0])).astype(np.float32)
+
+    for _ in range(max(1, int(runs))):
+        segments, info = model.transcribe(audio,
+                                          beam_size=whisper_config_data.get("beam_size", 5),
+                                          language=whisper_config_data.get("language", "en"),
+                                          word_timestamps=whisper_config_data.get("word_timestamps", False),
+                                          vad_filter=whisper_config_data.get("vad_filter", False),
+                                          max_new_tokens=8)
+        for _ in segments:
+            pass
+
+
+def get_warm_up(config_data):
+    """
+    Returns the warm up ModelStartup runs on each loaded model, as set in the model_pool section of the config, or
+    None when warm_up_seconds is 0.
+    """
+    seconds = config_data.get("model_pool", {}).get("warm_up_seconds", 2)
+    if not seconds:
+        return None
+    return functools.partial(warm_up_model, whisper_config_data=config_data.get("whisper", {}), seconds=seconds,
+                             runs=config_data.get("model_pool", {}).get("warm_up_runs", 1))
+
+
+def get_replacements_file_path(whisper_config_data, config_path):
+    return os.path.join(config_path, whisper_config_data.get("replacements_file", "transcribe_replacements.csv"))
+
+
+def process_word_segments(segments_data, transmission_sources, replacement_engine=None):
+    """
+    Post-processing for word_timestamps, applies the replacements to every segment's words, tags each word with
+    the source transmitting at the time and splits segments where the source changes. Segment text is rebuilt
+    from the replaced words.
+
+    :param segments_data: List of segment dicts with their word lists.
+    :param transmission_sources: TransmissionIndex for the call's srcList.
+    :param replacement_engine: Optional ReplacementEngine for the request's replacements file.
+    :return: A new list of segment dicts.
+    """
+    if replacement_engine:
+        for segment in segments_data:
+            if segment["words"]:
+                segment["words"] = replacement_engine.replace_words(segment["words"])
+            else:
+                segment["text"] = replacement_engine.replace(segment["text"])
+
+    return split_segments_by_unit(segments_data, transmission_sources)
+
+
+def build_transcription_result(segments, call_data, whisper_config_data, detected_tones, config_path, start=None,
+                               on_segment=None, timestamp_map=None):
+    """
+    Turns faster-whisper segments into the /transcribe response for one call.
+
+    :param segments: Iterable of faster-whisper Segment tuples, may be the lazy generator from run_inference.
+    :param call_data: The call JSON sent with the upload.
+    :param whisper_config_data: The effective whisper configuration for this request.
+    :param detected_tones: The tones that were cut from the audio.
+    :param config_path: Directory that holds the replacements files.
+    :param start: Time the request was received, used for process_time_seconds.
+    :param on_segment: Optional callable that receives each segment as soon as it is decoded, with its unit tag
+        and replacements already applied. Used for streaming responses.
+    :param timestamp_map: TimestampMap from trim_silence, segment and word times are mapped back to the original
+        audio before anything else looks at them.
+    :return: A tuple of the response dict and the HTTP status code.
+    """
+    start = start or time.time()
+
+    def original_time(time, is_end=False):
+        return timestamp_map.to_original(time, is_end) if timestamp_map else time
+
+    # Sorted once per call, every segment is then tagged with a binary search.
+    transmission_sources = TransmissionIndex(call_data.get('srcList') or [{
+        "pos": 0,
+        "src": 0,
+        "tag": "Speaker"
+    }])
+    unit_attribution = whisper_config_data.get("unit_attribution", "closest")
+
+    word_timestamps = whisper_config_data.get("word_timestamps", False)
+
+    replacement_engine = None
+    if on_segment or word_timestamps:
+        replacement_engine = load_replacement_engine(get_replacements_file_path(whisper_config_data, config_path))
+
+    try:
+        segments_data = []
+        segment_count = 0
+        streamed_count = 0
+        # The segments generator decodes lazily, time spent waiting on it is inference, the rest is assembly.
+        assembly_start = time.perf_counter()
+        inference_seconds = 0.0
+        # A list was already decoded by a batch, which records its time once under batch_inference.
+        is_lazy = not isinstance(segments, list)
+        segments = iter(segments)
+        while True:
+            inference_start = time.perf_counter()
+            segment = next(segments, None)
+            inference_seconds += time.perf_counter() - inference_start
+            if segment is None:
+                break
+
+            segment_count += 1
+            text = []
+            word_id = 0
+            if word_timestamps:
+                for word in segment.words:
+                    word_id += 1
+                    text.append({'word_id': word_id, 'word': word.word, 'start': original_time(word.start),
+                                 'end': original_time(word.end, True)})
+
+            segments_data.append(
+                {"segment_id": segment_count, "text": segment.text.strip(), "words": text, "unit_tag": "",
+                 "start": original_time(segment.start),
+                 "end": original_time(segment.end, True)})
+
+            if on_segment:
+                # Streamed copy, the stored segment still goes through the normal post-processing below.
+                streamed_segment = dict(segments_data[-1], words=[dict(word) for word in segments_data[-1]["words"]])
+                if word_timestamps:
+                    streamed_segments = process_word_segments([streamed_segment], transmission_sources,
+                                                              replacement_engine)
+                else:
+                    streamed_segments = associate_segments_with_src([streamed_segment], transmission_sources,
+                                                                    mode=unit_attribution)
+                    if replacement_engine:
+                        streamed_segment["text"] = replacement_engine.replace(streamed_segment["text"])
+
+                for streamed_segment in streamed_segments:
+                    streamed_count += 1
+                    streamed_segment["segment_id"] = streamed_count
+                    on_segment(streamed_segment)
+
+        if whisper_config_data.get("cut_tones", False) and whisper_config_data.get("show_tone_text", False):
+            segments_data = inject_alert_tone_segments(segments_data, detected_tones)
+
+        if word_timestamps:
+            with time_stage("replacement"):
+                segments_data = process_word_segments(segments_data, transmission_sources, replacement_engine)
+        else:
+            segments_data = associate_segments_with_src(segments_data, transmission_sources, mode=unit_attribution)
+
+        transcribe_text = " ".join(segment['text'] for segment in segments_data)
+
+        if is_lazy:
+            observe_stage("inference", inference_seconds)
+        observe_stage("segment_assembly", time.perf_counter() - assembly_start - inference_seconds)
+
+    except Exception as e:
+        traceback.print_exc()
+        result = {"success": False, "message": f"Exception: {e}"}
+        module_logger.error(result.get("message"))
+        return result, 400
+
+    if not transcribe_text or len(transcribe_text.strip()) == 0:
+        transcribe_text = []
+        addresses = []
+    else:
+        with time_stage("address_extraction"):
+            addresses = get_potential_addresses(transcribe_text)
+
+    if whisper_config_data.get("use_last_as_initial_prompt", False) and transcribe_text:
+        prompt_store.add(*get_prompt_key(call_data), transcribe_text)
+
+    result = {"success": True, "message": "Transcribe Success!", "transcript": transcribe_text,
+              "addresses": addresses, "segments": segments_data,
+              "process_time_seconds": round((time.time() - start), 2)}
+
+    # With word_timestamps the replacements were already applied to the words the segment text is built from.
+    if not word_timestamps:
+        with time_stage("replacement"):
+            result = transcript_replacement(result, replacements_file_path=get_replacements_file_path(
+                whisper_config_data, config_path))
+
+    return result, 200
+
+
+def transcribe_audio(model, audio, call_data, whisper_config_data, detected_tones, config_path, start=None,
+                     on_segment=None, timestamp_map=None):
+    """
+    Runs inference and the transcript post-processing for one call.
+
+    See build_transcription_result for on_segment and timestamp_map.
+
+    :return: A tuple of the response dict and the HTTP status code.
+    """
+    try:
+        segments = run_inference(model, audio, whisper_config_data,
+                                 get_initial_prompt(call_data, whisper_config_data, model))
+    except Exception as e:
+        traceback.print_exc()
+        result = {"success": False, "message": f"Exception: {e}"}
+        module_logger.error(result.get("message"))
+        return result, 400
+
+    return build_transcription_result(segments, call_data, whisper_config_data, detected_tones, config_path,
+                                      start=start, on_segment=on_segment, timestamp_map=timestamp_map)
+
+
+def get_transmission_pieces(audio, call_data, whisper_config_data, timestamp_map=None):
+    """
+    Cuts a call's audio at the key ups in its srcList for split_transmissions.
+
+    :param timestamp_map: TimestampMap when silence was trimmed, the key ups are moved onto the trimmed audio.
+    :return: List of (offset, length, audio) tuples, one per transmission, offset and length in seconds of the
+        audio passed in. The audio of each piece is a view, nothing is copied.
+    """
+    pieces = []
+    for start, end in get_key_up_spans(call_data.get('srcList'), whisper_config_data.get("split_min_seconds", 1.0)):
+        if timestamp_map:
+            start, end = timestamp_map.to_trimmed(start), timestamp_map.to_trimmed(end)
+        start_sample = int(start * SAMPLE_RATE)
+        end_sample = min(audio.shape[0], int(min(end, audio.shape[0] / SAMPLE_RATE) * SAMPLE_RATE))
+        if end_sample > start_sample:
+            pieces.append((start_sample / SAMPLE_RATE, (end_sample - start_sample) / SAMPLE_RATE,
+                           audio[start_sample:end_sample]))
+    return pieces
+
+
+def offset_segments(segments, offset, length):
+    """
+    Moves the segments of one transmission onto the call's timeline. Segments and words the model placed past the
+    end of the transmission's audio are dropped and ends are clamped to it, so nothing spills into the next one.
+    """
+    for segment in segments:
+        if segment.start >= length:
+            continue
+        words = segment.words
+        if words:
+            words = [word._replace(start=offset + word.start, end=offset + min(word.end, length))
+                     for word in words if word.start < length]
+        yield segment._replace(start=offset + segment.start, end=offset + min(segment.end, length), words=words)
+
+
+def transcribe_transmissions(model, jobs, config_path):
+    """
+    split_transmissions, cuts every call at its srcList key ups and decodes each transmission on its own. The
+    transmissions that fit in one window go through transcribe_batch together, across all calls of the batch, the
+    rest run side by side on the model's CTranslate2 workers. A call then takes about as long as its longest
+    transmission instead of the sum of them.
+
+    Each call's segments are stitched back in order with their offsets, and every segment is tagged with the
+    transmission it was decoded from.
+
+    :return: List of (result, status_code) tuples in the same order as jobs, None for the jobs that were not split.
+    """
+    results = [None] * len(jobs)
+
+    pieces = []
+    for index, job in enumerate(jobs):
+        if not job.whisper_config_data.get("split_transmissions", False) or job.audio is None:
+            continue
+        job_pieces = get_transmission_pieces(job.audio, job.call_data, job.whisper_config_data, job.timestamp_map)
+        if len(job_pieces) > 1:
+            pieces.extend((index, *piece) for piece in job_pieces)
+
+    if not pieces:
+        return results
+
+    prompts = {}
+    for index, offset, length, audio in pieces:
+        if index not in prompts:
+            prompts[index] = get_initial_prompt(jobs[index].call_data, jobs[index].whisper_config_data, model)
+
+    piece_segments = [None] * len(pieces)
+
+    batch_groups = {}
+    for piece_index, (index, offset, length, audio) in enumerate(pieces):
+        if can_batch(model, audio, jobs[index].whisper_config_data):
+            batch_groups.setdefault(get_batch_key(jobs[index].whisper_config_data), []).append(piece_index)
+
+    for piece_indexes in batch_groups.values():
+        if len(piece_indexes) < 2:
+            continue
+        try:
+            with time_stage("batch_inference"):
+                segment_lists = transcribe_batch(model, [pieces[piece_index][3] for piece_index in piece_indexes],
+                                                 jobs[pieces[piece_indexes[0]][0]].whisper_config_data,
+                                                 [prompts[pieces[piece_index][0]] for piece_index in piece_indexes],
+                                                 default_vad_parameters=default_vad_parameters)
+        except Exception as e:
+            module_logger.warning(f"Batched inference failed, transcribing transmissions individually: {e}")
+            continue
+        for piece_index, segments in zip(piece_indexes, segment_lists):
+            piece_segments[piece_index] = segments
+
+    def decode_piece(piece_index):
+        index, offset, length, audio = pieces[piece_index]
+        try:
+            return list(run_inference(model, audio, jobs[index].whisper_config_data, prompts[index]))
+        except Exception as e:
+            traceback.print_exc()
+            return e
+
+    remaining = [piece_index for piece_index, segments in enumerate(piece_segments) if segments is None]
+    if remaining:
+        # CTranslate2 runs at most num_workers transcriptions of a model at once, more threads would only queue.
+        workers = max(1, min(getattr(model.model, "num_workers", 1), len(remaining)))
+        with time_stage("batch_inference"), ThreadPoolExecutor(max_workers=workers) as executor:
+            for piece_index, segments in zip(remaining, executor.map(decode_piece, remaining)):
+                piece_segments[piece_index] = segments
+
+    job_pieces = {}
+    for piece, segments in zip(pieces, piece_segments):
+        job_pieces.setdefault(piece[0], []).append((piece[1], piece[2], segments))
+
+    for index, transmissions in job_pieces.items():
+        job = jobs[index]
+        errors = [segments for offset, length, segments in transmissions if isinstance(segments, Exception)]
+        if errors:
+            result = {"success": False, "message": f"Exception: {errors[0]}"}
+            module_logger.error(result.get("message"))
+            results[index] = (result, 400)
+            continue
+
+        segments = [segment for offset, length, transmission_segments in transmissions
+                    for segment in offset_segments(transmission_segments, offset, length)]
+        # Interval attribution over the same boundaries the audio was cut at tags each segment with the
+        # transmission it came from.
+        call_data = dict(job.call_data, srcList=tile_src_list(job.call_data['srcList']))
+        results[index] = build_transcription_result(segments, call_data,
+                                                    dict(job.whisper_config_data, unit_attribution="interval"),
+                                                    job.detected_tones, config_path, start=job.start,
+                                                    on_segment=job.emit_segment if job.streaming else None,
+                                                    timestamp_map=job.timestamp_map)
+
+    module_logger.debug(f"Split {len(job_pieces)} call(s) into {len(pieces)} transmission(s)")
+
+    return results
+
+
+def transcribe_jobs(model, jobs, config_path):
+    """
+    Transcribes a batch of queued jobs.
+
+    Jobs with compatible decode options that fit in a single window share one batched encoder and generate
+    pass, the rest, including streaming jobs, are transcribed one at a time. Jobs with split_transmissions are
+    cut at their key ups first, see transcribe_transmissions.
+
+    :param model: The WhisperModel instance to use.
+    :param jobs: List of TranscriptionJob objects collected by the job queue.
+    :param config_path: Directory that holds the replacements files.
+    :return: List of (result, status_code) tuples in the same order as jobs.
+    """
+    results = transcribe_transmissions(model, jobs, config_path)
+
+    batch_groups = {}
+    for index, job in enumerate(jobs):
+        if results[index] is None and not job.streaming and can_batch(model, job.audio, job.whisper_config_data):
+            batch_groups.setdefault(get_batch_key(job.whisper_config_data), []).append(index)
+
+    for indexes in batch_groups.values():
+        if len(indexes) < 2:
+            continue
+
+        group_jobs = [jobs[index] for index in indexes]
+        try:
+            with time_stage("batch_inference"):
+                segment_lists = transcribe_batch(model, [job.audio for job in group_jobs],
+                                                 group_jobs[0].whisper_config_data,
+                                                 [get_initial_prompt(job.call_data, job.whisper_config_data, model)
+                                                  for job in group_jobs],
+                                                 default_vad_parameters=default_vad_parameters)
+        except Exception as e:
+            module_logger.warning(f"Batched inference failed, transcribing jobs individually: {e}")
+            continue
+
+        for index, job, segments in zip(indexes, group_jobs, segment_lists):
+            results[index] = build_transcription_result(segments, job.call_data, job.whisper_config_data,
+                                                        job.detected_tones, config_path, start=job.start,
+                                                        timestamp_map=job.timestamp_map)
+
+    for index, job in enumerate(jobs):
+        if results[index] is None:
+            results[index] = transcribe_audio(model, job.audio, job.call_data, job.whisper_config_data,
+                                              job.detected_tones, config_path, start=job.start,
+                                              on_segment=job.emit_segment if job.streaming else None,
+                                              timestamp_map=job.timestamp_map)
+
+    return results
+
+
+def transcribe_model_groups(model_registry, jobs, config_path):
+    """
+    Groups queued jobs by the model they asked for and transcribes each group with that model.
+
+    :param model_registry: The ModelRegistry models are taken from.
+    :param jobs: List of TranscriptionJob objects collected by the job queue.
+    :param config_path: Directory that holds the replacements files.
+    :return: List of (result, status_code) tuples in the same order as jobs.
+    """
+    results = [None] * len(jobs)
+
+    model_groups = {}
+    for index, job in enumerate(jobs):
+        model_groups.setdefault(get_model_key(job.whisper_config_data), []).append(index)
+
+    for model_key, indexes in model_groups.items():
+        try:
+            model = model_registry.get(model_key)
+        except Exception as e:
+            module_logger.error(f"Exception Loading Whisper Model {model_key}: {e}")
+            for index in indexes:
+                results[index] = ({"success": False, "message": f"Exception Loading Whisper Model: {e}"}, 400)
+            continue
+
+        for index, result in zip(indexes, transcribe_jobs(model, [jobs[index] for index in indexes], config_path)):
+            results[index] = result
+
+    return results
@@ -1,24 +1,182 @@
+from bisect import bisect_left, bisect_right
+
+unit_attribution_modes = ("closest", "interval")
+
+
+class TransmissionIndex:
+    """
+    The srcList of a call sorted by pos once, so each lookup is a binary search instead of a scan over every source.
+
+    A source's transmission runs from pos for its duration when the call JSON has one, and otherwise until the next
+    source keys up. When several sources key up at the same pos the one listed last in srcList is the one that
+    transmits there, the others are dropped so both lookups agree on it.
+    """
+
+    def __init__(self, src_list):
+        # Stable sort, so among sources with the same pos the last one in srcList ends up last and is kept.
+        order = sorted(range(len(src_list or [])), key=lambda index: src_list[index].get('pos', 0))
+        self.order = [index for position, index in enumerate(order)
+                      if position + 1 == len(order) or
+                      src_list[order[position + 1]].get('pos', 0) != src_list[index].get('pos', 0)]
+        self.sources = [src_list[index] for index in self.order]
+        self.positions = [src.get('pos', 0) for src in self.sources]
+
+        self.ends = []
+        for index, src in enumerate(self.sources):
+            if src.get('duration'):
+                self.ends.append(self.positions[index] + src['duration'])
+            elif index + 1 < len(self.sources):
+                self.ends.append(self.positions[index + 1])
+            else:
+                self.ends.append(float('inf'))
+
+    def __len__(self):
+        return len(self.sources)
+
+    def closest(self, time):
+        """
+        Returns the source whose pos is nearest to time, the one listed first in srcList when two key ups are
+        equally near, or None without sources.
+        """
+        if not self.sources:
+            return None
+
+        index = bisect_left(self.positions, time)
+        if index == 0:
+            return self.sources[0]
+        if index == len(self.positions):
+            return self.sources[-1]
+
+        before_distance = time - self.positions[index - 1]
+        after_distance = self.positions[index] - time
+        if before_distance < after_distance or (before_distance == after_distance and
+                                                self.order[index - 1] < self.order[index]):
+            return self.sources[index - 1]
+        return self.sources[index]
+
+    def containing(self, time):
+        """
+        Returns the source transmitting at time. In a gap between two transmissions it is whichever of them is
+        nearer in time, before the first transmission it is the first source. None without sources.
+        """
+        if not self.sources:
+            return None
+
+        index = bisect_right(self.positions, time) - 1
+        if index < 0:
+            return self.sources[0]
+        if time < self.ends[index] or index + 1 == len(self.sources):
+            return self.sources[index]
+        if self.positions[index + 1] - time < time - self.ends[index]:
+            return self.sources[index + 1]
+        return self.sources[index]
+
+    def lookup(self, start, end, mode="closest"):
+        if mode == "interval":
+            return self.containing((start + end) / 2)
+        return self.closest(start)
+
+
+def get_unit_tag(src):
+    if src is None:
+        return ""
+    if src.get('src', 0) == -1:
+        return 0
+    return src.get('tag') or src.get('src', 0)
+
+
 def get_closest_src(src_list, segment):
-    def closest_source(src):
-        return abs(src['pos'] - segment['start'])
+    return TransmissionIndex(src_list).closest(segment['start'])
 
-    closest_src = min(src_list, key=closest_source)
-    return closest_src
 
+def associate_segments_with_src(segments, src_list, mode="closest"):
+    """
+    Sets the unit_tag of every segment from the call's srcList.
 
-def associate_segments_with_src(segments, src_list):
+    :param segments: List of segment dicts with start and end times, changed in place.
+    :param src_list: The call's srcList, or a TransmissionIndex built from it to reuse across calls.
+    :param mode: closest tags a segment with the source that keyed up nearest to its start. interval tags it with
+        the source transmitting at its midpoint, and tags every word of it the same way by the word's midpoint.
+    :return: The segments.
+    """
+    index = src_list if isinstance(src_list, TransmissionIndex) else TransmissionIndex(src_list)
 
     for segment in segments:
-        # Finding the closest source based on the segment start time
-        closest_src = get_closest_src(src_list, segment)
+        segment['unit_tag'] = get_unit_tag(index.lookup(segment['start'], segment['end'], mode))
 
-        # Applying the rules for unit_tag
-        if closest_src['src'] != -1:
-            if closest_src['tag']:
-                segment['unit_tag'] = closest_src['tag']
-            else:
-                segment['unit_tag'] = closest_src['src']
-        else:
-            segment['unit_tag'] = 0
+        if mode == "interval":
+            for word in segment.get('words') or []:
+                word['unit_tag'] = get_unit_tag(index.containing((word['start'] + word['end']) / 2))
 
     return segments
+
+
+def get_key_up_spans(src_list, min_length=0.0):
+    """
+    Cuts a call's timeline at every key up in its srcList.
+
+    :param src_list: The call's srcList.
+    :param min_length: Seconds, a key up less than this after the previous cut does not start a new span.
+    :return: Sorted (start, end) tuples in seconds that cover the whole call, the first starts at 0 and the last
+        ends at inf.
+    """
+    spans = []
+    start = 0.0
+    for position in sorted({src.get('pos', 0) for src in src_list or []}):
+        if position - start < min_length:
+            continue
+        spans.append((start, position))
+        start = position
+    spans.append((start, float('inf')))
+    return spans
+
+
+def tile_src_list(src_list):
+    """
+    Copies of the srcList entries without their duration, so every transmission runs until the next key up, the
+    same boundaries get_key_up_spans cuts at.
+    """
+    return [{key: value for key, value in src.items() if key != 'duration'} for src in src_list or []]
+
+
+def split_segments_by_unit(segments, src_list):
+    """
+    Tags every word with the source transmitting at its midpoint and splits segments where the source changes,
+    so a segment that runs across two transmissions comes back as one segment per transmission.
+
+    Segment text is rebuilt from the words, segments without words are tagged by their midpoint and kept as they
+    are. Segment and word ids are renumbered.
+
+    :param segments: List of segment dicts with word lists, as built for word_timestamps.
+    :param src_list: The call's srcList, or a TransmissionIndex built from it.
+    :return: A new list of segment dicts.
+    """
+    index = src_list if isinstance(src_list, TransmissionIndex) else TransmissionIndex(src_list)
+
+    split_segments = []
+    for segment in segments:
+        words = segment.get('words')
+        if not words:
+            segment['unit_tag'] = get_unit_tag(index.lookup(segment['start'], segment['end'], "interval"))
+            split_segments.append(segment)
+            continue
+
+        pieces = []
+        for word in words:
+            word['unit_tag'] = get_unit_tag(index.containing((word['start'] + word['end']) / 2))
+            if not pieces or word['unit_tag'] != pieces[-1]['unit_tag']:
+                pieces.append(dict(segment, unit_tag=word['unit_tag'], words=[],
+                                   start=word['start'] if pieces else segment['start']))
+            word['word_id'] = len(pieces[-1]['words']) + 1
+            pieces[-1]['words'].append(word)
+            pieces[-1]['end'] = word['end']
+        pieces[-1]['end'] = segment['end']
+
+        for piece in pieces:
+            piece['text'] = "".join(word['word'] for word in piece['words']).strip()
+        split_segments.extend(pieces)
+
+    for segment_id, segment in enumerate(split_segments, start=1):
+        segment['segment_id'] = segment_id
+
+    return split_segments
@@ -0,0 +1,101 @@
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from flask import Request
+
+module_logger = logging.getLogger('icad_transcribe.upload')
+
+
+class MemoryLimitExceeded(Exception):
+    """Raised when decoding an upload would push the process over its memory ceiling."""
+
+    def __init__(self, required_bytes, available_bytes):
+        super().__init__(f"Decoding needs {round(required_bytes / (1024 * 1024), 1)} MB but only "
+                         f"{round(max(0, available_bytes) / (1024 * 1024), 1)} MB is left under the memory ceiling")
+        self.required_bytes = required_bytes
+        self.available_bytes = available_bytes
+
+
+def get_process_rss():
+    """Returns the resident set size of this process in bytes, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryLimiter:
+    """
+    Admission control for decoded audio.
+
+    Before an upload is decoded its PCM size is reserved against the ceiling, the reservation is checked against
+    the current resident size of the process plus every other decode that is still running, so a burst of
+    uploads can not all pass the check before any of them has allocated its buffer. Once a decode finishes the
+    buffer shows up in the resident size and the reservation is released.
+    """
+
+    def __init__(self, ceiling_mb=0):
+        """
+        :param ceiling_mb: Maximum resident memory for the process in MB, 0 disables the limit.
+        """
+        self.ceiling = int(ceiling_mb * 1024 * 1024)
+        self._reserved = 0
+        self._lock = threading.Lock()
+        self.rejections = 0
+
+        if self.ceiling and get_process_rss() is None:
+            module_logger.warning("Process memory can not be read on this platform, the memory ceiling is disabled")
+            self.ceiling = 0
+
+    @contextmanager
+    def reserve(self, required_bytes):
+        if not self.ceiling:
+            yield
+            return
+
+        with self._lock:
+            available = self.ceiling - get_process_rss() - self._reserved
+            if required_bytes > available:
+                self.rejections += 1
+                raise MemoryLimitExceeded(required_bytes, available)
+            self._reserved += required_bytes
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._reserved -= required_bytes
+
+    def stats(self):
+        rss = get_process_rss()
+        return {"ceiling_mb": round(self.ceiling / (1024 * 1024), 1),
+                "rss_mb": round(rss / (1024 * 1024), 1) if rss is not None else None,
+                "reserved_mb": round(self._reserved / (1024 * 1024), 1),
+                "rejections": self.rejections}
+
+
+class SpooledUploadRequest(Request):
+    """
+    Request class that writes every uploaded file straight to a named temporary file.
+
+    Werkzeug keeps uploads under 500 KB in memory and larger ones in an anonymous temporary file, either way
+    the decoder has to pull the bytes back through Python. Spooling to a named file lets the decoder open the
+    upload by path. Flask closes, and so deletes, the files when the request ends.
+    """
+
+    spool_path = None
+    # Upload size limits for endpoints that take more than MAX_CONTENT_LENGTH, keyed by endpoint name.
+    endpoint_max_content_length = {}
+
+    @property
+    def max_content_length(self):
+        if self.endpoint in self.endpoint_max_content_length:
+            return self.endpoint_max_content_length[self.endpoint]
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile("wb+", dir=self.spool_path, prefix="icad_upload_")
@@ -0,0 +1,239 @@
+#!/home/icad/.venv/bin/python
+"""
+Offline transcription of trunk-recorder archives without going through the HTTP server.
+
+    python transcribe_cli.py batch /data/trunk-recorder/2024-05-11 --output 2024-05-11.jsonl
+
+Audio files are paired with the call JSON next to them, decoded and preprocessed (tone cutting, AGC) with their
+talkgroup's profile in a pool of worker processes and transcribed in the main process. Every output line is
+the call's /transcribe response with its path and status code added, {"filename": ..., "status_code": ..., ...},
+the same lines the /transcribe/batch endpoint streams. Calls that were transcribed, or rejected as bad input, are
+recorded in a checkpoint file, running the same command again picks up where it stopped and retries the rest.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from lib.archive_handler import pair_call_files
+from lib.config_handler import load_config_file
+from lib.helpers import load_json, validate_audio_file
+from lib.job_handler import TranscriptionJob
+from lib.json_handler import dumps_result_line, word_formats
+from lib.logging_handler import CustomLogger
+from lib.model_handler import ModelRegistry, get_model_key
+from lib.profile_handler import get_profile_store
+from lib.prompt_handler import get_prompt_store
+from lib.transcribe_handler import preprocess_audio, set_prompt_store, transcribe_model_groups
+
+app_name = "icad_transcribe"
+
+# Set in every worker process by init_worker.
+profile_store = None
+whisper_overrides = None
+
+
+def find_calls(input_path, recursive=True):
+    """Returns the (audio_path, json_path) pairs under input_path, relative to it."""
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(input_path):
+        for file_name in file_names:
+            paths.append(os.path.relpath(os.path.join(dir_path, file_name), input_path))
+        if not recursive:
+            break
+    return pair_call_files(paths)
+
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, "r") as cf:
+        return {line.rstrip("\n") for line in cf if line.strip()}
+
+
+def init_worker(config_file_path, overrides):
+    """Runs once in every worker process, loads the talkgroup profiles the calls are resolved against."""
+    global profile_store, whisper_overrides
+    profile_store = get_profile_store(load_config_file(config_file_path) or {})
+    whisper_overrides = overrides
+
+
+def prepare_call(input_path, audio_name, json_name, upload_config_data):
+    """
+    Runs in a worker process, validates, decodes and preprocesses one call exactly like the /transcribe route.
+
+    :return: A tuple of (audio_name, prepared, error) where prepared is (audio, call_data, whisper_config_data,
+        detected_tones, timestamp_map, start) and error is a (result, status_code) tuple when the call was
+        rejected.
+    """
+    start = time.time()
+    try:
+        call_data = {}
+        if json_name:
+            with open(os.path.join(input_path, json_name), "rb") as json_file:
+                call_data, error = load_json(json_file)
+            if error:
+                return audio_name, None, ({"success": False, "message": error}, 400)
+
+        whisper_config_data, error = profile_store.resolve(call_data, whisper_overrides)
+        if error:
+            return audio_name, None, ({"success": False, "message": error}, 400)
+
+        with open(os.path.join(input_path, audio_name), "rb") as audio_file:
+            is_valid, validation_response, audio = validate_audio_file(
+                audio_file,
+                upload_config_data.get("allowed_extensions", ["audio/x-wav", "audio/x-m4a", "audio/mpeg"]),
+                upload_config_data.get("max_audio_length", 300))
+        if not is_valid:
+            return audio_name, None, ({"success": False, "message": validation_response}, 400)
+
+        audio, detected_tones, timestamp_map = preprocess_audio(audio, call_data, whisper_config_data)
+        return audio_name, (audio, call_data, whisper_config_data, detected_tones, timestamp_map, start), None
+    except Exception as e:
+        traceback.print_exc()
+        return audio_name, None, ({"success": False, "message": f"Exception: {e}"}, 500)
+
+
+def run_batch(args, logger):
+    config_path = os.path.dirname(os.path.abspath(args.config))
+    config_data = load_config_file(args.config)
+    if not config_data:
+        logger.error(f"Failed to load configuration from {args.config}")
+        return 1
+
+    # Each call resolves its talkgroup's profile in the worker processes, this only checks --whisper-config.
+    whisper_config_data, error = get_profile_store(config_data).resolve({}, args.whisper_config)
+    if error:
+        logger.error(f"Invalid --whisper-config: {error}")
+        return 1
+
+    calls = find_calls(args.input, recursive=not args.no_recursive)
+    checkpoint_path = args.checkpoint or (f"{args.output}.checkpoint" if args.output != "-" else None)
+    completed = load_checkpoint(checkpoint_path) if checkpoint_path else set()
+    calls = [(audio_name, json_name) for audio_name, json_name in calls if audio_name not in completed]
+    logger.info(f"Found {len(calls) + len(completed)} call(s) in {args.input}, {len(completed)} already done")
+    if not calls:
+        return 0
+
+    set_prompt_store(get_prompt_store(config_data))
+
+    model_registry = ModelRegistry(os.getenv("TRANSFORMERS_CACHE", os.path.join(os.getcwd(), 'models')),
+                                   cpu_threads=whisper_config_data.get("cpu_threads", 4),
+                                   offline=config_data.get("model_pool", {}).get("offline", False),
+                                   verify_checksums=config_data.get("model_pool", {}).get("verify_checksums", True),
+                                   refresh_days=config_data.get("model_pool", {}).get("refresh_days", 0))
+    # Loads the default model up front, a model that fails to load stops the run instead of failing every call.
+    model_registry.get(get_model_key(whisper_config_data))
+
+    output_file = sys.stdout if args.output == "-" else open(args.output, "a")
+    checkpoint_file = open(checkpoint_path, "a") if checkpoint_path else None
+    upload_config_data = config_data.get("audio_upload", {})
+    batch_size = args.batch_size or config_data.get("job_queue", {}).get("batch_size", 8)
+    max_pending = args.queue_size or args.processes * 2
+
+    written = failed = 0
+    run_start = time.time()
+
+    def write_result(audio_name, result, status_code, done):
+        """Writes one output line, done marks the call finished in the checkpoint so a rerun skips it."""
+        nonlocal written, failed
+        output_file.write(dumps_result_line(audio_name, result, status_code, args.word_format))
+        output_file.flush()
+        written += 1
+        if status_code != 200:
+            failed += 1
+        if checkpoint_file and done:
+            checkpoint_file.write(audio_name + "\n")
+            checkpoint_file.flush()
+
+    try:
+        pending_calls = iter(calls)
+        pending = set()
+        # Spawned rather than forked, forking a process that already holds a loaded model is not safe.
+        with ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_worker, initargs=(args.config, args.whisper_config)) as executor:
+            def fill():
+                # The pending set is the bounded queue between the decode processes and the model.
+                for audio_name, json_name in pending_calls:
+                    pending.add(executor.submit(prepare_call, args.input, audio_name, json_name, upload_config_data))
+                    if len(pending) >= max_pending:
+                        break
+
+            fill()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                pending.difference_update(done)
+                fill()
+
+                audio_names = []
+                jobs = []
+                for future in done:
+                    audio_name, prepared, error = future.result()
+                    if error:
+                        # Rejected input is not retried, an unexpected failure while preparing it is.
+                        write_result(audio_name, *error, done=error[1] < 500)
+                        continue
+                    audio, call_data, call_whisper_config_data, detected_tones, timestamp_map, start = prepared
+                    audio_names.append(audio_name)
+                    jobs.append(TranscriptionJob(audio, call_data, call_whisper_config_data, detected_tones,
+                                                 start=start, timestamp_map=timestamp_map))
+
+                for batch_start in range(0, len(jobs), batch_size):
+                    batch_results = transcribe_model_groups(model_registry, jobs[batch_start:batch_start + batch_size],
+                                                            config_path)
+                    for audio_name, (result, status_code) in zip(audio_names[batch_start:batch_start + batch_size],
+                                                                 batch_results):
+                        # Inference failures come back as 400 too, only a transcript marks the call done.
+                        write_result(audio_name, result, status_code, done=status_code == 200)
+
+                logger.info(f"{written}/{len(calls)} call(s) transcribed")
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    logger.info(f"Transcribed {written} call(s) in {round(time.time() - run_start, 2)} seconds, {failed} failed")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='icad-transcribe', description='iCAD Transcribe offline tools.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch_parser = subparsers.add_parser('batch', help='Transcribe a directory of trunk-recorder audio and JSON files')
+    batch_parser.add_argument('input', help='Directory holding the audio files and their call JSON files')
+    batch_parser.add_argument('-o', '--output', default='-', help='JSONL file results are appended to, - for stdout')
+    batch_parser.add_argument('--checkpoint', default=None,
+                              help='File listing finished calls, defaults to the output path plus .checkpoint')
+    batch_parser.add_argument('-c', '--config', default=os.path.join('etc', 'config.json'),
+                              help='Config file, the replacements file is read from the same directory')
+    batch_parser.add_argument('--whisper-config', default=None,
+                              help='JSON merged over the whisper section and the talkgroup\'s profile, same as '
+                                   'whisper_config_data')
+    batch_parser.add_argument('-p', '--processes', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                              help='Decode and preprocess worker processes')
+    batch_parser.add_argument('--queue-size', type=int, default=0,
+                              help='Maximum calls decoded ahead of the model, defaults to twice the processes')
+    batch_parser.add_argument('--batch-size', type=int, default=0,
+                              help='Calls per inference batch, defaults to job_queue.batch_size from the config')
+    batch_parser.add_argument('--word-format', choices=word_formats, default='objects',
+                              help='columns writes each segment\'s words as parallel arrays, same as ?word_format')
+    batch_parser.add_argument('--no-recursive', action='store_true', help='Do not descend into sub directories')
+    batch_parser.add_argument('--log-level', type=int, default=2, help='1 debug to 5 critical')
+
+    args = parser.parse_args()
+
+    log_path = os.path.join(os.getcwd(), 'log')
+    os.makedirs(log_path, exist_ok=True)
+    logger = CustomLogger(args.log_level, app_name, os.path.join(log_path, f"{app_name}_cli.log")).logger
+
+    if args.command == 'batch':
+        sys.exit(run_batch(args, logger))
+
+
+if __name__ == "__main__":
+    main()